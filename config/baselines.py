@@ -0,0 +1,41 @@
+"""
+Baseline Configuration File
+---------------------------
+Classical (pyiqa) IQA metrics every MLLM run is compared against, see
+utils/iqa_baselines.py. Metric names are pyiqa names; their 0-100 scaling
+lives in legacy/common_utils.py (IQA_METRIC_SCALES).
+"""
+
+baselines = {
+    # Images per forward pass of each metric. Only images of the same size
+    # share a batch; metrics that resize internally batch freely.
+    # "cpu": True runs the metric in the CPU process pool even when a GPU is
+    # available (classical, non-neural metrics)
+    "metrics": {
+        "musiq": {"batch_size": 8},
+        "arniqa-kadid": {"batch_size": 16},
+        "topiq_nr": {"batch_size": 16},
+        "tres": {"batch_size": 8},
+        "clipiqa": {"batch_size": 32},
+        "maniqa": {"batch_size": 8},
+        "dbcnn": {"batch_size": 16},
+        "paq2piq": {"batch_size": 16},
+        "hyperiqa": {"batch_size": 16},
+        "cnniqa": {"batch_size": 32},
+        "liqe": {"batch_size": 16},
+        # "brisque": {"batch_size": 1, "cpu": True},
+        # "niqe": {"batch_size": 1, "cpu": True},
+    },
+    # "auto" uses CUDA when available; with "cpu" every metric runs in the pool
+    "device": "auto",
+    # Worker processes for CPU metrics, and torch threads per worker (None
+    # splits the available cores between the workers)
+    "cpu_workers": 4,
+    "cpu_threads_per_worker": None,
+    # Images decoded ahead of the device metrics by background threads
+    "decode_workers": 4,
+    # Images decoded and scored together by the device metrics
+    "chunk_size": 64,
+    # SQLite store of (metric, image content hash) -> score
+    "score_cache_path": "cache/iqa_scores.sqlite",
+}
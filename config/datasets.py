@@ -1,7 +1,14 @@
 datasets = {
     "KADID10K": {
+        # Images scored per run (None scores every image), drawn
+        # deterministically from sample_seed; "stratified" spreads them over
+        # the MOS range, "random" draws uniformly (see utils/manifest.py)
         "sample_size": 150,
-        "path": "/home/jovyan/nr_iqa_masters_thesis/experiment_1/data/kadid_images"
+        "sample_seed": 0,
+        "sampling": "stratified",
+        "path": "/home/jovyan/nr_iqa_masters_thesis/experiment_1/data/kadid_images",
+        # "image_name value" per line, read by utils/evaluation.py
+        "mos_path": "/home/jovyan/nr_iqa_masters_thesis/data/MOS_scores/NR_KADID_sampled_uniform.txt"
     },
     # "SPAQ": {
     #     "sample_size": 150,
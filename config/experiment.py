@@ -0,0 +1,41 @@
+"""
+Experiment Configuration File
+-----------------------------
+Runtime settings for the experiment driver (batching, execution order, ...).
+"""
+
+experiment = {
+    # Number of (prompt, image) samples sent to the model in one generate call
+    "batch_size": 4,
+    # "prompt_major": loop prompt -> images (batched)
+    # "image_major": loop image -> prompts, decoding/encoding each image once
+    "execution_order": "prompt_major",
+    # Number of batches (or images in image-major order) loaded ahead of the
+    # model by background workers; 0 loads everything on the main thread
+    "prefetch_depth": 2,
+    "prefetch_workers": 2,
+    # On-disk cache of preprocessed pixel tensors (None disables it)
+    "tensor_cache_dir": "cache/tensors",
+    "tensor_cache_max_gb": 20,
+    # SQLite store of generated responses reused across reruns (None disables it)
+    "response_cache_path": "cache/responses.sqlite",
+    "response_cache_max_mb": 512,
+    # Unix socket of a running model server (`python -m models.server start`);
+    # runs attach to its warm models instead of loading their own
+    "model_server_socket": "cache/model_server.sock",
+    # Rows buffered before a Parquet row group is written to the results file
+    "results_row_group_size": 1000,
+    # Adaptive screening of prompts (utils/adaptive.py): images are scored in
+    # an order shuffled by the dataset's sample_seed, and a (model, dataset,
+    # prompt) cell stops once the confidence intervals of its SRCC and PLCC
+    # against MOS are narrower than "tolerance", or its SRCC interval lies
+    # below that of a better prompt. A dataset's sample_size caps the images
+    # per cell; datasets without a mos_path are scored in full
+    "adaptive": {
+        "enabled": False,
+        "tolerance": 0.1,
+        "confidence": 0.95,
+        # Images with a MOS a cell scores before it may stop
+        "min_samples": 30,
+    },
+}
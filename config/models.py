@@ -1,3 +1,10 @@
+# Optional per-model placement keys (see models/device.py):
+#   "device": "auto" | "cuda" | "cuda:1" | "cpu"   (default "auto")
+#   "dtype": "float16" | "bfloat16" | "float32"     (default: the adapter's on CUDA, float32 on CPU)
+#   "autocast": True | False                        (CPU default: bf16 autocast where native)
+#   "cpu_threads", "cpu_interop_threads": torch thread pools on CPU
+# Optional image decoding key (see models/image_decode.py):
+#   "decode_size": shortest edge images are decoded at (default: the adapter's; None for full resolution)
 models = {
     # "model1": {
     #     "model_name": "llava-v1.5-7b",
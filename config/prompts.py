@@ -3,6 +3,18 @@ Prompt Configuration File
 ------------------------
 Contains versioned prompts and utility functions to access them.
 Each prompt can have multiple versions and experiment-specific settings.
+`max_new_tokens` optionally caps how many tokens a version may generate,
+never beyond the adapter's own limit (200 for LLaVA-1.5, 300 for LLaVA-1.6,
+a 400-token total for IDEFICS, 512 for mPLUG-Owl2 and 1024 for
+InternLM-XComposer2); without it a version decodes up to that limit.
+Decoding also stops as soon as a version's `regex_pattern` has matched. A
+version with `constrained_output` can only answer `prefix` (optional)
+followed by one of its `choices`, which covers numeric scales and
+categorical labels alike, and is budgeted to its longest answer; it is an
+opt-in mode, set only on versions of their own.
+Chained versions declare what they produce (`output_type`) and consume
+(`input_type`); a consumer's text has a `{<input_type>}` placeholder that is
+filled with the producer's output for the same image.
 """
 
 prompts = {
@@ -31,6 +43,13 @@ prompts = {
                 "token_pairs": ["good", "poor"],  # for softmax comparison
                 "active": False
             },
+            "v5": {
+                # v2 with the answer constrained to the scale
+                "text": "Score the quality of the image from 1 to 5, with 1 as lowest and 5 as highest.",
+                "extraction_method": "direct_output",
+                "constrained_output": {"choices": ["1", "2", "3", "4", "5"]},
+                "active": False
+            },
             
         }
     },
@@ -59,6 +78,18 @@ prompts = {
                 "regex_pattern": r"Score:\s*(\d+)",
                 "description_pattern": r"Description:\s*(.+?)\.\s*Score:",
                 "active": True
+            },
+            "v3": {
+                # v1 with the answer constrained to "Score: <0-100>"
+                "text": """For the given image, please assign a perceptual quality score in terms 
+                of structure and texture preservation, color and luminance reproduction, noise, contrast, 
+                sharpness, and any other low-level distortions. The score must range from 0 to 100, with a higher 
+                score denoting better image quality. Your response must only include a score to summarize its visual quality of the given image. 
+                The response format should be: Score: [a score].""",
+                "extraction_method": "direct_output",
+                "regex_pattern": r"Score:\s*(\d+)",
+                "constrained_output": {"prefix": "Score: ", "choices": [str(score) for score in range(101)]},
+                "active": False
             }
         }
     },
@@ -206,12 +237,13 @@ prompts = {
                 "text": """
 Based on this image, what would it take to capture a high quality image to minimize distortions that might affect this image? Only output your propositions like this: (1) ... (2) ...""",
                 "extraction_method": "direct_output",
+                "output_type": "guidelines",
                 "active": True
             },
 
              "v3": {
                 "text": """
-You are provided with an image and a list of guidlines {the_list} to take a high-quality image to minimize distortions that might affect this image. 
+You are provided with an image and a list of guidlines {guidelines} to take a high-quality image to minimize distortions that might affect this image. 
 
 For each proposition in the list of guidlines, tell me if based on your understanding of the image, the guidlines are followed or violated. Rate how the actual image setup is aligned with the guidlines using the following scale:
 - 5: Excellent – The actual setup aligns very closely with the ideal.
@@ -220,8 +252,26 @@ For each proposition in the list of guidlines, tell me if based on your understa
 - 2: Bad – The actual setup diverges significantly from the ideal, impacting quality.
 - 1: Poor – The actual setup is far from ideal, resulting in major quality issues.""",
                 "extraction_method": "direct_output",
+                "input_type": "guidelines",
                 "active": True
             },
+
+             "v4": {
+                # v3 with the answer constrained to the scale
+                "text": """
+You are provided with an image and a list of guidlines {guidelines} to take a high-quality image to minimize distortions that might affect this image. 
+
+For each proposition in the list of guidlines, tell me if based on your understanding of the image, the guidlines are followed or violated. Rate how the actual image setup is aligned with the guidlines using the following scale:
+- 5: Excellent – The actual setup aligns very closely with the ideal.
+- 4: Good – The actual setup is mostly similar to the ideal, with only minor deviations.
+- 3: Fair – There are noticeable differences between the actual setup and the ideal.
+- 2: Bad – The actual setup diverges significantly from the ideal, impacting quality.
+- 1: Poor – The actual setup is far from ideal, resulting in major quality issues.""",
+                "extraction_method": "direct_output",
+                "constrained_output": {"choices": ["1", "2", "3", "4", "5"]},
+                "input_type": "guidelines",
+                "active": False
+            },
         }
     }
 }
@@ -241,6 +291,15 @@ def get_prompt_version(prompt_id, version):
         raise ValueError(f"Prompt {prompt_id} version {version} not found")
     return prompts[prompt_id]["versions"][version]
 
+def get_generation_options(prompt_config):
+    """Per-prompt decoding options: the score regex to stop on, the token budget
+    and the answer grammar."""
+    return {
+        key: prompt_config[key]
+        for key in ("regex_pattern", "max_new_tokens", "constrained_output")
+        if prompt_config.get(key) is not None
+    }
+
 def get_prompts_by_extraction_method(method):
     """Get all prompts using a specific extraction method."""
     method_prompts = {}
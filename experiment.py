@@ -1,19 +1,24 @@
+import argparse
 import os
-import pandas as pd
 import json
 import re
+import shutil
 from datetime import datetime
-from config.prompts import prompts, get_active_prompts
+from config.prompts import prompts, get_active_prompts, get_generation_options, get_prompt_version
 from config.datasets import datasets
 from config.models import models
-from models import load_model
-
-def load_images_folder(images_folder_path, sort=False):
-    """Load images from folder."""
-    images = [f for f in os.listdir(images_folder_path) if f.lower().endswith(('.png', '.jpg', '.jpeg'))]
-    if sort:
-        images.sort()
-    return images
+from config.experiment import experiment
+from models import MODEL_REGISTRY
+from utils.prefetch import Prefetcher
+from utils.response_cache import ResponseCache, image_content_hash
+from utils.journal import Journal, load_journal, latest_journal
+from utils.planner import (
+    generation_key_hash, group_prompts, plan_experiment, print_plan, shared_stage_dependencies, stage_order
+)
+from utils.sharding import shard_samples, parse_shard, launch_shards, merge_journals
+from utils.manifest import load_manifest, select_samples
+from utils.work_queue import IncompleteResult, WorkQueue, run_worker
+from utils.stage_store import StageStore
 
 def process_direct_output_with_regex(raw_prediction, regex_pattern):
     """Process outputs that need specific regex extraction."""
@@ -25,9 +30,34 @@ def process_direct_output_with_regex(raw_prediction, regex_pattern):
         return None
     return raw_prediction
 
+def assistant_reply(text):
+    """The assistant's reply in a decoded output.
+
+    LLaVA and IDEFICS decode the prompt along with the answer
+    ("USER: ... ASSISTANT: Score: 85"), so only the text after the last
+    assistant marker is kept. Outputs without a marker are the reply already.
+    """
+    return re.split(r"ASSISTANT:|Assistant:", text)[-1].strip()
+
+def process_constrained_output(raw_prediction, constrained_output):
+    """Process outputs generated under an answer grammar (prefix + one of the choices).
+
+    Returns None when the reply is not a valid answer of the grammar.
+    """
+    answer = assistant_reply(raw_prediction)
+    prefix = constrained_output.get("prefix", "").strip()
+    if prefix and answer.startswith(prefix):
+        answer = answer[len(prefix):].strip()
+    try:
+        return float(answer)
+    except ValueError:
+        # Categorical answer
+        return answer if answer in constrained_output["choices"] else None
+
 def process_softmax_based(embeddings, token_pairs):
     """Process softmax-based outputs."""
-    # Note: This is already handled in the model's process_output method
+    # Note: softmax-based prompts are scored directly by the model's
+    # score_prepared / score_batch from the prefill logits
     return embeddings
 
 def process_ccot_direct_guided(raw_prediction):
@@ -46,167 +76,704 @@ def process_ccot_direct_guided(raw_prediction):
 
 def process_scene_graph_prompt_output(scene_graph):
     """Extracts the JSON scene graph from the provided text."""
+    return assistant_reply(scene_graph)
     
-    # Split the text to find the JSON part after "ASSISTANT: "
-    parts = scene_graph.split("ASSISTANT: ")
-    # if len(parts) < 2:
-    #     return None  # No JSON found
+
+# How the output of a chain stage is cleaned up before it fills the next
+# stage's `{<input_type>}` placeholder; other types keep the assistant reply
+STAGE_OUTPUT_PARSERS = {
+    "scene_graph": process_scene_graph_prompt_output,
+    "guidelines": assistant_reply,
+}
+
+def format_stage_prompt(prompt_config, stage_output):
+    """Fill the output of the previous chain stage into a chained prompt."""
+    input_type = prompt_config["input_type"]
+    parse = STAGE_OUTPUT_PARSERS.get(input_type, assistant_reply)
+    return prompt_config["text"].format(**{input_type: parse(stage_output)})
+
+def extract_score(prompt_config, raw_prediction):
+    """Turn a raw model prediction into a score based on the extraction method."""
+    if prompt_config["extraction_method"] == "direct_output":
+        if "constrained_output" in prompt_config:
+            score = process_constrained_output(raw_prediction, prompt_config["constrained_output"])
+            # An answer outside the grammar may still carry a score the regex finds
+            if score is not None or "regex_pattern" not in prompt_config:
+                return score
+        if "regex_pattern" in prompt_config:
+            return process_direct_output_with_regex(
+                raw_prediction, 
+                prompt_config["regex_pattern"]
+            )
+        return raw_prediction
     
-    json_str = parts[-1].strip()  # Take the last part and remove whitespace
-    return json_str
+    elif prompt_config["extraction_method"] == "ccot_direct_guided":
+        return process_ccot_direct_guided(raw_prediction)
+
+    elif prompt_config["extraction_method"] == "ccot_direct_guided_1":
+        # Intermediate chain stage: its output feeds the next stage, no score
+        return -1
+
+    elif prompt_config["extraction_method"] == "ccot_direct_guided_2":
+        # score = process_ccot_direct_guided(raw_prediction)
+        return raw_prediction
     
+    print(f"Unknown extraction method: {prompt_config['extraction_method']}")
+    return None
+
+def lookup_cached_responses(model_instance, response_cache, prompts, images, options=None):
+    """Look up a batch in the response cache.
+
+    `options` are the per-prompt decoding options of each sample and
+    `decode_size` the resolution images are decoded at; they change the
+    generation, so they are part of its key. Returns the cache entries
+    (None for samples that cannot be cached), the cached responses (None on a
+    miss) and the indices that still need to be generated.
+    """
+    options = options or [{}] * len(prompts)
+    entries, responses = [], []
+    for prompt, image, option in zip(prompts, images, options):
+        image_hash = None
+        if response_cache is not None:
+            # Paths of manifest images come with their hash; other files are read and hashed
+            known = model_instance.content_hashes.get(image) if isinstance(image, str) else None
+            image_hash = known or image_content_hash(image)
+        if image_hash is None:
+            entries.append(None)
+            responses.append(None)
+            continue
+        settings = dict(model_instance.generation_kwargs, **option)
+        if model_instance.decode_size:
+            # Images decoded at another resolution can get another response
+            settings["decode_size"] = model_instance.decode_size
+        key = ResponseCache.make_key(model_instance.model_path, prompt, image_hash, settings)
+        entries.append((key, prompt, image_hash, settings))
+        responses.append(response_cache.get(key))
+    missing = [i for i, response in enumerate(responses) if response is None]
+    return entries, responses, missing
+
+def merge_generated(model_instance, response_cache, entries, responses, missing, generated):
+    """Fill freshly generated samples into a partially cached batch and store them."""
+    new_responses, new_embeddings = generated
+    embeddings = [None] * len(responses)
+    for i, response, embeds in zip(missing, new_responses, new_embeddings):
+        responses[i] = response
+        embeddings[i] = embeds
+        if entries[i] is not None and isinstance(response, str):
+            key, prompt, image_hash, settings = entries[i]
+            response_cache.put(key, model_instance.model_path, prompt, image_hash, settings, response)
+    return responses, embeddings
+
+def make_batches(samples, batch_size):
+    """Split the list of samples into consecutive batches of at most batch_size."""
+    return [samples[i:i + batch_size] for i in range(0, len(samples), batch_size)]
 
-def process_ccot_prompt(followup_prompt, scene_graph, model_instance, image_path):
-    """Process prompts that work in a chain."""
+def run_prompt_major(model_instance, active_prompts, dataset_path, samples, response_cache=None,
+                     completed=None, record=None, dependencies=None, stage_outputs=None, screening=None):
+    """Run every prompt over the dataset in batches of images (prompt -> image).
 
-    sg = process_scene_graph_prompt_output(scene_graph)
+    `completed` holds {prompt_name: {image_id: (score, raw_output)}} from a
+    previous run's journal; those samples are skipped. `record(prompt_name,
+    image_id, score, raw_output)` is called for every newly scored sample.
 
-    # print(f"Scene graph only: {scene_graph}")
+    Chained prompts run as stages: `dependencies` maps a prompt to the prompt
+    whose output fills it, and `stage_outputs` holds {producer: {image_id:
+    output}} (e.g. read back from the stage store). Each stage runs batched
+    over the whole dataset after its producer, and adds its own outputs to
+    `stage_outputs` when a later stage consumes them.
+
+    With `screening` (a `utils.adaptive.AdaptiveScreening` fed by `record`)
+    a prompt stops after the batch where it is settled, see utils/adaptive.py.
+    """
+    dataset_results = {}
+    completed = completed or {}
+    dependencies = dependencies or {}
+    stage_outputs = stage_outputs if stage_outputs is not None else {}
+    sample_set = set(samples)
+
+    batch_size = experiment["batch_size"]
+    print(f"Batch size: {batch_size}")
     
-    followup_prompt = followup_prompt.format(scene_graph=sg)
+    for prompt_name in stage_order(active_prompts, dependencies):
+        prompt_config = active_prompts[prompt_name]
+        print(f"Applying prompt: {prompt_name}")
+        done = {image_id: entry for image_id, entry in completed.get(prompt_name, {}).items() if image_id in sample_set}
+        predictions = {image_id: score for image_id, (score, _) in done.items()}
+        if prompt_name in stage_outputs:
+            stage_outputs[prompt_name].update({image_id: raw_output for image_id, (_, raw_output) in done.items()})
+        processed = len(done)
+        if done:
+            print(f"Resuming: {len(done)}/{len(samples)} samples already in the journal")
+
+        todo = [image_id for image_id in samples if image_id not in done]
+        if screening is not None and screening.is_done(prompt_name):
+            print(f"Screening: {prompt_name} already settled by the journal")
+            todo = []
+        producer = dependencies.get(prompt_name)
+        if producer is not None:
+            inputs = stage_outputs.get(producer, {})
+            unavailable = [image_id for image_id in todo if inputs.get(image_id) is None]
+            if unavailable:
+                print(f"No {producer} output for {len(unavailable)} samples, skipping them")
+                predictions.update({image_id: None for image_id in unavailable})
+                todo = [image_id for image_id in todo if inputs.get(image_id) is not None]
+        batches = make_batches(todo, batch_size)
+
+        # Softmax-based prompts are scored from one prefill pass, without decoding
+        softmax_based = prompt_config["extraction_method"] == "softmax_based"
+        option = get_generation_options(prompt_config)
+
+        def prepare(batch):
+            if producer is not None:
+                prompts = [format_stage_prompt(prompt_config, stage_outputs[producer][image_id]) for image_id in batch]
+            else:
+                prompts = [prompt_config["text"]] * len(batch)
+            image_paths = [os.path.join(dataset_path, image_id) for image_id in batch]
 
-    # print(f"Followup prompt: {followup_prompt}")
+            if softmax_based:
+                return None, None, None, model_instance.prepare_batch(prompts, image_paths)
+
+            # Only samples missing from the response cache are preprocessed
+            options = [option] * len(batch)
+            entries, responses, missing = lookup_cached_responses(
+                model_instance, response_cache, prompts, image_paths, options
+            )
+            prepared = None
+            if missing:
+                prepared = model_instance.prepare_batch(
+                    [prompts[i] for i in missing], [image_paths[i] for i in missing], [options[i] for i in missing]
+                )
+            return entries, responses, missing, prepared
+
+        # Decode and preprocess the next batches while the current one generates
+        prefetcher = Prefetcher(
+            batches,
+            prepare,
+            depth=experiment["prefetch_depth"],
+            num_workers=experiment["prefetch_workers"],
+        )
         
-    # Get model prediction
-    raw_prediction, embeddings = model_instance.generate(followup_prompt, image_path)
+        try:
+            for batch, prepared_batch, error in prefetcher:
+                print(f"Processing images: {batch[0]} ... {batch[-1]}")
+                try:
+                    if error is not None:
+                        raise error
 
-    # score = process_ccot_direct_guided(raw_prediction)
-    score = raw_prediction
-    return score
+                    entries, raw_predictions, missing, prepared = prepared_batch
+                    if softmax_based:
+                        raw_predictions = [None] * len(batch)
+                        scores = model_instance.score_prepared(prepared, prompt_config["token_pairs"])
+                    else:
+                        generated = model_instance.generate_prepared(prepared) if missing else ([], [])
+                        raw_predictions, embeddings = merge_generated(
+                            model_instance, response_cache, entries, raw_predictions, missing, generated
+                        )
+                        # Process the outputs based on extraction method
+                        scores = [
+                            extract_score(prompt_config, raw_prediction)
+                            for raw_prediction in raw_predictions
+                        ]
 
-def save_results_to_csv(results, model_name, timestamp):
-    """Save results to CSV file for a specific model."""
-    results_dir = "results"
-    os.makedirs(results_dir, exist_ok=True)
-    
-    # Prepare data for DataFrame
-    rows = []
-    model_data = results[model_name]
-    
-    for dataset, dataset_data in model_data.items():
-        for prompt, predictions in dataset_data.items():
-            for image_id, score in predictions.items():
-                row = {
-                    'model_name': models[model_name]['model_name'],  # Use actual model name
-                    'dataset': dataset,
-                    'prompt': prompt,
-                    'image_id': image_id,
-                    'predicted_score': score
-                }
-                rows.append(row)
-    
-    # Create the filename with experiment number
-    filename = f"{models[model_name]['model_name']}_results_{timestamp}.csv"
-    csv_path = os.path.join(results_dir, filename)
-
-    # Create DataFrame and save to CSV
-    df = pd.DataFrame(rows)
-    df.to_csv(csv_path, index=False)
-    print(f"Results saved to {csv_path}")
-    
-    return df
+                    if prompt_name in stage_outputs:
+                        stage_outputs[prompt_name].update(zip(batch, raw_predictions))
+                    predictions.update(zip(batch, scores))
+                    if record is not None:
+                        for image_id, score, raw_prediction in zip(batch, scores, raw_predictions):
+                            record(prompt_name, image_id, score, raw_prediction)
+                        
+                except Exception as e:
+                    print(f"Error processing batch {batch[0]} ... {batch[-1]}: {str(e)}")
+                    for image_id in batch:
+                        predictions[image_id] = None
+
+                processed += len(batch)
+                print(f"Processed {processed}/{len(samples)} samples")
+
+                if screening is not None:
+                    screening.update()
+                    if screening.is_done(prompt_name):
+                        print(f"Screening: stopping {prompt_name} after {processed}/{len(samples)} samples")
+                        break
+            
+            dataset_results[prompt_name] = predictions
+                
+        except Exception as e:
+            print(f"Error processing prompt {prompt_name}: {str(e)}")
+            dataset_results[prompt_name] = {"error": str(e)}
+
+    return dataset_results
+
+def run_image_major(model_instance, active_prompts, dataset_path, samples, response_cache=None,
+                    completed=None, record=None, dependencies=None, stage_outputs=None, screening=None):
+    """Run all active prompts on one image before moving on (image -> prompt).
+
+    Each image is decoded once and handed to `generate_prompts`, so the
+    adapter can share the pixel tensor and vision-encoder output across
+    prompts. Chained prompts run in later rounds on the same decoded image,
+    once the output of the stage they depend on is known. `completed`,
+    `record`, `dependencies`, `stage_outputs` and `screening` work as in
+    `run_prompt_major`; a settled prompt is left out of the following images.
+    """
+    completed = completed or {}
+    dependencies = dependencies or {}
+    stage_outputs = stage_outputs if stage_outputs is not None else {}
+    order = stage_order(active_prompts, dependencies)
+    dataset_results = {prompt_name: {} for prompt_name in active_prompts}
+
+    # Fill in what the journal already has and only visit images with work left
+    pending = {}
+    for image_id in samples:
+        for prompt_name in order:
+            if image_id in completed.get(prompt_name, {}):
+                score, raw_output = completed[prompt_name][image_id]
+                dataset_results[prompt_name][image_id] = score
+                if prompt_name in stage_outputs:
+                    stage_outputs[prompt_name][image_id] = raw_output
+            else:
+                pending.setdefault(image_id, []).append(prompt_name)
+    todo = [image_id for image_id in samples if image_id in pending]
+    if len(todo) < len(samples):
+        print(f"Resuming: {len(samples) - len(todo)}/{len(samples)} samples already in the journal")
+
+    # Decode the next images while the current one generates
+    prefetcher = Prefetcher(
+        todo,
+        lambda image_id: model_instance.load_image(os.path.join(dataset_path, image_id)),
+        depth=experiment["prefetch_depth"],
+        num_workers=experiment["prefetch_workers"],
+    )
+
+    for i, (image_id, image, error) in enumerate(prefetcher):
+        print(f"Processing image: {image_id}")
+        running = [name for name in pending[image_id] if screening is None or not screening.is_done(name)]
+        try:
+            if error is not None:
+                raise error
+
+            # Each round runs the prompts whose producing stage is done for this image
+            remaining = list(running)
+            while remaining:
+                ready = [name for name in remaining if dependencies.get(name) not in remaining]
+                remaining = [name for name in remaining if name not in ready]
+
+                generate_stage = []
+                for prompt_name in ready:
+                    producer = dependencies.get(prompt_name)
+                    if producer is not None and stage_outputs.get(producer, {}).get(image_id) is None:
+                        print(f"No {producer} output for {image_id}, skipping {prompt_name}")
+                        dataset_results[prompt_name][image_id] = None
+                    elif active_prompts[prompt_name]["extraction_method"] == "softmax_based":
+                        # One prefill pass per softmax-based prompt, no decoding
+                        prompt_config = active_prompts[prompt_name]
+                        score = model_instance.score_batch([prompt_config["text"]], [image], prompt_config["token_pairs"])[0]
+                        dataset_results[prompt_name][image_id] = score
+                        if record is not None:
+                            record(prompt_name, image_id, score, None)
+                    else:
+                        generate_stage.append(prompt_name)
+
+                if not generate_stage:
+                    continue
 
-def run_experiment():
-    """Main function to run the experiment."""
-    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+                prompts = [
+                    format_stage_prompt(active_prompts[name], stage_outputs[dependencies[name]][image_id])
+                    if name in dependencies else active_prompts[name]["text"]
+                    for name in generate_stage
+                ]
+                options = [get_generation_options(active_prompts[name]) for name in generate_stage]
+                entries, raw_predictions, missing = lookup_cached_responses(
+                    model_instance, response_cache, prompts, [image] * len(prompts), options
+                )
+                generated = model_instance.generate_prompts(
+                    [prompts[i] for i in missing], image, [options[i] for i in missing]
+                ) if missing else ([], [])
+                raw_predictions, embeddings = merge_generated(
+                    model_instance, response_cache, entries, raw_predictions, missing, generated
+                )
+
+                for prompt_name, raw_prediction in zip(generate_stage, raw_predictions):
+                    score = extract_score(active_prompts[prompt_name], raw_prediction)
+                    if prompt_name in stage_outputs:
+                        stage_outputs[prompt_name][image_id] = raw_prediction
+                    dataset_results[prompt_name][image_id] = score
+                    if record is not None:
+                        record(prompt_name, image_id, score, raw_prediction)
+
+        except Exception as e:
+            print(f"Error processing sample {image_id}: {str(e)}")
+            for prompt_name in running:
+                dataset_results[prompt_name].setdefault(image_id, None)
+
+        if (i + 1) % 10 == 0:
+            print(f"Processed {i + 1}/{len(todo)} samples")
+
+        if screening is not None:
+            screening.update()
+            if all(screening.is_done(name) for name in order):
+                print(f"Screening: every prompt settled after {i + 1}/{len(todo)} samples")
+                break
+
+    return dataset_results
+
+def run_experiment(resume=None, shard=None, run_id=None, model_keys=None, dataset_names=None, dry_run=False):
+    """Main function to run the experiment.
+
+    Every scored sample is appended to results/journal_<timestamp>.jsonl as
+    soon as it is produced and streamed into one Parquet file per model
+    (results/<model_name>_results_<timestamp>.parquet). Passing a journal path
+    as `resume` continues that run: completed cells are read back and
+    skipped, and the run keeps the original timestamp. Outputs of chain
+    stages (scene graphs, guideline lists) are also kept in results/stages,
+    so a later stage can run on its own from a previous run's outputs.
+
+    `shard=(index, count)` restricts every dataset to one shard of its images
+    (see `utils.sharding`); `run_id` replaces the timestamp in the file names.
+    `model_keys` and `dataset_names` restrict the run to part of the configs,
+    e.g. for one task of a work queue (see `utils.work_queue`). With
+    `dry_run` only the plan is printed; nothing is loaded or written.
+    """
+    completed = {}
+    if resume:
+        print(f"Resuming from journal: {resume}")
+        completed = load_journal(resume)
+        timestamp = os.path.basename(resume)[len("journal_"):-len(".jsonl")]
+    else:
+        timestamp = run_id or datetime.now().strftime('%Y%m%d_%H%M%S')
     print(f"Starting experiment")
     results = {}
     
     # Get active prompts
     active_prompts = get_active_prompts()
     print(f"Active prompts: {list(active_prompts.keys())}")
+
+    # Versions needing identical generation work run once, under the first
+    # version's name; the others get the same raw output with their own extraction
+    prompt_groups = group_prompts(active_prompts)
+    unique_prompts = {prompt_name: active_prompts[prompt_name] for prompt_name in prompt_groups}
+
+    # Chained stages read their producer's outputs, persisted in the stage store
+    dependencies = shared_stage_dependencies(active_prompts, prompt_groups)
+    stage_store = StageStore(os.path.join("results", "stages"))
+
+    run_models = {key: config for key, config in models.items() if model_keys is None or key in model_keys}
+    run_datasets = {name: config for name, config in datasets.items() if dataset_names is None or name in dataset_names}
+
+    # Select every dataset's sample up front so the plan can be printed before any model loads
+    dataset_samples = {}
+    for dataset_name, dataset_config in run_datasets.items():
+        try:
+            dataset_samples[dataset_name] = select_samples(dataset_name, dataset_config)
+            if shard is not None:
+                dataset_samples[dataset_name] = shard_samples(dataset_samples[dataset_name], *shard)
+        except OSError as e:
+            print(f"Cannot list dataset {dataset_name}: {str(e)}")
+    plan = plan_experiment(
+        run_models, run_datasets, active_prompts,
+        {dataset_name: len(samples) for dataset_name, samples in dataset_samples.items()},
+    )
+    print_plan(plan, experiment["batch_size"], experiment["execution_order"])
+    adaptive = experiment["adaptive"]
+    if adaptive["enabled"]:
+        print(f"Adaptive screening: cells stop once their CI is narrower than {adaptive['tolerance']} "
+              f"or a better prompt dominates them; the counts above are upper bounds")
+    if dry_run:
+        return results
+
+    # Imported here so listing and planning never pay for torch and the model stack
+    from models import ModelLifecycle
+    from models.server import connect as connect_model_server
+    from utils.adaptive import AdaptiveScreening, screening_order
+    from utils.evaluation import load_mos
+    from utils.results_writer import ParquetResultsWriter
+    from utils.tensor_cache import TensorCache
+
+    journal = Journal(os.path.join("results", f"journal_{timestamp}.jsonl"))
+
+    # Warm models from a running model server, if there is one
+    model_server = connect_model_server(experiment["model_server_socket"])
+    if model_server is not None:
+        print(f"Using the model server at {experiment['model_server_socket']}")
     
-    for model, model_config in models.items():
+    for model, model_config in run_models.items():
         print(f"Processing model: {model} ({model_config['model_name']})")
         results[model] = {}
+
+        results_path = os.path.join("results", f"{model_config['model_name']}_results_{timestamp}.parquet")
+        writer = ParquetResultsWriter(results_path, experiment["results_row_group_size"])
         
-        # Initialize model
-        model_instance = load_model(model_config)
+        # Load the model; it is torn down and its memory released when the block
+        # exits (models from the model server stay loaded there)
+        lifecycle = model_server.model(model_config) if model_server is not None else ModelLifecycle(model_config)
+        with lifecycle as model_instance:
+            response_cache = None
+            if experiment["response_cache_path"]:
+                response_cache = ResponseCache(experiment["response_cache_path"], experiment["response_cache_max_mb"] * 1024 ** 2)
+
+            if experiment["tensor_cache_dir"]:
+                tensor_cache = TensorCache(experiment["tensor_cache_dir"], experiment["tensor_cache_max_gb"] * 1024 ** 3)
+                model_instance.use_tensor_cache(tensor_cache)
         
-        for dataset_name, dataset_config in datasets.items():
-            print(f"Processing dataset: {dataset_name}")
-            results[model][dataset_name] = {}
+            for dataset_name, dataset_config in run_datasets.items():
+                print(f"Processing dataset: {dataset_name}")
+                results[model][dataset_name] = {}
             
-            try:
-                # Load dataset samples
-                dataset_path = dataset_config["path"]
-                print(f"Dataset path: {dataset_path}")
-                
-                sample_size = dataset_config["sample_size"]
-                print(f"Sample size: {sample_size}")
-                
-                # TODO: Better Dataset loading (batching using Dataloader ig)
+                try:
+                    # Load dataset samples
+                    dataset_path = dataset_config["path"]
+                    print(f"Dataset path: {dataset_path}")
                 
-                samples = load_images_folder(dataset_path, sort=True)
-                print(f"Loaded {len(samples)} samples from {dataset_name}")
+                    sample_size = dataset_config["sample_size"]
+                    print(f"Sample size: {sample_size}")
                 
-                for prompt_name, prompt_config in active_prompts.items():
-                    print(f"Applying prompt: {prompt_name}")
-                    predictions = {}
-                    
-                    try:
-                        for i, image_id in enumerate(samples):
-                            print(f"Processing image: {image_id}")
-                            try:
-                                image_path = os.path.join(dataset_path, image_id)
-                                
-                                
-                                if prompt_name == "prompt3_v1":
-                                    scene_graph, embeddings = model_instance.generate(prompt_config["text"], image_path)
-                                    # print(scene_graph)
-                                    score = -1
-                                elif prompt_name == "prompt3_v2":
-                                    score = process_ccot_prompt(prompt_config["text"], scene_graph, model_instance, image_path)
-                                
-                                else:
-                                    # Regular prompt processing
-                                    raw_prediction, embeddings = model_instance.generate(prompt_config["text"], image_path)
-                                    
-                                    # Process the output based on extraction method
-                                    if prompt_config["extraction_method"] == "direct_output":
-                                        if "regex_pattern" in prompt_config:
-                                            score = process_direct_output_with_regex(
-                                                raw_prediction, 
-                                                prompt_config["regex_pattern"]
-                                            )
-                                        else:
-                                            score = raw_prediction
-                                    
-                                    elif prompt_config["extraction_method"] == "softmax_based":
-                                        score = model_instance.process_output(embeddings)
-                                        score = -1
-                                    
-                                    elif prompt_config["extraction_method"] == "ccot_direct_guided":
-                                        score = process_ccot_direct_guided(raw_prediction)
-                                    
-                                    else:
-                                        print(f"Unknown extraction method: {prompt_config['extraction_method']}")
-                                        score = None
-
-                                predictions[image_id] = score
-                                
-                                if (i + 1) % 10 == 0:
-                                    print(f"Processed {i + 1}/{len(samples)} samples")
-                                    
-                            except Exception as e:
-                                print(f"Error processing sample {image_id}: {str(e)}")
-                                predictions[image_id] = None
-                        
-                        results[model][dataset_name][prompt_name] = predictions
-                            
-                    except Exception as e:
-                        print(f"Error processing prompt {prompt_name}: {str(e)}")
-                        results[model][dataset_name][prompt_name] = {"error": str(e)}
+                    samples = dataset_samples.get(dataset_name)
+                    if samples is None:
+                        samples = select_samples(dataset_name, dataset_config)
+                        if shard is not None:
+                            samples = shard_samples(samples, *shard)
+                    print(f"Loaded {len(samples)} samples from {dataset_name}")
+
+                    # The manifest already hashed every image, so the caches need not read them again
+                    manifest = load_manifest(dataset_name, dataset_config)
+                    model_instance.use_content_hashes({
+                        os.path.join(dataset_path, image_id): manifest.hash_of(image_id) for image_id in samples
+                    })
+
+                    # Cells of this (model, dataset) already in the journal
+                    dataset_completed = {
+                        prompt_name: completed.get((model, dataset_name, prompt_name), {})
+                        for prompt_name in active_prompts
+                    }
+
+                    # Rows recovered from the journal go to the rewritten results file as well
+                    for prompt_name, done in dataset_completed.items():
+                        for image_id, (score, raw_output) in done.items():
+                            writer.write(model_config["model_name"], dataset_name, prompt_name, image_id, score, raw_output)
+
+                    # A shared task only counts as done for images every consumer has
+                    run_completed = {
+                        prompt_name: {
+                            image_id: entry for image_id, entry in dataset_completed[prompt_name].items()
+                            if all(image_id in dataset_completed[consumer] for consumer in consumers)
+                        }
+                        for prompt_name, consumers in prompt_groups.items()
+                    }
+                    shared_results = {}
+                    # Producers running in this run start empty (resumed outputs come back from
+                    # the journal), so a failed image is skipped rather than fed a stale output;
+                    # inactive producers are read from the store under their current generation key
+                    stage_outputs = {
+                        producer: {} if producer in unique_prompts else stage_store.load(
+                            model, dataset_name, producer,
+                            generation_key_hash(get_prompt_version(*producer.rsplit("_", 1))),
+                        )
+                        for producer in set(dependencies.values())
+                    }
+
+                    # Adaptive screening scores the images in random order and stops settled cells
+                    screening = None
+                    if adaptive["enabled"] and dataset_config.get("mos_path"):
+                        screening = AdaptiveScreening(
+                            load_mos(dataset_config["mos_path"]), active_prompts, prompt_groups, dependencies,
+                            tolerance=adaptive["tolerance"], confidence=adaptive["confidence"],
+                            min_samples=adaptive["min_samples"],
+                        )
+                        samples = screening_order(samples, dataset_config.get("sample_seed", 0))
+                        for prompt_name, done in dataset_completed.items():
+                            for image_id, (score, _) in done.items():
+                                screening.add(prompt_name, image_id, score)
+                        screening.update()
+                    elif adaptive["enabled"]:
+                        print(f"No mos_path for {dataset_name}, screening disabled: scoring every sample")
+
+                    def record(prompt_name, image_id, score, raw_output):
+                        # Fan the output of a shared task out to every consumer version
+                        for consumer in prompt_groups.get(prompt_name, [prompt_name]):
+                            if image_id in dataset_completed.get(consumer, {}):
+                                continue
+                            consumer_score = score
+                            if consumer != prompt_name:
+                                # Scored groups (softmax) have no raw output to re-parse
+                                if raw_output is not None:
+                                    consumer_score = extract_score(active_prompts[consumer], raw_output)
+                                shared_results.setdefault(consumer, {})[image_id] = consumer_score
+                            if screening is not None:
+                                screening.add(consumer, image_id, consumer_score)
+                            journal.record(model, dataset_name, consumer, image_id, consumer_score, raw_output)
+                            writer.write(model_config["model_name"], dataset_name, consumer, image_id, consumer_score, raw_output)
+                            if active_prompts[consumer].get("output_type", "score") != "score" and raw_output is not None:
+                                stage_store.append(
+                                    model, dataset_name, consumer, generation_key_hash(active_prompts[consumer]),
+                                    image_id, raw_output
+                                )
+
+                    if experiment["execution_order"] == "image_major":
+                        dataset_results = run_image_major(
+                            model_instance, unique_prompts, dataset_path, samples, response_cache, run_completed, record,
+                            dependencies, stage_outputs, screening
+                        )
+                    else:
+                        dataset_results = run_prompt_major(
+                            model_instance, unique_prompts, dataset_path, samples, response_cache, run_completed, record,
+                            dependencies, stage_outputs, screening
+                        )
+                    for prompt_name, consumers in prompt_groups.items():
+                        for consumer in consumers[1:]:
+                            consumer_results = {
+                                image_id: score for image_id, (score, _) in dataset_completed[consumer].items()
+                            }
+                            consumer_results.update(shared_results.get(consumer, {}))
+                            dataset_results[consumer] = consumer_results
+                    results[model][dataset_name] = dataset_results
+                    if screening is not None:
+                        print(f"Screening of {model} on {dataset_name}:")
+                        screening.summary()
                         
-            except Exception as e:
-                print(f"Error processing dataset {dataset_name}: {str(e)}")
-                results[model][dataset_name] = {"error": str(e)}
+                except Exception as e:
+                    print(f"Error processing dataset {dataset_name}: {str(e)}")
+                    results[model][dataset_name] = {"error": str(e)}
+        
+            if response_cache is not None:
+                stats = response_cache.stats()
+                print(f"Response cache: {stats['hits']} hits, {stats['misses']} misses "
+                      f"({stats['hit_rate']:.0%}), {stats['entries']} entries")
+                response_cache.close()
+
+            if experiment["tensor_cache_dir"]:
+                print(f"Tensor cache: {tensor_cache.hits} hits, {tensor_cache.misses} misses, "
+                      f"{tensor_cache.total_bytes / 1024 ** 2:.1f} MB on disk")
         
-        # Save results for this model
-        df = save_results_to_csv(results, model, timestamp)
+            # Flush the last row group of this model
+            writer.close()
+            print(f"Results saved to {results_path} ({writer.rows_written} rows)")
     
+    journal.close()
+    if model_server is not None:
+        model_server.close()
     print("Experiment completed")
     return results
 
+def queue_task_id(model, dataset_name, shard_index, num_shards):
+    return f"{model}__{dataset_name}__shard{shard_index}of{num_shards}"
+
+def journal_gaps(journal_path, model, dataset_name, samples, prompt_names, required=None):
+    """{prompt_name: missing} for every prompt the journal scored on fewer than
+    `required` (default: all) of `samples` for the (model, dataset)."""
+    completed = load_journal(journal_path) if os.path.exists(journal_path) else {}
+    required = len(samples) if required is None else required
+    gaps = {}
+    for prompt_name in prompt_names:
+        scored = completed.get((model, dataset_name, prompt_name), {})
+        covered = sum(1 for image_id in samples if image_id in scored)
+        if covered < required:
+            gaps[prompt_name] = required - covered
+    return gaps
+
+def run_queue_worker(queue_dir, num_shards=1):
+    """Work on a shared queue of (model, dataset, shard) tasks until it is drained.
+
+    Every worker adds the tasks of the current configs (existing ones are
+    kept), so any of them can start the queue. Each task runs as a separate
+    `run_experiment` call whose journal is committed to the queue once it
+    covers every sample of the shard for every active prompt. An incomplete
+    journal is resumed by the task's next attempt, and committed with its
+    gaps recorded after the last one.
+    """
+    queue = WorkQueue(queue_dir)
+    for model in models:
+        for dataset_name in datasets:
+            for i in range(num_shards):
+                queue.add_task(
+                    queue_task_id(model, dataset_name, i, num_shards),
+                    {"model": model, "dataset": dataset_name, "shard": [i, num_shards]},
+                )
+
+    def run_task(task_id, spec, attempt_id, previous):
+        shard = tuple(spec["shard"]) if spec["shard"][1] > 1 else None
+        journal_path = os.path.join("results", f"journal_{attempt_id}.jsonl")
+        resume = None
+        if previous is not None:
+            # Continue the previous attempt's journal under this attempt's name
+            os.makedirs("results", exist_ok=True)
+            shutil.copyfile(previous, journal_path)
+            with open(journal_path, "rb+") as f:
+                f.seek(0, os.SEEK_END)
+                if f.tell():
+                    f.seek(-1, os.SEEK_END)
+                    if f.read(1) != b"\n":
+                        # Keep a torn last line from swallowing the first new record
+                        f.write(b"\n")
+            resume = journal_path
+        run_experiment(resume=resume, shard=shard, run_id=attempt_id,
+                       model_keys=[spec["model"]], dataset_names=[spec["dataset"]])
+
+        # run_experiment reports failed datasets and batches without raising;
+        # an incomplete journal goes back to the queue instead of being committed
+        dataset_config = datasets[spec["dataset"]]
+        samples = select_samples(spec["dataset"], dataset_config)
+        if shard is not None:
+            samples = shard_samples(samples, *shard)
+        required = None
+        if experiment["adaptive"]["enabled"] and dataset_config.get("mos_path"):
+            # Screened cells may stop once they have their minimum sample
+            required = min(len(samples), experiment["adaptive"]["min_samples"])
+        gaps = journal_gaps(journal_path, spec["model"], spec["dataset"], samples, get_active_prompts(), required)
+        if gaps:
+            raise IncompleteResult(journal_path, gaps)
+        return journal_path
+
+    return run_worker(queue, run_task)
+
 if __name__ == "__main__":
-    results = run_experiment()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Run the NR-IQA experiment.")
+    parser.add_argument("--resume", nargs="?", const="latest", default=None,
+                        help="resume from a journal file (default: the latest one in results/)")
+    parser.add_argument("--shards", type=int, default=None,
+                        help="split the images into N shards run by parallel worker processes")
+    parser.add_argument("--devices", default="cpu",
+                        help="'cpu' or comma-separated GPU ids the shard workers are spread over")
+    parser.add_argument("--timestamp", default=None,
+                        help="with --shards: timestamp of an earlier sharded run to resume")
+    parser.add_argument("--queue", default=None,
+                        help="work on a shared queue directory of (model, dataset, shard) tasks")
+    parser.add_argument("--queue-shards", type=int, default=1,
+                        help="with --queue: shards per (model, dataset) when the tasks are created")
+    parser.add_argument("--merge", action="store_true",
+                        help="with --queue: merge the committed results into results/")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="print the plan of the run without loading any model")
+    parser.add_argument("--list-models", action="store_true",
+                        help="list the configured and the available models")
+    parser.add_argument("--shard", type=parse_shard, default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--run-id", default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.list_models:
+        for model, model_config in models.items():
+            print(f"{model}: {model_config['model_name']} ({model_config['model_path']})")
+        print(f"Available: {', '.join(MODEL_REGISTRY)}")
+        raise SystemExit(0)
+
+    if args.queue:
+        if args.merge:
+            queue_name = os.path.basename(os.path.normpath(args.queue))
+            queue = WorkQueue(args.queue)
+            for task_id, gaps in queue.gaps().items():
+                print(f"{task_id} was committed with missing samples per prompt: {gaps}")
+            merge_journals(queue.results(), queue_name)
+        else:
+            run_queue_worker(args.queue, args.queue_shards)
+        raise SystemExit(0)
+
+    if args.shards:
+        devices = "cpu" if args.devices == "cpu" else args.devices.split(",")
+        exit_codes = launch_shards(args.shards, devices, args.timestamp)
+        raise SystemExit(max(exit_codes))
+
+    resume = args.resume
+    if resume == "latest":
+        resume = latest_journal()
+        if resume is None:
+            parser.error("no journal found in results/ to resume from")
+
+    results = run_experiment(resume=resume, shard=args.shard, run_id=args.run_id, dry_run=args.dry_run)
\ No newline at end of file
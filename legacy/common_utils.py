@@ -6,45 +6,48 @@
 
 import pyiqa
 import os
+from functools import lru_cache
 from scipy.stats import pearsonr
 from scipy import stats
 
+# Factor bringing each metric's scores to the 0-100 range
+# Comment out metrics you don't want to use
+IQA_METRIC_SCALES = {
+    'musiq': 1,
+    'arniqa-kadid': 100,
+    'topiq_nr': 100,
+    'tres': 1,
+    'clipiqa': 100,
+    'maniqa': 100,
+    'dbcnn': 100,
+    'paq2piq': 1,
+    'hyperiqa': 100,
+    'cnniqa': 100,
+    'liqe': 1,
+    # 'liqe_mix': 1,
+    # 'brisque': 1,
+    # 'niqe': 1,
+    # 'nima': 1,
+}
+
+# Metric instances created by init_iqa_metrics(), by name
+iqa_metrics = {}
+
 # Needs pyiqa library
 # Is called before get_iqa_scores() to init functions
-def init_iqa_metrics():
-    musiq_metric = pyiqa.create_metric('musiq')
-    arniqa_kadid_metric = pyiqa.create_metric('arniqa-kadid')
-    topiq_nr_metric = pyiqa.create_metric('topiq_nr')
-    tres_metric = pyiqa.create_metric('tres')
-    clipiqa_metric = pyiqa.create_metric('clipiqa')
-    maniqa_metric = pyiqa.create_metric('maniqa')
-    dbcnn_metric = pyiqa.create_metric('dbcnn')
-    paq2piq_metric = pyiqa.create_metric('paq2piq')
-    hyperiqa_metric = pyiqa.create_metric('hyperiqa')
-    cnniqa_metric = pyiqa.create_metric('cnniqa')
-    liqe_metric = pyiqa.create_metric('liqe')
+# Metrics already created are kept, so calling it again is cheap
+def init_iqa_metrics(metric_names=None, device=None):
+    for name in metric_names or IQA_METRIC_SCALES:
+        if name not in iqa_metrics:
+            iqa_metrics[name] = pyiqa.create_metric(name, device=device)
+    return iqa_metrics
 
 # needs pyiqa library
 # Returns IQA score in dict format.
 # All scores between range between 0 and 100
-# Comment out metrics you don't want to use
 def get_iqa_scores(image_path):
-  return {'musiq': musiq_metric(image_path).cpu().item(),
-          'arniqa-kadid': arniqa_kadid_metric(image_path).cpu().item() * 100,
-          'topiq_nr': topiq_nr_metric(image_path).cpu().item() * 100,
-          'tres': tres_metric(image_path).cpu().item(),
-          'clipiqa': clipiqa_metric(image_path).cpu().item() * 100,
-          'maniqa': maniqa_metric(image_path).cpu().item() * 100,
-          'dbcnn': dbcnn_metric(image_path).cpu().item() * 100,
-          'paq2piq': paq2piq_metric(image_path).cpu().item(),
-          'hyperiqa': hyperiqa_metric(image_path).cpu().item() * 100,
-          'cnniqa': cnniqa_metric(image_path).cpu().item() * 100,
-          'liqe' : liqe_metric(image_path).cpu().item(),
-        #   'liqe_mix': liqe_mix_metric(image_path).cpu().item(),
-        #   'brisque': brisque_metric(image_path).cpu().item(),
-        #   'niqe': niqe_metric(image_path).cpu().item(),
-        #   'nima': nima_metric(image_path).cpu().item()
-          }
+    return {name: metric(image_path).cpu().item() * IQA_METRIC_SCALES.get(name, 1)
+            for name, metric in iqa_metrics.items()}
 
 # Reference: https://github.com/TianheWu/MLLMs-for-IQA
 # Takes an IQA score and scales it to range in scale num.
@@ -69,18 +72,21 @@ def get_image_mos(image_name, mos_file_path):
     Returns:
     - The MOS value for the given image, or None if the image is not found.
     """
-    mos_dict = {}
+    return read_mos_file(mos_file_path).get(image_name, None)
 
-    # Step 1: Open the MOS file and read line by line
+
+# Parses a MOS file once; later lookups in the same file reuse the dict.
+# For correlations over whole result files, see utils/evaluation.py.
+@lru_cache(maxsize=None)
+def read_mos_file(mos_file_path):
+    mos_dict = {}
     with open(mos_file_path, 'r') as file:
         for line in file:
             parts = line.strip().split()
             if len(parts) == 2:
                 img_name, mos_value = parts
                 mos_dict[img_name] = float(mos_value)
-
-    # Step 2: Retrieve the MOS value for the specified image name
-    return mos_dict.get(image_name, None)
+    return mos_dict
 
 
 # When you have a folder containing images and want to load it
@@ -1,23 +1,45 @@
-from .base_model import BaseModel
-# from .mplug_owl2 import MPLUGOwl2Model
-from .llava_1_5 import LLAVA1_5
-from .llava_1_6 import LLAVA1_6
-from .idefics_9b_instruct import IDEFICS9bModel
-from .internlm_xc2_vl import InternLMXC2Model
-
-# Map model names to their implementations
+import importlib
+
+# Map model names to "module:class" of their implementations. Adapters (and
+# the transformers classes they pull in) are only imported when selected.
 MODEL_REGISTRY = {
-    "llava-v1.5-7b": LLAVA1_5,
-    "llava-v1.6-vicuna-7b": LLAVA1_6,
-    "idefics-9b-instruct": IDEFICS9bModel,
-    "internlm-xcomposer2-7b": InternLMXC2Model,
-    # "mplug-owl2-llama2-7b": MPLUGOwl2Model,
+    "llava-v1.5-7b": "models.llava_1_5:LLAVA1_5",
+    "llava-v1.6-vicuna-7b": "models.llava_1_6:LLAVA1_6",
+    "idefics-9b-instruct": "models.idefics_9b_instruct:IDEFICS9bModel",
+    "internlm-xcomposer2-7b": "models.internlm_xc2_vl:InternLMXC2Model",
+    "mplug-owl2-llama2-7b": "models.mplug_owl2:MPLUGOwl2Model",
 }
 
-def load_model(model_config):
-    """Factory function to load the appropriate model."""
-    model_name = model_config["model_name"]
+# Package attributes resolved on first access, so `import models` stays cheap
+_LAZY_ATTRIBUTES = {
+    "BaseModel": "models.base_model:BaseModel",
+    "ModelLifecycle": "models.lifecycle:ModelLifecycle",
+}
+
+
+def _import_path(path):
+    module_name, attribute = path.split(":")
+    return getattr(importlib.import_module(module_name), attribute)
+
+
+def __getattr__(name):
+    if name in _LAZY_ATTRIBUTES:
+        value = _import_path(_LAZY_ATTRIBUTES[name])
+        globals()[name] = value
+        return value
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def get_model_class(model_name):
+    """Import and return the adapter class registered for `model_name`."""
     if model_name not in MODEL_REGISTRY:
         raise ValueError(f"Unknown model: {model_name}")
-    
-    return MODEL_REGISTRY[model_name](model_config) 
\ No newline at end of file
+    return _import_path(MODEL_REGISTRY[model_name])
+
+
+def load_model(model_config):
+    """Factory function to load the appropriate model."""
+    model = get_model_class(model_config["model_name"])(model_config)
+    if "decode_size" in model_config:
+        model.decode_size = model_config["decode_size"]
+    return model
@@ -1,7 +1,28 @@
 from abc import ABC, abstractmethod
+from contextlib import contextmanager
+import hashlib
+from PIL import Image
+import torch
+from .image_decode import decode_image
 
 class BaseModel(ABC):
     """Abstract base class for all models."""
+
+    # Decoding settings passed to every generate call; adapters set their own.
+    # They are part of the response-cache key.
+    generation_kwargs = {}
+
+    # Tensors collected during the generation pass ("hidden_states", "scores").
+    # Empty by default, in which case nothing is captured.
+    capture = ()
+
+    # Shortest image edge the adapter's processor works at; images are decoded
+    # at a reduced resolution that still covers it (see `models.image_decode`).
+    # None decodes at full resolution. "decode_size" in the model config overrides it.
+    decode_size = None
+
+    # Known SHA-1 of image files by path, for lookups before decoding (see `use_content_hashes`)
+    content_hashes = {}
     
     @abstractmethod
     def __init__(self, model_config):
@@ -13,7 +34,222 @@ class BaseModel(ABC):
         """Generate a response for the given prompt and image."""
         pass
     
+    def generate_batch(self, prompts, image_paths, options=None):
+        """Generate responses for a batch of (prompt, image) pairs.
+
+        Returns two lists aligned with the inputs: the decoded responses and
+        the per-sample captured tensors (see `set_capture`, None when nothing
+        is captured). `options` optionally holds one dict of per-prompt
+        decoding options per sample (regex early stopping, max_new_tokens
+        budget; see `models.stopping.decoding_kwargs`). Adapters that can run
+        several samples in one forward pass override this; the default falls
+        back to calling `generate` once per sample and ignores `options`.
+        """
+        responses, embeddings = [], []
+        for prompt, image_path in zip(prompts, image_paths):
+            response, embeds = self.generate(prompt, image_path)
+            responses.append(response)
+            embeddings.append(embeds)
+        return responses, embeddings
+
+    def prepare_batch(self, prompts, image_paths, options=None):
+        """Decode and preprocess a batch on the host.
+
+        Safe to call from a prefetch worker thread while another batch is
+        generating. Adapters override this to also run their processor and
+        copy the inputs to the device; the default only decodes the images.
+        """
+        return {
+            "prompts": prompts,
+            "images": [self.load_image(image_path) for image_path in image_paths],
+            "options": options,
+        }
+
+    def generate_prepared(self, prepared):
+        """Generate responses for the output of `prepare_batch`."""
+        return BaseModel.generate_batch(self, prepared["prompts"], prepared["images"], prepared["options"])
+
+    def score_prepared(self, prepared, token_pairs):
+        """Score a prepared batch from the next-token logits of one prefill pass.
+
+        Returns, per sample, the probability of `token_pairs[0]` against
+        `token_pairs[1]` (e.g. "good" vs "poor") without decoding anything.
+        """
+        raise NotImplementedError(f"{type(self).__name__} does not support logit scoring")
+
+    def score_batch(self, prompts, image_paths, token_pairs):
+        """Logit-based scores for a batch of (prompt, image) pairs, see `score_prepared`."""
+        return self.score_prepared(self.prepare_batch(prompts, image_paths), token_pairs)
+
+    def token_ids(self, tokenizer, words):
+        """First token id of each word, tokenized once per word list."""
+        cache = self.__dict__.setdefault("_token_id_cache", {})
+        key = tuple(words)
+        if key not in cache:
+            cache[key] = [tokenizer(word, add_special_tokens=False).input_ids[0] for word in words]
+        return cache[key]
+
+    def generate_prompts(self, prompts, image_path, options=None):
+        """Generate responses for several prompts applied to the same image.
+
+        The image is decoded once and shared by every prompt. Adapters
+        override this to also reuse the preprocessed pixel tensor and, where
+        possible, the vision-encoder output.
+        """
+        image = self.load_image(image_path)
+        return self.generate_batch(prompts, [image] * len(prompts), options)
+
+    def set_capture(self, *names):
+        """Opt in to capturing tensors during the generation pass itself.
+
+        "hidden_states" yields the last-layer hidden states of the prompt and
+        every generated token, shape (1, seq_len, hidden); "scores" yields the
+        next-token logits of every decoding step, shape (1, steps, vocab).
+        Call without arguments to turn capturing off again.
+        """
+        unknown = set(names) - {"hidden_states", "scores"}
+        if unknown:
+            raise ValueError(f"Unknown capture targets: {sorted(unknown)}")
+        self.capture = tuple(names)
+
+    def generate_capture_kwargs(self):
+        """Extra `generate` kwargs needed for the requested captures."""
+        if not self.capture:
+            return {}
+        return {
+            "return_dict_in_generate": True,
+            "output_hidden_states": "hidden_states" in self.capture,
+            "output_scores": "scores" in self.capture,
+        }
+
+    def unpack_generate_output(self, output):
+        """Split a `generate` result into sequences and per-sample captures."""
+        if not self.capture:
+            return output, [None] * output.shape[0]
+
+        sequences = output.sequences
+        captured = [{} for _ in range(sequences.shape[0])]
+        if "hidden_states" in self.capture:
+            # Last layer of the prefill step followed by every decoding step
+            last_layer = torch.cat([step[-1] for step in output.hidden_states], dim=1)
+            for i, sample in enumerate(captured):
+                sample["hidden_states"] = last_layer[i:i + 1]
+        if "scores" in self.capture:
+            scores = torch.stack(output.scores, dim=1)
+            for i, sample in enumerate(captured):
+                sample["scores"] = scores[i:i + 1]
+        return sequences, captured
+
+    @contextmanager
+    def capture_output_layer(self, output_layer):
+        """Capture from a forward hook on the output layer, for adapters whose
+        generation API hides `generate`. Yields the capture dict (filled when
+        the block exits), or None when nothing is captured."""
+        if not self.capture:
+            yield None
+            return
+
+        hidden_states, logits = [], []
+
+        def hook(module, inputs, output):
+            hidden_states.append(inputs[0])
+            logits.append(output[:, -1, :])
+
+        captured = {}
+        handle = output_layer.register_forward_hook(hook)
+        try:
+            yield captured
+        finally:
+            handle.remove()
+            if "hidden_states" in self.capture and hidden_states:
+                captured["hidden_states"] = torch.cat(hidden_states, dim=1)
+            if "scores" in self.capture and logits:
+                captured["scores"] = torch.stack(logits, dim=1)
+
+    def load_image(self, image):
+        """Return a decoded RGB image from a path (decoded images pass through).
+
+        The image is reduced towards `decode_size` while it is decoded. The
+        SHA-1 of the file bytes is kept in `image.info["content_hash"]` so
+        caches can address the image by content. The bytes just read are
+        hashed, so a file rewritten in place never inherits an old hash.
+        """
+        if isinstance(image, Image.Image):
+            return image
+        with open(image, "rb") as f:
+            data = f.read()
+        decoded = decode_image(data, self.decode_size)
+        decoded.info["content_hash"] = hashlib.sha1(data).hexdigest()
+        return decoded
+
+    def use_content_hashes(self, hashes):
+        """Register the content hashes of image files as {path: SHA-1}, e.g. from a
+        dataset manifest, for cache lookups by path before an image is decoded."""
+        self.content_hashes = {**self.content_hashes, **hashes}
+
+    def use_tensor_cache(self, cache):
+        """Serve preprocessed pixel tensors from a `utils.tensor_cache.TensorCache`.
+
+        Adapters whose image preprocessing can be wrapped override this; the
+        default leaves preprocessing uncached.
+        """
+        pass
+    
     @abstractmethod
     def process_output(self, output):
         """Process the model output to extract the score."""
-        pass 
\ No newline at end of file
+        pass
+
+
+def pair_probability(next_token_logits, token_ids):
+    """Q-Bench style score: softmax over the logits of the candidate tokens,
+    returning the probability of the first one for every row."""
+    selected = next_token_logits[:, token_ids].float()
+    return [float(p) for p in (selected / 100).softmax(dim=-1)[:, 0]]
+
+
+def _first_row(value, batch):
+    """Keep only the first row of a per-image tensor argument."""
+    if hasattr(value, "shape") and len(value.shape) > 0 and value.shape[0] == batch:
+        return value[:1]
+    return value
+
+
+@contextmanager
+def shared_vision_features(module, method_name):
+    """Temporarily memoize a vision-encoder method of `module`.
+
+    Calls with the same input tensor reuse the first result, and a batch whose
+    rows are all views of one image (stride 0 on the batch dimension) is
+    encoded once and expanded. Does nothing if `module` has no such method.
+    """
+    original = getattr(module, method_name, None)
+    if original is None:
+        yield
+        return
+
+    cache = {}
+
+    def cached(pixel_values, *args, **kwargs):
+        key = (pixel_values.data_ptr(), tuple(pixel_values.shape))
+        if key not in cache:
+            batch = pixel_values.shape[0] if pixel_values.dim() > 1 else 1
+            if batch > 1 and pixel_values.stride(0) == 0:
+                # Per-image side inputs (e.g. image_sizes) are shrunk to match
+                args = [_first_row(arg, batch) for arg in args]
+                kwargs = {name: _first_row(arg, batch) for name, arg in kwargs.items()}
+                features = original(pixel_values[:1], *args, **kwargs)
+                if isinstance(features, (list, tuple)):
+                    features = [features[0]] * batch
+                else:
+                    features = features.expand(batch, *features.shape[1:])
+            else:
+                features = original(pixel_values, *args, **kwargs)
+            cache[key] = features
+        return cache[key]
+
+    setattr(module, method_name, cached)
+    try:
+        yield
+    finally:
+        delattr(module, method_name)
@@ -0,0 +1,88 @@
+import weakref
+
+import torch
+from transformers import LogitsProcessor
+
+
+class ChoiceConstraint:
+    """Finite answer grammar: the output must be `prefix` followed by one of `choices`.
+
+    Every allowed answer is tokenized as a whole and stored in a token trie,
+    so at each decode step only the tokens that keep the output on some
+    allowed answer are permitted.
+    """
+
+    def __init__(self, tokenizer, choices, prefix=""):
+        self.eos_token_id = tokenizer.eos_token_id
+        self.trie = {}
+        self.max_length = 0
+        for choice in choices:
+            token_ids = tokenizer(prefix + choice, add_special_tokens=False).input_ids
+            node = self.trie
+            for token_id in token_ids:
+                node = node.setdefault(token_id, {})
+            # None marks the end of a complete answer
+            node[None] = {}
+            self.max_length = max(self.max_length, len(token_ids))
+
+    def _walk(self, generated):
+        """Trie node reached by the generated tokens, or None once off the grammar."""
+        node = self.trie
+        for token_id in generated.tolist():
+            node = node.get(token_id)
+            if node is None:
+                return None
+        return node
+
+    def allowed_tokens(self, generated):
+        """Token ids that may follow `generated`; EOS once an answer is complete."""
+        node = self._walk(generated)
+        if node is None:
+            return [self.eos_token_id]
+        allowed = [token_id for token_id in node if token_id is not None]
+        if None in node:
+            allowed.append(self.eos_token_id)
+        return allowed
+
+    def finished(self, generated):
+        """Whether the output is a complete answer that cannot be extended, or has left the grammar."""
+        node = self._walk(generated)
+        return node is None or list(node) == [None]
+
+
+# Per tokenizer instance, dropped with it; an id() key could be reused by the
+# tokenizer of the next model loaded after the previous one is freed
+_constraints = weakref.WeakKeyDictionary()
+
+
+def make_constraint(tokenizer, constrained_output):
+    """ChoiceConstraint for a prompt's `constrained_output` config, memoized per tokenizer."""
+    choices = tuple(constrained_output["choices"])
+    prefix = constrained_output.get("prefix", "")
+    memo = _constraints.setdefault(tokenizer, {})
+    if (prefix, choices) not in memo:
+        memo[(prefix, choices)] = ChoiceConstraint(tokenizer, choices, prefix)
+    return memo[(prefix, choices)]
+
+
+class ConstrainedOutputLogitsProcessor(LogitsProcessor):
+    """Masks the logits of constrained rows to the tokens their grammar allows.
+
+    `constraints` holds one ChoiceConstraint (or None for a free-form row)
+    per row of the batch; generated tokens start at `prompt_length`.
+    """
+
+    def __init__(self, constraints, prompt_length):
+        self.constraints = constraints
+        self.prompt_length = prompt_length
+
+    def __call__(self, input_ids, scores):
+        generated = input_ids[:, self.prompt_length:]
+        for i, constraint in enumerate(self.constraints):
+            if constraint is None:
+                continue
+            allowed = torch.tensor(constraint.allowed_tokens(generated[i]), device=scores.device)
+            mask = torch.full_like(scores[i], float("-inf"))
+            mask[allowed] = 0
+            scores[i] = scores[i] + mask
+        return scores
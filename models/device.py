@@ -0,0 +1,101 @@
+"""
+Device Placement
+----------------
+Where and in which precision an adapter runs, read from optional keys of
+its model config (see `config/models.py`):
+
+    "device"               "auto" (CUDA when available, default), "cuda", "cuda:1" or "cpu"
+    "dtype"                "float16", "bfloat16" or "float32" weights; defaults to the
+                           adapter's own dtype on CUDA and to float32 on CPU
+    "autocast"             run forward passes under autocast (float16 on CUDA, bfloat16
+                           on CPU); on CPU the default is on when the CPU has native
+                           bf16 matmuls and the weights are float32
+    "cpu_threads"          intra-op threads on CPU (default: torch's, i.e. OMP_NUM_THREADS)
+    "cpu_interop_threads"  inter-op threads on CPU (default: torch's)
+
+Every model call runs under `torch.inference_mode` through `inference()`.
+"""
+
+from contextlib import contextmanager
+
+import torch
+
+DTYPES = {"float16": torch.float16, "bfloat16": torch.bfloat16, "float32": torch.float32}
+
+
+def cpu_has_native_bf16():
+    """Whether the CPU runs bf16 matmuls natively (AVX512-BF16 or AMX).
+
+    Elsewhere bf16 is emulated and slower than float32, so autocast stays off.
+    """
+    for check in ("_is_avx512_bf16_supported", "_is_amx_tile_supported"):
+        supported = getattr(torch.cpu, check, None)
+        if supported is not None and supported():
+            return True
+    return False
+
+
+def configure_cpu_threads(num_threads=None, num_interop_threads=None):
+    """Size torch's intra-op and inter-op thread pools (None keeps the current size)."""
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    if num_interop_threads and torch.get_num_interop_threads() != num_interop_threads:
+        try:
+            torch.set_num_interop_threads(num_interop_threads)
+        except RuntimeError:
+            # Only settable once, before any inter-op parallel work has started
+            print(f"Cannot change inter-op threads to {num_interop_threads}, "
+                  f"keeping {torch.get_num_interop_threads()}")
+
+
+class DevicePlacement:
+    """Device, weight dtype and autocast setting of one adapter.
+
+    `dtype` and `autocast` are the adapter's defaults on CUDA; the model
+    config overrides them.
+    """
+
+    def __init__(self, model_config, dtype=torch.float16, autocast=False):
+        device = model_config.get("device", "auto")
+        if device == "auto":
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.device = torch.device(device)
+
+        if self.device.type == "cpu":
+            configure_cpu_threads(model_config.get("cpu_threads"), model_config.get("cpu_interop_threads"))
+            self.dtype = DTYPES[model_config.get("dtype", "float32")]
+            self.autocast_dtype = torch.bfloat16
+            autocast = self.dtype == torch.float32 and cpu_has_native_bf16()
+        else:
+            self.dtype = DTYPES[model_config["dtype"]] if "dtype" in model_config else dtype
+            self.autocast_dtype = torch.float16
+        self.use_autocast = model_config.get("autocast", autocast)
+
+    def describe(self):
+        description = f"{self.device} {str(self.dtype).replace('torch.', '')}"
+        if self.use_autocast:
+            description += f", {str(self.autocast_dtype).replace('torch.', '')} autocast"
+        if self.device.type == "cpu":
+            description += f", {torch.get_num_threads()}/{torch.get_num_interop_threads()} intra/inter-op threads"
+        return description
+
+    def move(self, tensor, dtype=None):
+        """Copy a host tensor to the device; on CUDA asynchronously from pinned memory."""
+        if self.device.type == "cuda":
+            return tensor.pin_memory().to(self.device, dtype=dtype, non_blocking=True)
+        return tensor.to(self.device, dtype=dtype)
+
+    def move_inputs(self, inputs):
+        """Copy every tensor of a processor output to the device, in place."""
+        for key in inputs:
+            inputs[key] = self.move(inputs[key])
+        return inputs
+
+    def autocast(self):
+        return torch.autocast(self.device.type, dtype=self.autocast_dtype, enabled=self.use_autocast)
+
+    @contextmanager
+    def inference(self):
+        """Context for model calls: inference mode plus the configured autocast."""
+        with torch.inference_mode(), self.autocast():
+            yield
@@ -1,52 +1,84 @@
-from PIL import Image
 from transformers import IdeficsForVisionText2Text, AutoProcessor
-from .base_model import BaseModel
+from .base_model import BaseModel, pair_probability
+from .stopping import decoding_kwargs
+from .device import DevicePlacement
 import torch
 
 class IDEFICS9bModel(BaseModel):
+    # The processor resizes to 224 x 224
+    decode_size = 224
+
     def __init__(self, model_config):
         """Initialize IDEFICS 9B Instruct model."""
         self.model_path = model_config["model_path"]
+        self.placement = DevicePlacement(model_config, dtype=torch.bfloat16)
 
         # Load model and tokenizer
-        self.model = IdeficsForVisionText2Text.from_pretrained(self.model_path, torch_dtype=torch.bfloat16)
+        self.model = IdeficsForVisionText2Text.from_pretrained(self.model_path, torch_dtype=self.placement.dtype)
         self.processor = AutoProcessor.from_pretrained(self.model_path)
+
+        # Decoding settings shared by every generate call
+        self.generation_kwargs = {"max_length": 400}
+
+        # Left-pad so every sequence in a batch ends right before generation
+        self.processor.tokenizer.padding_side = "left"
         
-        # Move model to GPU if available
-        self.model.to('cuda')
+        # Move model to its configured device
+        self.model.to(self.placement.device)
     
     def generate(self, prompt, image_path):
         """Generate response using IDEFICS 9B Instruct."""
-        # Load and process image
-        image = Image.open(image_path).convert("RGB")
+        responses, embeddings = self.generate_batch([prompt], [image_path])
+        return responses[0], embeddings[0]
 
-        prompts = ["user:",image,f"{prompt}","Assistant:"]
-        
-        inputs = self.processor(prompts,return_tensors="pt",debug=True).to('cuda')
+    def prepare_batch(self, prompts, image_paths, options=None):
+        """Decode, preprocess and copy a batch to the model's device (runs in prefetch workers)."""
+        batch_prompts = []
+        for prompt, image_path in zip(prompts, image_paths):
+            image = self.load_image(image_path)
+            batch_prompts.append(["user:", image, f"{prompt}", "Assistant:"])
+
+        # The processor pads the batch and returns the matching attention mask
+        inputs = self.placement.move_inputs(self.processor(batch_prompts, padding="longest", return_tensors="pt"))
+
+        return {"inputs": inputs, "options": options}
+
+    def generate_prepared(self, prepared):
+        """Generate responses for a batch returned by `prepare_batch`."""
+        inputs = prepared["inputs"]
+        kwargs = decoding_kwargs(self.generation_kwargs, prepared["options"], self.processor.tokenizer, inputs["input_ids"].shape[1])
 
         exit_condition = self.processor.tokenizer("<end_of_utterance>", add_special_tokens=False).input_ids
         bad_words_ids = self.processor.tokenizer(["<image>", "<fake_token_around_image>"], add_special_tokens=False).input_ids
-        
-        generate_ids = self.model.generate(**inputs,
-                                      eos_token_id=exit_condition,
-                                      bad_words_ids=bad_words_ids,
-                                      max_length=400)
-        
-        embeds = generate_ids
-    
-        generate_text = self.processor.batch_decode(generate_ids,
-                                               skip_special_tokens=True)[0]
-        
-        return generate_text, embeds
-        
-            
-    def process_output(self, embeds):
-        """Extract score from model output."""
 
-        good_idx, poor_idx = self.processor.tokenizer(["good","poor"]).tolist()
+        with self.placement.inference():
+            generate_ids = self.model.generate(**inputs,
+                                          eos_token_id=exit_condition,
+                                          bad_words_ids=bad_words_ids,
+                                          **kwargs,
+                                          **self.generate_capture_kwargs())
+
+        generate_ids, captured = self.unpack_generate_output(generate_ids)
+        responses = self.processor.batch_decode(generate_ids, skip_special_tokens=True)
 
-        output_logits = self.model(input_embeds=embeds).logits[0,-1]
+        return responses, captured
 
-        q_pred = (output_logits[[good_idx, poor_idx]] / 100).softmax(0)[0]
+    def score_prepared(self, prepared, token_pairs):
+        """Next-token probability of token_pairs[0] vs token_pairs[1] from one prefill pass."""
+        inputs = prepared["inputs"]
+        token_ids = self.token_ids(self.processor.tokenizer, token_pairs)
+
+        # Left padding puts every row's next-token position last
+        with self.placement.inference():
+            logits = self.model(**inputs).logits[:, -1, :]
+
+        return pair_probability(logits, token_ids)
+
+    def generate_batch(self, prompts, image_paths, options=None):
+        """Generate responses for a batch of prompts and images using IDEFICS 9B Instruct."""
+        return self.generate_prepared(self.prepare_batch(prompts, image_paths, options))
         
-        return float(q_pred) 
\ No newline at end of file
+    def process_output(self, embeds):
+        """Extract score from the first-step logits captured with `set_capture("scores")`."""
+        token_ids = self.token_ids(self.processor.tokenizer, ["good", "poor"])
+        return pair_probability(embeds["scores"][:, 0, :], token_ids)[0]
@@ -0,0 +1,43 @@
+"""
+Reduced-Resolution Decoding
+---------------------------
+Every processor downscales its input to a fixed size (336 px for LLaVA,
+224 px for IDEFICS, 490 px for InternLM-XComposer2), so decoding a
+smartphone photo at full resolution wastes most of the decode time and
+memory. `decode_image` only produces as many pixels as the adapter's
+`decode_size` needs:
+
+- JPEGs are decoded at 1/2, 1/4 or 1/8 scale by libjpeg itself (`draft`),
+- what is left of the reduction (and every other format) is done with
+  `Image.reduce`, an integer box filter that is much cheaper than a resize.
+
+The shortest edge of the result never drops below `decode_size`, so the
+processor still performs the final resize to its input size.
+"""
+
+import io
+
+from PIL import Image
+
+
+def reduction_factor(size, decode_size):
+    """Largest integer factor that keeps the shortest edge of `size` at `decode_size` or more."""
+    if not decode_size:
+        return 1
+    return max(1, min(size) // decode_size)
+
+
+def decode_image(data, decode_size=None):
+    """Decode image file bytes to RGB, reduced towards `decode_size` (None keeps full resolution)."""
+    image = Image.open(io.BytesIO(data))
+    if decode_size and image.format == "JPEG":
+        factor = reduction_factor(image.size, decode_size)
+        if factor > 1:
+            # libjpeg picks the smallest DCT scale still at least this large
+            width, height = image.size
+            image.draft("RGB", (width // factor, height // factor))
+    image = image.convert("RGB")
+    factor = reduction_factor(image.size, decode_size)
+    if factor > 1:
+        image = image.reduce(factor)
+    return image
@@ -1,60 +1,147 @@
-from PIL import Image
 from transformers import AutoTokenizer, AutoModelForCausalLM
-from .base_model import BaseModel
+from .base_model import BaseModel, shared_vision_features, pair_probability
+from .stopping import decoding_kwargs
+from .device import DevicePlacement
+from utils.tensor_cache import CachedTransform, processor_identity
 import torch
 
 class InternLMXC2Model(BaseModel):
+    # The vision processor resizes to 490 x 490
+    decode_size = 490
+
     def __init__(self, model_config):
         """Initialize InternLMXC2Model model."""
         self.model_path = model_config["model_path"]
+        # float32 weights with float16 autocast on CUDA; set "dtype": "float16"
+        # in the model config to halve the weight memory if float32 runs out of memory
+        self.placement = DevicePlacement(model_config, dtype=torch.float32, autocast=True)
         
         # Load model and tokenizer
         self.tokenizer = AutoTokenizer.from_pretrained(self.model_path, trust_remote_code=True)
-        self.model = AutoModelForCausalLM.from_pretrained(self.model_path, torch_dtype=torch.float32, trust_remote_code=True).cuda()
-        # Set `torch_dtype=torch.float16` to load model in float16, otherwise it will be loaded as float32 and might cause OOM Error.
+        self.model = AutoModelForCausalLM.from_pretrained(
+            self.model_path, torch_dtype=self.placement.dtype, trust_remote_code=True
+        ).to(self.placement.device)
         
         self.model = self.model.eval()
+        self.vis_processor = self.model.vis_processor
+
+        # Decoding settings shared by every chat call (1024 new tokens is
+        # `model.chat`'s own default)
+        self.generation_kwargs = {"do_sample": False, "max_new_tokens": 1024}
     
-    def generate(self, prompt, image_path):
-        """Generate response using InternLMXC2Model."""
-        # Load and process image
-        image = Image.open(image_path).convert("RGB")
+    def use_tensor_cache(self, cache):
+        """Serve the vision processor's outputs from the tensor cache."""
+        self.vis_processor = CachedTransform(
+            self.model.vis_processor, cache, processor_identity(self.model_path, repr(self.model.vis_processor))
+        )
+
+    def _preprocess(self, image_path):
+        """Decode an image and run the vision processor on it."""
+        image = self.load_image(image_path)
         
         # Format messages
-        image = self.model.vis_processor(image)
+        image = self.vis_processor(image)
 
-        image = torch.stack(image)
-        
+        return torch.stack(image)
+
+    def _chat(self, prompt, image, option=None):
+        """Run one chat turn on an already preprocessed image tensor.
+
+        Requested captures are collected by a hook on the output layer during
+        the chat itself; without any, the second value is None. `model.chat`
+        generates from input embeddings, so the stopping criteria see only
+        the generated tokens (prompt length 0).
+        """
+        kwargs = decoding_kwargs(self.generation_kwargs, [option] if option else None, self.tokenizer, 0)
         query = f'<ImageHere> <ImageHere>{prompt}'
-        with torch.cuda.amp.autocast():
-            # Get both response and embeddings
+        with self.placement.inference(), self.capture_output_layer(self.model.get_output_embeddings()) as captured:
             response, history = self.model.chat(
                 self.tokenizer, 
                 query=query, 
                 image=image, 
                 history=[], 
-                do_sample=False,
-                return_embeddings=True  # Add this parameter if available in the model
+                **kwargs
             )
-            
-            # If the model doesn't have a return_embeddings parameter,
-            # you can get embeddings directly from the forward pass:
-            inputs = self.tokenizer(query, return_tensors="pt").to('cuda')
-            with torch.no_grad():
-                outputs = self.model(**inputs, output_hidden_states=True)
-                embeddings = outputs.hidden_states[-1]  # Get last hidden state
         
-        return response, embeddings
+        return response, captured
+
+    # `model.chat` only takes one query at a time, so batches run one chat
+    # turn per sample.
+    def generate(self, prompt, image_path):
+        """Generate response using InternLMXC2Model."""
+        return self._chat(prompt, self._preprocess(image_path))
+
+    def prepare_batch(self, prompts, image_paths, options=None):
+        """Decode and run the vision processor on a batch (runs in prefetch workers)."""
+        return {
+            "prompts": prompts,
+            "images": [self._preprocess(image_path) for image_path in image_paths],
+            "options": options,
+        }
+
+    def generate_prepared(self, prepared):
+        """Generate responses one chat turn at a time for a prepared batch."""
+        options = prepared["options"] or [None] * len(prepared["prompts"])
+        responses, embeddings = [], []
+        for prompt, image, option in zip(prepared["prompts"], prepared["images"], options):
+            response, embeds = self._chat(prompt, image, option)
+            responses.append(response)
+            embeddings.append(embeds)
+        return responses, embeddings
+
+    def generate_batch(self, prompts, image_paths, options=None):
+        """Generate responses for a batch of prompts and images using InternLMXC2Model."""
+        return self.generate_prepared(self.prepare_batch(prompts, image_paths, options))
+
+    def score_prepared(self, prepared, token_pairs):
+        """Next-token probability of token_pairs[0] vs token_pairs[1] from one prefill pass.
+
+        `model.chat` hides the forward pass, so a hook on the output layer
+        captures the prefill logits of a one-token chat turn.
+        """
+        token_ids = self.token_ids(self.tokenizer, token_pairs)
+
+        scores = []
+        for prompt, image in zip(prepared["prompts"], prepared["images"]):
+            captured = []
+            handle = self.model.get_output_embeddings().register_forward_hook(
+                lambda module, inputs, output: captured.append(output[:, -1, :])
+            )
+            try:
+                with self.placement.inference():
+                    self.model.chat(
+                        self.tokenizer,
+                        query=f'<ImageHere> <ImageHere>{prompt}',
+                        image=image,
+                        history=[],
+                        do_sample=False,
+                        max_new_tokens=1,
+                    )
+            finally:
+                handle.remove()
+            scores.extend(pair_probability(captured[0], token_ids))
+
+        return scores
+
+    def generate_prompts(self, prompts, image_path, options=None):
+        """Generate responses for several prompts on one image using InternLMXC2Model.
+
+        The image is decoded and preprocessed once, and `encode_img` reuses the
+        vision-encoder output for every prompt after the first.
+        """
+        image = self._preprocess(image_path)
+        options = options or [None] * len(prompts)
+
+        responses, embeddings = [], []
+        with shared_vision_features(self.model, "encode_img"):
+            for prompt, option in zip(prompts, options):
+                response, embeds = self._chat(prompt, image, option)
+                responses.append(response)
+                embeddings.append(embeds)
+
+        return responses, embeddings
     
     def process_output(self, embeddings):
-        """Extract score from model output."""
-        # Get token IDs for "good" and "poor"
-        good_idx, poor_idx = self.tokenizer(["good", "poor"]).input_ids
-        
-        # Get logits from the last position
-        output_logits = self.model(input_embeds=embeddings).logits[0, -1]
-        
-        # Calculate prediction score
-        q_pred = (output_logits[[good_idx, poor_idx]] / 100).softmax(0)[0]
-        
-        return float(q_pred) 
\ No newline at end of file
+        """Extract score from the first-step logits captured with `set_capture("scores")`."""
+        token_ids = self.token_ids(self.tokenizer, ["good", "poor"])
+        return pair_probability(embeddings["scores"][:, 0, :], token_ids)[0]
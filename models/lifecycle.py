@@ -0,0 +1,131 @@
+import ctypes
+import gc
+import os
+import resource
+import threading
+import time
+
+import torch
+
+
+def current_rss():
+    """Resident set size of this process in bytes."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        # No procfs: fall back to the lifetime peak (kilobytes on Linux)
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def release_memory():
+    """Collect garbage and hand cached memory back to the device and the OS."""
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+        torch.cuda.empty_cache()
+        torch.cuda.ipc_collect()
+    try:
+        # glibc keeps freed heap pages mapped until asked to trim them
+        ctypes.CDLL("libc.so.6").malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+
+
+class _RSSMonitor:
+    """Samples the process RSS in a background thread and keeps the peak."""
+
+    def __init__(self, interval=0.5):
+        self.interval = interval
+        self.peak = current_rss()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, current_rss())
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, current_rss())
+
+
+class ModelLifecycle:
+    """Context manager owning one model from load to teardown.
+
+        with ModelLifecycle(model_config) as model_instance:
+            ...
+
+    On exit every attribute of the adapter (model, processor, caches) is
+    dropped, garbage is collected and the device allocator cache is
+    released, so the next model loads into freed memory. Memory use is
+    tracked while the model is alive and printed on exit; it is also kept in
+    `self.report`.
+    """
+
+    def __init__(self, model_config, monitor_interval=0.5):
+        self.model_config = model_config
+        self.monitor_interval = monitor_interval
+        self.model_instance = None
+        self.report = {}
+
+    def __enter__(self):
+        # Imported here so the registry (and every adapter) only loads on use
+        from . import load_model
+
+        release_memory()
+        if torch.cuda.is_available():
+            torch.cuda.reset_peak_memory_stats()
+        self.report["rss_before_load"] = current_rss()
+        self._monitor = _RSSMonitor(self.monitor_interval)
+        self._monitor.start()
+
+        start = time.perf_counter()
+        try:
+            self.model_instance = load_model(self.model_config)
+        except BaseException:
+            self._monitor.stop()
+            release_memory()
+            raise
+        self.report["load_seconds"] = time.perf_counter() - start
+        self.report["rss_after_load"] = current_rss()
+        if torch.cuda.is_available():
+            self.report["device_after_load"] = torch.cuda.memory_allocated()
+        placement = getattr(self.model_instance, "placement", None)
+        if placement is not None:
+            print(f"{self.model_config['model_name']} runs on {placement.describe()}")
+        return self.model_instance
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._monitor.stop()
+        self.report["peak_rss"] = self._monitor.peak
+        if torch.cuda.is_available():
+            self.report["peak_device_allocated"] = torch.cuda.max_memory_allocated()
+            self.report["peak_device_reserved"] = torch.cuda.max_memory_reserved()
+
+        # Drop the adapter's references even if someone still holds the instance
+        self.model_instance.__dict__.clear()
+        self.model_instance = None
+        release_memory()
+        self.report["rss_after_teardown"] = current_rss()
+        if torch.cuda.is_available():
+            self.report["device_after_teardown"] = torch.cuda.memory_allocated()
+
+        self.print_report()
+        return False
+
+    def print_report(self):
+        gb = 1024 ** 3
+        report = self.report
+        line = (f"Memory for {self.model_config['model_name']}: load {report['load_seconds']:.1f}s, "
+                f"RSS {report['rss_before_load'] / gb:.2f} -> {report['rss_after_load'] / gb:.2f} GB "
+                f"(peak {report['peak_rss'] / gb:.2f} GB, {report['rss_after_teardown'] / gb:.2f} GB after teardown)")
+        if "peak_device_allocated" in report:
+            line += (f", device peak {report['peak_device_allocated'] / gb:.2f} GB allocated / "
+                     f"{report['peak_device_reserved'] / gb:.2f} GB reserved, "
+                     f"{report['device_after_teardown'] / gb:.2f} GB after teardown")
+        print(line)
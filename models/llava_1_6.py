@@ -1,56 +1,22 @@
-from PIL import Image
 from transformers import LlavaNextProcessor, LlavaNextForConditionalGeneration
-from .base_model import BaseModel
-import torch
+from .llava_base import LlavaBase
 
-class LLAVA1_6(BaseModel):
-    def __init__(self, model_config):
+class LLAVA1_6(LlavaBase):
+    processor_class = LlavaNextProcessor
+    model_class = LlavaNextForConditionalGeneration
 
-        self.model_path = model_config["model_path"]
+    # AnyRes grids of 336 px tiles go up to 672 px on the shortest edge
+    decode_size = 672
 
-        self.processor = LlavaNextProcessor.from_pretrained(self.model_path)
+    # Decoding settings shared by every generate call
+    generation_kwargs = {"max_new_tokens": 300}
 
-        self.model = LlavaNextForConditionalGeneration.from_pretrained(self.model_path, torch_dtype=torch.float16) 
-                
-        # Move model to GPU if available
-        self.model.to('cuda')
-    
-    def generate(self, prompt, image_path):
+    def _decode(self, output, inputs):
+        """Decode a `generate` result and split out the captured tensors."""
+        sequences, captured = self.unpack_generate_output(output)
+        return self.processor.batch_decode(sequences, skip_special_tokens=True), captured
 
-        # Load and process image
-        image = Image.open(image_path).convert("RGB")
-
-        conversation = [
-            {
-        
-              "role": "user",
-              "content": [
-                  {"type": "text", "text": f"{prompt}"},
-                  {"type": "image"},
-                ],
-            },
-        ]
-        
-        prompt = self.processor.apply_chat_template(conversation, add_generation_prompt=True)
-        
-        inputs = self.processor(images=image, text=prompt, return_tensors='pt')
-
-        inputs.to('cuda')
-
-        output = self.model.generate(**inputs, max_new_tokens=300)
-        embeds = output # getting the embeddings out
-        output = self.processor.decode(output[0], skip_special_tokens=True)
-       
-        return output, embeds
-    
-  # this code snippet follows Q-Bench
-    def process_output(self, embeds):
-        """Extract score from model output."""
-
-        good_idx, poor_idx = self.processor.tokenizer(["good","poor"]).tolist()
-
-        output_logits = self.model(input_embeds=embeds).logits[0,-1]
-
-        q_pred = (output_logits[[good_idx, poor_idx]] / 100).softmax(0)[0]
-        
-        return float(q_pred) 
\ No newline at end of file
+    def _expand_image_inputs(self, inputs, batch):
+        """Expand the pixel tensor and the AnyRes image size of one image over `batch` rows."""
+        super()._expand_image_inputs(inputs, batch)
+        inputs["image_sizes"] = inputs["image_sizes"].expand(batch, -1)
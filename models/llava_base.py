@@ -0,0 +1,151 @@
+from .base_model import BaseModel, shared_vision_features, pair_probability
+from .stopping import decoding_kwargs
+from .device import DevicePlacement
+from utils.tensor_cache import CachedImageProcessor, processor_identity
+import torch
+
+class LlavaBase(BaseModel):
+    """Batching and shared-image generation of the LLaVA adapters.
+
+    Subclasses name their `processor_class` and `model_class`, set
+    `generation_kwargs` and `decode_size`, and implement `_decode`.
+    """
+
+    processor_class = None
+    model_class = None
+
+    def __init__(self, model_config):
+        self.model_path = model_config["model_path"]
+        self.placement = DevicePlacement(model_config, dtype=torch.float16)
+
+        self.processor = self.processor_class.from_pretrained(self.model_path)
+        self.model = self.model_class.from_pretrained(self.model_path, torch_dtype=self.placement.dtype)
+
+        # Left-pad so every sequence in a batch ends right before generation
+        self.processor.tokenizer.padding_side = "left"
+
+        # Chat-template text per prompt
+        self._prompt_texts = {}
+
+        # Move model to its configured device
+        self.model.to(self.placement.device)
+
+    def use_tensor_cache(self, cache):
+        """Serve the image processor's outputs from the tensor cache."""
+        image_processor = self.processor.image_processor
+        identity = processor_identity(self.model_path, image_processor.to_dict())
+        self.processor.image_processor = CachedImageProcessor(image_processor, cache, identity)
+
+    def _build_prompt(self, prompt):
+        """Apply the chat template to obtain the full prompt text (rendered once per prompt)."""
+        if prompt in self._prompt_texts:
+            return self._prompt_texts[prompt]
+        conversation = [
+            {
+              "role": "user",
+              "content": [
+                  {"type": "text", "text": f"{prompt}"},
+                  {"type": "image"},
+                ],
+            },
+        ]
+        self._prompt_texts[prompt] = self.processor.apply_chat_template(conversation, add_generation_prompt=True)
+        return self._prompt_texts[prompt]
+
+    def generate(self, prompt, image_path):
+        """Generate a response for one prompt and image."""
+        responses, embeddings = self.generate_batch([prompt], [image_path])
+        return responses[0], embeddings[0]
+
+    def _decode(self, output, inputs):
+        """Decode a `generate` result for `inputs` and split out the captured tensors."""
+        raise NotImplementedError
+
+    def prepare_batch(self, prompts, image_paths, options=None):
+        """Decode, preprocess and copy a batch to the model's device (runs in prefetch workers)."""
+        images = [self.load_image(image_path) for image_path in image_paths]
+        prompt_texts = [self._build_prompt(prompt) for prompt in prompts]
+
+        # Left padding + attention mask let samples of different length share a batch
+        inputs = self.placement.move_inputs(
+            self.processor(images=images, text=prompt_texts, padding=True, return_tensors='pt')
+        )
+
+        return {"inputs": inputs, "options": options}
+
+    def _generate(self, inputs, options):
+        """Run `generate` with the per-prompt decoding options and captures."""
+        kwargs = decoding_kwargs(self.generation_kwargs, options, self.processor.tokenizer, inputs["input_ids"].shape[1])
+
+        with self.placement.inference():
+            return self.model.generate(**inputs, **kwargs, **self.generate_capture_kwargs())
+
+    def generate_prepared(self, prepared):
+        """Generate responses for a batch returned by `prepare_batch`."""
+        inputs = prepared["inputs"]
+        output = self._generate(inputs, prepared["options"])
+
+        return self._decode(output, inputs)
+
+    def score_prepared(self, prepared, token_pairs):
+        """Next-token probability of token_pairs[0] vs token_pairs[1] from one prefill pass."""
+        inputs = prepared["inputs"]
+        token_ids = self.token_ids(self.processor.tokenizer, token_pairs)
+
+        with self.placement.inference():
+            # Left padding puts every row's next-token position last
+            output = self.model(**inputs)
+        logits = output.logits[:, -1, :]
+
+        return pair_probability(logits, token_ids)
+
+    def generate_batch(self, prompts, image_paths, options=None):
+        """Generate responses for a batch of prompts and images."""
+        return self.generate_prepared(self.prepare_batch(prompts, image_paths, options))
+
+    def _prepare_shared_inputs(self, image, prompt_texts):
+        """Preprocess one image once and tokenize every prompt against it."""
+        first = self.processor(images=image, text=prompt_texts[0], return_tensors='pt')
+
+        # Expand the image placeholder the way the processor did for the first prompt
+        image_token = getattr(self.processor, "image_token", "<image>")
+        num_image_tokens = int((first["input_ids"] == self.model.config.image_token_index).sum())
+        texts = [text.replace(image_token, image_token * num_image_tokens) for text in prompt_texts]
+
+        inputs = self.processor.tokenizer(texts, padding=True, return_tensors='pt')
+        for key in first:
+            if key not in ("input_ids", "attention_mask"):
+                inputs[key] = first[key]
+        return inputs
+
+    def _expand_image_inputs(self, inputs, batch):
+        """Expand the per-image inputs of one image over `batch` rows, as views."""
+        inputs["pixel_values"] = inputs["pixel_values"].expand(batch, *inputs["pixel_values"].shape[1:])
+
+    def generate_prompts(self, prompts, image_path, options=None):
+        """Generate responses for several prompts on one image.
+
+        The image is decoded and preprocessed once; the pixel tensor is shared
+        by every row of the batch and the vision tower runs on it only once.
+        """
+        image = self.load_image(image_path)
+        prompt_texts = [self._build_prompt(prompt) for prompt in prompts]
+
+        inputs = self._prepare_shared_inputs(image, prompt_texts)
+
+        for key in inputs:
+            inputs[key] = inputs[key].to(self.placement.device)
+
+        # Expand on the device so every row is a view of the same pixels
+        self._expand_image_inputs(inputs, len(prompts))
+
+        with shared_vision_features(self.model, "get_image_features"):
+            output = self._generate(inputs, options)
+
+        return self._decode(output, inputs)
+
+    # this code snippet follows Q-Bench
+    def process_output(self, embeds):
+        """Extract score from the first-step logits captured with `set_capture("scores")`."""
+        token_ids = self.token_ids(self.processor.tokenizer, ["good", "poor"])
+        return pair_probability(embeds["scores"][:, 0, :], token_ids)[0]
@@ -1,7 +1,9 @@
-from PIL import Image
 import torch
-from transformers import TextStreamer, AutoTokenizer
-from .base_model import BaseModel
+from PIL import Image
+from .base_model import BaseModel, pair_probability
+from .stopping import decoding_kwargs
+from .device import DevicePlacement
+from utils.tensor_cache import CachedImageProcessor, processor_identity
 
 
 # Usage
@@ -17,14 +19,18 @@ from .base_model import BaseModel
 
 # Import required mPLUG-Owl2 specific modules
 from mplug_owl2.constants import IMAGE_TOKEN_INDEX, DEFAULT_IMAGE_TOKEN
-from mplug_owl2.conversation import conv_templates, SeparatorStyle
+from mplug_owl2.conversation import conv_templates
 from mplug_owl2.model.builder import load_pretrained_model
 from mplug_owl2.mm_utils import process_images, tokenizer_image_token, get_model_name_from_path, KeywordsStoppingCriteria
 
 class MPLUGOwl2Model(BaseModel):
+    # The CLIP processor works at 448 x 448
+    decode_size = 448
+
     def __init__(self, model_config):
         """Initialize mPLUG-Owl2 model."""
         self.model_path = model_config["model_path"]
+        self.placement = DevicePlacement(model_config, dtype=torch.float16)
         
         # Load model and components
         model_name = get_model_name_from_path(self.model_path)
@@ -34,85 +40,132 @@ class MPLUGOwl2Model(BaseModel):
             model_name, 
             load_8bit=False, 
             load_4bit=False, 
-            device="cuda"
+            device=str(self.placement.device)
         )
+        # The builder always loads float16 weights
+        if self.placement.dtype != torch.float16:
+            self.model.to(dtype=self.placement.dtype)
         
-        # Initialize conversation template
-        self.conv = conv_templates["mplug_owl2"].copy()
-        self.roles = self.conv.roles
+        # Decoding settings shared by every generate call
+        self.generation_kwargs = {"do_sample": True, "temperature": 0.7, "max_new_tokens": 512}
     
     def generate(self, prompt, image_path):
         """Generate response using mPLUG-Owl2."""
-        # Load and process image
-        image = Image.open(image_path).convert('RGB')
-        max_edge = max(image.size)
-        image = image.resize((max_edge, max_edge))
-        
-        # Process image
-        image_tensor = process_images([image], self.image_processor)
-        image_tensor = image_tensor.to(self.model.device, dtype=torch.float16)
-        
-        # Format conversation
-        inp = DEFAULT_IMAGE_TOKEN + prompt
-        self.conv.append_message(self.conv.roles[0], inp)
-        self.conv.append_message(self.conv.roles[1], None)
-        prompt = self.conv.get_prompt()
-        
-        # Prepare inputs
-        input_ids = tokenizer_image_token(
-            prompt, 
-            self.tokenizer, 
-            IMAGE_TOKEN_INDEX, 
-            return_tensors='pt'
-        ).unsqueeze(0).to(self.model.device)
-        
-        # Setup stopping criteria
-        stop_str = self.conv.sep2
-        keywords = [stop_str]
-        stopping_criteria = KeywordsStoppingCriteria(keywords, self.tokenizer, input_ids)
-        
-        # Setup streamer
-        streamer = TextStreamer(self.tokenizer, skip_prompt=True, skip_special_tokens=True)
-        
-        # Generate response and get embeddings
-        with torch.inference_mode():
-            # First get the response
-            output_ids = self.model.generate(
-                input_ids,
-                images=image_tensor,
-                do_sample=True,
-                temperature=0.7,
-                max_new_tokens=512,
-                streamer=streamer,
-                use_cache=True,
-                stopping_criteria=[stopping_criteria]
-            )
-            
-            # Then get embeddings from forward pass
-            outputs = self.model(
-                input_ids=output_ids,
-                images=image_tensor,
-                output_hidden_states=True
+        responses, embeddings = self.generate_batch([prompt], [image_path])
+        return responses[0], embeddings[0]
+
+    def use_tensor_cache(self, cache):
+        """Serve the image processor's outputs from the tensor cache."""
+        identity = processor_identity(self.model_path, self.image_processor.to_dict())
+        self.image_processor = CachedImageProcessor(self.image_processor, cache, identity)
+
+    def _square_image(self, image_path):
+        """Decode an image and stretch it to a square.
+
+        The processor resizes the square to `decode_size` next, so the square
+        is never made larger than that; small images keep their longest edge.
+        """
+        image = self.load_image(image_path)
+        side = min(max(image.size), self.decode_size or max(image.size))
+        square = image.resize((side, side), Image.BICUBIC)
+        # The resize is deterministic, so the source hash still identifies the pixels
+        if "content_hash" in image.info:
+            square.info["content_hash"] = image.info["content_hash"]
+        return square
+
+    def prepare_batch(self, prompts, image_paths, options=None):
+        """Decode, preprocess and copy a batch to the model's device (runs in prefetch workers)."""
+        images = [self._square_image(image_path) for image_path in image_paths]
+
+        image_tensor = process_images(images, self.image_processor)
+        image_tensor = self.placement.move(image_tensor, dtype=self.placement.dtype)
+
+        return {"prompts": prompts, "image_tensor": image_tensor, "options": options}
+
+    def generate_prepared(self, prepared):
+        """Generate responses for a batch returned by `prepare_batch`."""
+        return self._generate_from_tensor(prepared["prompts"], prepared["image_tensor"], prepared["options"])
+
+    def score_prepared(self, prepared, token_pairs):
+        """Next-token probability of token_pairs[0] vs token_pairs[1] from one prefill pass.
+
+        mPLUG-Owl2 pads after splicing in the image tokens, so each sample
+        gets its own unpadded forward pass.
+        """
+        token_ids = self.token_ids(self.tokenizer, token_pairs)
+
+        scores = []
+        for i, prompt in enumerate(prepared["prompts"]):
+            conv = conv_templates["mplug_owl2"].copy()
+            conv.append_message(conv.roles[0], DEFAULT_IMAGE_TOKEN + prompt)
+            conv.append_message(conv.roles[1], None)
+            input_ids = tokenizer_image_token(
+                conv.get_prompt(), self.tokenizer, IMAGE_TOKEN_INDEX, return_tensors='pt'
+            ).unsqueeze(0).to(self.model.device)
+
+            with self.placement.inference():
+                logits = self.model(input_ids=input_ids, images=prepared["image_tensor"][i:i + 1]).logits[:, -1, :]
+            scores.extend(pair_probability(logits, token_ids))
+
+        return scores
+
+    def generate_batch(self, prompts, image_paths, options=None):
+        """Generate responses for a batch of prompts and images using mPLUG-Owl2."""
+        return self.generate_prepared(self.prepare_batch(prompts, image_paths, options))
+
+    def generate_prompts(self, prompts, image_path, options=None):
+        """Generate responses for several prompts on one image using mPLUG-Owl2.
+
+        The image is decoded and preprocessed once and every prompt runs on a
+        view of the same pixel tensor.
+        """
+        image_tensor = process_images([self._square_image(image_path)], self.image_processor)
+        image_tensor = image_tensor.to(self.model.device, dtype=self.placement.dtype)
+        image_tensor = image_tensor.expand(len(prompts), *image_tensor.shape[1:])
+
+        return self._generate_from_tensor(prompts, image_tensor, options)
+
+    def _generate_from_tensor(self, prompts, image_tensor, options=None):
+        """Generate for each prompt against its row of preprocessed image tensors.
+
+        mPLUG-Owl2 builds its attention mask while splicing in the image
+        tokens, and its keyword stopping criterion handles a single sequence,
+        so every sample gets its own unpadded generate call (as in
+        `score_prepared`). The batch still shares one decode and preprocessing
+        pass and one host-to-device copy.
+        """
+        responses, captured = [], []
+        for i, prompt in enumerate(prompts):
+            conv = conv_templates["mplug_owl2"].copy()
+            conv.append_message(conv.roles[0], DEFAULT_IMAGE_TOKEN + prompt)
+            conv.append_message(conv.roles[1], None)
+            input_ids = tokenizer_image_token(
+                conv.get_prompt(), self.tokenizer, IMAGE_TOKEN_INDEX, return_tensors='pt'
+            ).unsqueeze(0).to(self.model.device)
+
+            kwargs = decoding_kwargs(
+                self.generation_kwargs, [options[i]] if options else None, self.tokenizer, input_ids.shape[1]
             )
-            embeddings = outputs.hidden_states[-1]  # Get last hidden state
-        
-        # Get output text
-        response = self.tokenizer.decode(output_ids[0, input_ids.shape[1]:]).strip()
-        
-        # Reset conversation
-        self.conv = conv_templates["mplug_owl2"].copy()
-        
-        return response, embeddings
+            stopping_criteria = [KeywordsStoppingCriteria([conv.sep2], self.tokenizer, input_ids)]
+            stopping_criteria += kwargs.pop("stopping_criteria", [])
+
+            with self.placement.inference():
+                output_ids = self.model.generate(
+                    input_ids,
+                    images=image_tensor[i:i + 1],
+                    **kwargs,
+                    **self.generate_capture_kwargs(),
+                    use_cache=True,
+                    stopping_criteria=stopping_criteria
+                )
+            output_ids, sample_captured = self.unpack_generate_output(output_ids)
+
+            responses.append(self.tokenizer.decode(output_ids[0, input_ids.shape[1]:], skip_special_tokens=True).strip())
+            captured.extend(sample_captured)
+
+        return responses, captured
     
     def process_output(self, embeddings):
-        """Extract score from model output."""
-        # Get token IDs for "good" and "poor"
-        good_idx, poor_idx = self.tokenizer(["good", "poor"]).input_ids
-        
-        # Get logits from the last position
-        output_logits = self.model(input_embeds=embeddings).logits[0, -1]
-        
-        # Calculate prediction score
-        q_pred = (output_logits[[good_idx, poor_idx]] / 100).softmax(0)[0]
-        
-        return float(q_pred) 
\ No newline at end of file
+        """Extract score from the first-step logits captured with `set_capture("scores")`."""
+        token_ids = self.token_ids(self.tokenizer, ["good", "poor"])
+        return pair_probability(embeddings["scores"][:, 0, :], token_ids)[0]
@@ -0,0 +1,324 @@
+"""
+Model Server
+------------
+Long-lived local process that keeps models loaded and runs scoring jobs for
+`experiment.py` runs over a Unix socket, so short prompt-iteration runs
+attach to warm models instead of paying `from_pretrained` every time.
+
+    python -m models.server start [--models llava-v1.6-vicuna-7b,...]
+    python -m models.server status
+    python -m models.server stop
+
+Jobs refer to images by path, so the server must see the same files as
+the client. Clients send their own model config, and a model is loaded
+once per distinct config. Messages are pickled; the socket is only usable by the owner
+and connections are authenticated with a key only the owner can read.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import secrets
+import signal
+import threading
+from contextlib import contextmanager
+from multiprocessing.connection import Client, Listener
+
+import torch
+
+from config.experiment import experiment
+from config.models import models
+from .lifecycle import ModelLifecycle, current_rss
+
+
+def _key_path(socket_path):
+    return f"{socket_path}.key"
+
+
+def _to_cpu(value):
+    """Move captured tensors to the host so they can be sent back."""
+    if isinstance(value, torch.Tensor):
+        return value.cpu()
+    if isinstance(value, dict):
+        return {name: _to_cpu(item) for name, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return type(value)(_to_cpu(item) for item in value)
+    return value
+
+
+def model_key(model_config):
+    """Name a loaded model by its `model_name` and a digest of its whole config."""
+    digest = hashlib.sha1(json.dumps(model_config, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+    return f"{model_config['model_name']}@{digest[:8]}"
+
+
+class ModelServer:
+    """Serves the models of `MODEL_REGISTRY` by config, loading them on first use.
+
+    Each connection is handled in its own thread; model calls are serialized
+    by one lock since they share the device.
+    """
+
+    JOBS = ("generate_batch", "generate_prompts", "score_batch")
+
+    def __init__(self, socket_path):
+        self.socket_path = socket_path
+        self.lifecycles = {}
+        self.instances = {}
+        self._lock = threading.Lock()
+        self._listener = None
+        self._authkey = None
+        self._stopping = threading.Event()
+
+    def load(self, model_config):
+        """Load a model for `model_config` unless it is loaded already; returns its key."""
+        key = model_key(model_config)
+        with self._lock:
+            if key in self.instances:
+                return key
+            lifecycle = ModelLifecycle(model_config)
+            instance = lifecycle.__enter__()
+            if experiment["tensor_cache_dir"]:
+                from utils.tensor_cache import TensorCache
+                instance.use_tensor_cache(
+                    TensorCache(experiment["tensor_cache_dir"], experiment["tensor_cache_max_gb"] * 1024 ** 3)
+                )
+            self.lifecycles[key] = lifecycle
+            self.instances[key] = instance
+            print(f"Loaded {key} in {lifecycle.report['load_seconds']:.1f}s")
+        return key
+
+    def unload(self, key):
+        with self._lock:
+            if key in self.instances:
+                del self.instances[key]
+                self.lifecycles.pop(key).__exit__(None, None, None)
+
+    def status(self):
+        """Loaded models with their weight and load-time memory, and process totals."""
+        loaded = {}
+        for key, instance in self.instances.items():
+            weights = sum(p.numel() * p.element_size() for p in instance.model.parameters())
+            report = self.lifecycles[key].report
+            loaded[key] = {
+                "model_path": instance.model_path,
+                "generation_kwargs": instance.generation_kwargs,
+                "weight_bytes": weights,
+                "load_seconds": report["load_seconds"],
+                "rss_added_by_load": report["rss_after_load"] - report["rss_before_load"],
+                "device_after_load": report.get("device_after_load"),
+            }
+        status = {"pid": os.getpid(), "models": loaded, "rss": current_rss()}
+        if torch.cuda.is_available():
+            status["device_allocated"] = torch.cuda.memory_allocated()
+            status["device_reserved"] = torch.cuda.memory_reserved()
+        return status
+
+    def _handle(self, request):
+        op = request["op"]
+        if op == "load":
+            instance = self.instances[self.load(request["model"])]
+            return {
+                "model_path": instance.model_path,
+                "generation_kwargs": instance.generation_kwargs,
+                "decode_size": instance.decode_size,
+            }
+        if op == "unload":
+            self.unload(model_key(request["model"]))
+            return None
+        if op == "status":
+            return self.status()
+        if op == "stop":
+            self.stop()
+            return None
+        if op in self.JOBS:
+            key = self.load(request["model"])
+            with self._lock, torch.inference_mode():
+                result = getattr(self.instances[key], op)(*request["args"])
+            return _to_cpu(result)
+        raise ValueError(f"Unknown operation: {op}")
+
+    def _serve_connection(self, conn):
+        with conn:
+            while not self._stopping.is_set():
+                try:
+                    request = conn.recv()
+                except (EOFError, OSError):
+                    return
+                try:
+                    conn.send({"ok": True, "result": self._handle(request)})
+                except Exception as e:
+                    conn.send({"ok": False, "error": f"{type(e).__name__}: {str(e)}"})
+
+    def serve_forever(self, preload=()):
+        os.makedirs(os.path.dirname(self.socket_path) or ".", exist_ok=True)
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+        self._authkey = secrets.token_bytes(32)
+        fd = os.open(_key_path(self.socket_path), os.O_CREAT | os.O_TRUNC | os.O_WRONLY, 0o600)
+        with os.fdopen(fd, "wb") as f:
+            f.write(self._authkey)
+
+        for model_name in preload:
+            # Preloaded models use the server's configs; clients with the same config share them
+            model_config = next((config for config in models.values() if config["model_name"] == model_name), None)
+            if model_config is None:
+                raise ValueError(f"Unknown model: {model_name}")
+            self.load(model_config)
+
+        self._listener = Listener(self.socket_path, family="AF_UNIX", authkey=self._authkey)
+        os.chmod(self.socket_path, 0o600)
+        # The handler interrupts accept() on the main thread, so it must not connect from there
+        signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=self.stop).start())
+        print(f"Model server listening on {self.socket_path} (pid {os.getpid()})")
+        try:
+            while True:
+                conn = self._listener.accept()
+                if self._stopping.is_set():
+                    conn.close()
+                    break
+                threading.Thread(target=self._serve_connection, args=(conn,), daemon=True).start()
+        finally:
+            self._listener.close()
+            self.shutdown()
+
+    def stop(self):
+        """Stop accepting jobs; `serve_forever` then unloads every model."""
+        self._stopping.set()
+        # Wake up the blocking accept() with a connection of our own
+        try:
+            Client(self.socket_path, family="AF_UNIX", authkey=self._authkey).close()
+        except (OSError, EOFError):
+            pass
+
+    def shutdown(self):
+        for key in list(self.instances):
+            self.unload(key)
+        for path in (self.socket_path, _key_path(self.socket_path)):
+            if os.path.exists(path):
+                os.remove(path)
+        print("Model server stopped")
+
+
+class ModelServerClient:
+    """Connection to a running model server."""
+
+    def __init__(self, socket_path):
+        with open(_key_path(socket_path), "rb") as f:
+            authkey = f.read()
+        self._conn = Client(socket_path, family="AF_UNIX", authkey=authkey)
+        self._lock = threading.Lock()
+
+    def request(self, op, **fields):
+        with self._lock:
+            self._conn.send(dict(fields, op=op))
+            reply = self._conn.recv()
+        if not reply["ok"]:
+            raise RuntimeError(f"Model server: {reply['error']}")
+        return reply["result"]
+
+    @contextmanager
+    def model(self, model_config):
+        """Use a warm model on the server as a drop-in for a local adapter.
+
+        The server loads the model from this `model_config`, so placement and
+        decoding settings are the client's. The model stays loaded on the
+        server after the block exits.
+        """
+        info = self.request("load", model=model_config)
+        yield RemoteModel(self, model_config, info)
+
+    def close(self):
+        self._conn.close()
+
+
+def connect(socket_path):
+    """Client of the model server at `socket_path`, or None if none is running."""
+    if not socket_path or not os.path.exists(socket_path):
+        return None
+    try:
+        return ModelServerClient(socket_path)
+    except (OSError, EOFError):
+        return None
+
+
+class RemoteModel:
+    """Driver-facing side of a model running in the model server.
+
+    Implements the adapter methods `run_experiment` uses. Images travel as
+    paths and are decoded by the server, so `load_image` and `prepare_batch`
+    do no work on the client.
+    """
+
+    def __init__(self, client, model_config, info):
+        self.client = client
+        self.model_config = model_config
+        self.model_path = info["model_path"]
+        self.generation_kwargs = info["generation_kwargs"]
+        self.decode_size = info["decode_size"]
+        self.content_hashes = {}
+
+    def _job(self, op, *args):
+        return self.client.request(op, model=self.model_config, args=args)
+
+    def load_image(self, image_path):
+        return image_path
+
+    def use_content_hashes(self, hashes):
+        # Only for the response-cache lookups on the client; the server hashes what it decodes
+        self.content_hashes = {**self.content_hashes, **hashes}
+
+    def use_tensor_cache(self, cache):
+        pass
+
+    def prepare_batch(self, prompts, image_paths, options=None):
+        return {"prompts": prompts, "image_paths": image_paths, "options": options}
+
+    def generate_prepared(self, prepared):
+        return self._job("generate_batch", prepared["prompts"], prepared["image_paths"], prepared["options"])
+
+    def score_prepared(self, prepared, token_pairs):
+        return self._job("score_batch", prepared["prompts"], prepared["image_paths"], token_pairs)
+
+    def generate_batch(self, prompts, image_paths, options=None):
+        return self._job("generate_batch", prompts, image_paths, options)
+
+    def generate_prompts(self, prompts, image_path, options=None):
+        return self._job("generate_prompts", prompts, image_path, options)
+
+    def score_batch(self, prompts, image_paths, token_pairs):
+        return self._job("score_batch", prompts, image_paths, token_pairs)
+
+
+def _print_status(status):
+    gb = 1024 ** 3
+    print(f"Model server pid {status['pid']}: RSS {status['rss'] / gb:.2f} GB"
+          + (f", device {status['device_allocated'] / gb:.2f} GB allocated / "
+             f"{status['device_reserved'] / gb:.2f} GB reserved" if "device_allocated" in status else ""))
+    for key, info in status["models"].items():
+        print(f"  {key}: weights {info['weight_bytes'] / gb:.2f} GB, "
+              f"+{info['rss_added_by_load'] / gb:.2f} GB RSS at load, loaded in {info['load_seconds']:.1f}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Keep models loaded for experiment.py runs.")
+    parser.add_argument("command", choices=["start", "status", "stop"])
+    parser.add_argument("--socket", default=experiment["model_server_socket"])
+    parser.add_argument("--models", default="",
+                        help="comma-separated model names to load at start (default: on first use)")
+    args = parser.parse_args()
+
+    if args.command == "start":
+        ModelServer(args.socket).serve_forever([name for name in args.models.split(",") if name])
+    else:
+        client = connect(args.socket)
+        if client is None:
+            parser.exit(1, f"No model server running at {args.socket}\n")
+        if args.command == "status":
+            _print_status(client.request("status"))
+        else:
+            client.request("stop")
+            print("Stop requested")
+        client.close()
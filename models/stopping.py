@@ -0,0 +1,90 @@
+import re
+
+import torch
+from transformers import StoppingCriteria
+
+from .constraints import ConstrainedOutputLogitsProcessor, make_constraint
+
+
+class PromptStoppingCriteria(StoppingCriteria):
+    """Stops each sequence of a batch on its own prompt's conditions.
+
+    A row is finished once its generated text matches the prompt's
+    extraction regex, once it has produced `max_new_tokens` tokens, or once
+    its answer grammar (see `models.constraints`) is complete. The
+    regex only counts once the match is followed by more text, so a number
+    like "Score: 8" is not cut off before the "5" of "85". Finished rows are
+    not decoded again.
+    """
+
+    def __init__(self, tokenizer, prompt_length, patterns, max_new_tokens, constraints=None):
+        self.tokenizer = tokenizer
+        self.prompt_length = prompt_length
+        self.patterns = [re.compile(pattern) if pattern else None for pattern in patterns]
+        self.max_new_tokens = max_new_tokens
+        self.constraints = constraints or [None] * len(patterns)
+        self.done = None
+
+    def _row_finished(self, i, generated):
+        budget = self.max_new_tokens[i]
+        if budget is not None and generated.shape[0] >= budget:
+            return True
+        if self.constraints[i] is not None:
+            return generated.shape[0] > 0 and self.constraints[i].finished(generated)
+        if self.patterns[i] is None:
+            return False
+        text = self.tokenizer.decode(generated, skip_special_tokens=True)
+        match = self.patterns[i].search(text)
+        return match is not None and match.end() < len(text)
+
+    def __call__(self, input_ids, scores, **kwargs):
+        if self.done is None:
+            self.done = torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+        generated = input_ids[:, self.prompt_length:]
+        for i in range(input_ids.shape[0]):
+            if not self.done[i] and self._row_finished(i, generated[i]):
+                self.done[i] = True
+        return self.done.clone()
+
+
+def decoding_kwargs(generation_kwargs, options, tokenizer, prompt_length):
+    """Merge an adapter's generation_kwargs with per-row prompt options.
+
+    `options` holds one dict per row with optional "regex_pattern",
+    "max_new_tokens" and "constrained_output" keys (see
+    `config.prompts.get_generation_options`). Constrained rows are masked to
+    their answer grammar and budgeted to its longest answer plus EOS. A
+    prompt budget never exceeds the adapter's own limit (`max_new_tokens`,
+    or `max_length` minus the prompt), and rows without one decode up to
+    that limit. The batch decodes up to the largest budget; the stopping
+    criteria end every row at its own budget, regex match or complete answer.
+    """
+    kwargs = dict(generation_kwargs)
+    if not options:
+        return kwargs
+
+    limit = kwargs.get("max_new_tokens")
+    if limit is None and kwargs.get("max_length") is not None:
+        limit = max(1, kwargs["max_length"] - prompt_length)
+    budgets = [option.get("max_new_tokens", limit) for option in options]
+    if limit is not None:
+        budgets = [limit if budget is None else min(budget, limit) for budget in budgets]
+    patterns = [option.get("regex_pattern") for option in options]
+    constraints = [
+        make_constraint(tokenizer, option["constrained_output"]) if option.get("constrained_output") else None
+        for option in options
+    ]
+    for i, constraint in enumerate(constraints):
+        if constraint is not None:
+            budgets[i] = min(budgets[i] or constraint.max_length + 1, constraint.max_length + 1)
+
+    if all(budget is not None for budget in budgets):
+        kwargs.pop("max_length", None)
+        kwargs["max_new_tokens"] = max(budgets)
+
+    if any(constraints):
+        kwargs["logits_processor"] = [ConstrainedOutputLogitsProcessor(constraints, prompt_length)]
+
+    if any(patterns) or any(budget is not None for budget in budgets):
+        kwargs["stopping_criteria"] = [PromptStoppingCriteria(tokenizer, prompt_length, patterns, budgets, constraints)]
+    return kwargs
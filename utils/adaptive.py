@@ -0,0 +1,137 @@
+"""
+Adaptive Screening
+------------------
+Stops scoring a (model, dataset, prompt) cell as soon as more images would
+not change the conclusion. Images are scored in a random order, and after
+every batch (or image, in image-major order) the SRCC and PLCC of each cell
+against the MOS are updated with Fisher-z confidence intervals. A cell stops
+when
+
+- "converged": both intervals are narrower than `tolerance`, or
+- "dominated": its SRCC interval lies wholly below the SRCC interval of
+  another prompt of the same model and dataset.
+
+Correlations are signed, so a prompt whose scores fall as quality rises
+counts as worse. The dataset's `sample_size` caps the images of every cell;
+see "adaptive" in config/experiment.py.
+"""
+
+import math
+import random
+from statistics import NormalDist
+
+import numpy as np
+
+from utils.evaluation import _as_float, pearson_rows, rank_rows
+
+
+def screening_order(samples, seed=0):
+    """The samples in a random order that is the same for every run with `seed`."""
+    order = list(samples)
+    random.Random(seed).shuffle(order)
+    return order
+
+
+def fisher_interval(r, n, confidence=0.95, spearman=False):
+    """Confidence interval of a correlation from its Fisher z-transform.
+
+    SRCC uses the Bonett-Wright variance (1 + r^2 / 2) / (n - 3).
+    """
+    if n <= 3 or math.isnan(r):
+        return -1.0, 1.0
+    r = min(max(r, -0.999999), 0.999999)
+    variance = (1 + r * r / 2 if spearman else 1) / (n - 3)
+    half_width = NormalDist().inv_cdf((1 + confidence) / 2) * math.sqrt(variance)
+    z = math.atanh(r)
+    return math.tanh(z - half_width), math.tanh(z + half_width)
+
+
+class CellEstimate:
+    """Scores of one cell paired with the MOS of their images."""
+
+    def __init__(self):
+        self.scores = {}
+        self.stop_reason = None
+
+    def estimate(self, mos, confidence):
+        """{"n", "srcc", "srcc_low", "srcc_high", "plcc", "plcc_low", "plcc_high"} of the cell so far."""
+        pairs = [(score, mos.get(image_id)) for image_id, score in self.scores.items()]
+        pairs = np.array([pair for pair in pairs if pair[1] is not None and not math.isnan(pair[0])],
+                         dtype=np.float64).reshape(-1, 2)
+        n = len(pairs)
+        row = {"n": n}
+        if n > 3:
+            predictions, targets = pairs[:, 0], pairs[:, 1]
+            row["plcc"] = float(pearson_rows(predictions, targets))
+            row["srcc"] = float(pearson_rows(rank_rows(predictions), rank_rows(targets)))
+        else:
+            row["plcc"] = row["srcc"] = float("nan")
+        for metric in ("plcc", "srcc"):
+            row[f"{metric}_low"], row[f"{metric}_high"] = fisher_interval(
+                row[metric], n, confidence, spearman=metric == "srcc"
+            )
+        return row
+
+
+class AdaptiveScreening:
+    """Online stopping rule for the prompts of one (model, dataset).
+
+    Scores are added per consumer prompt through `add`; the runners ask
+    `is_done` for the task they run (the first version of a prompt group,
+    see `utils.planner.group_prompts`), which is done once every consumer
+    has stopped. A stage whose output is not a score runs as long as a
+    prompt reading it does.
+    """
+
+    def __init__(self, mos, active_prompts, prompt_groups=None, dependencies=None,
+                 tolerance=0.1, confidence=0.95, min_samples=30):
+        self.mos = mos
+        self.confidence = confidence
+        self.tolerance = tolerance
+        self.min_samples = min_samples
+        self.prompt_groups = prompt_groups or {name: [name] for name in active_prompts}
+        self.dependencies = dependencies or {}
+        self.cells = {
+            name: CellEstimate() for name, config in active_prompts.items()
+            if config.get("output_type", "score") == "score"
+        }
+
+    def add(self, prompt_name, image_id, score):
+        cell = self.cells.get(prompt_name)
+        if cell is not None and cell.stop_reason is None:
+            cell.scores[image_id] = _as_float(score)
+
+    def update(self):
+        """Re-estimate every running cell and stop the ones that are settled."""
+        estimates = {name: cell.estimate(self.mos, self.confidence) for name, cell in self.cells.items()}
+        for name, cell in self.cells.items():
+            row = estimates[name]
+            if cell.stop_reason is not None or row["n"] < self.min_samples:
+                continue
+            if all(row[f"{metric}_high"] - row[f"{metric}_low"] < self.tolerance for metric in ("plcc", "srcc")):
+                cell.stop_reason = "converged"
+                continue
+            leaders = [
+                (other["srcc_low"], other_name) for other_name, other in estimates.items()
+                if other_name != name and other["n"] >= self.min_samples
+            ]
+            if leaders and max(leaders)[0] > row["srcc_high"]:
+                cell.stop_reason = f"dominated by {max(leaders)[1]}"
+        return estimates
+
+    def is_done(self, task_name):
+        """Whether the task (a prompt group or a chain stage) needs no more images."""
+        consumers = self.prompt_groups.get(task_name, [task_name])
+        scored = [name for name in consumers if name in self.cells]
+        if len(scored) < len(consumers):
+            # A stage feeding later prompts: needed while any of them runs
+            readers = [name for name, producer in self.dependencies.items() if producer == task_name]
+            return bool(readers) and all(self.is_done(name) for name in readers)
+        return all(self.cells[name].stop_reason is not None for name in scored)
+
+    def summary(self):
+        """Print the estimate and the stopping reason of every cell."""
+        for name, row in self.update().items():
+            reason = self.cells[name].stop_reason or "sample exhausted"
+            print(f"  {name}: n={row['n']}, SRCC {row['srcc']:.3f} [{row['srcc_low']:.3f}, {row['srcc_high']:.3f}], "
+                  f"PLCC {row['plcc']:.3f} [{row['plcc_low']:.3f}, {row['plcc_high']:.3f}] ({reason})")
@@ -0,0 +1,346 @@
+"""
+Correlation Evaluation
+----------------------
+Scores a results file against the MOS of each dataset: PLCC, SRCC and KRCC
+per (model, dataset, prompt) cell, with bootstrap confidence intervals.
+
+    python -m utils.evaluation results/journal_<timestamp>.jsonl [--resamples 1000] [--csv out.csv]
+
+Parquet results files are read as well. MOS files ("image_name value" per
+line, see `mos_path` in config/datasets.py) are parsed once into an index
+and aligned with the image ids of the results. The cells of a dataset that
+scored the same images are stacked into one matrix, so every correlation
+and every bootstrap resample is computed for all of them at once. The
+resamples are shared by those cells (paired bootstrap), so their intervals
+can be compared directly.
+"""
+
+import argparse
+import csv
+import functools
+import os
+
+import numpy as np
+
+from config.datasets import datasets
+from config.models import models
+from utils.journal import load_journal
+
+METRICS = ("plcc", "srcc", "krcc")
+
+# Upper bound on the elements of one block of pairwise comparisons
+_BLOCK_ELEMENTS = 1 << 24
+
+
+class MOSIndex:
+    """MOS values of one dataset, indexed by image name."""
+
+    def __init__(self, path):
+        names, values = [], []
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) == 2:
+                    names.append(parts[0])
+                    values.append(float(parts[1]))
+        self.path = path
+        self.names = names
+        self.values = np.asarray(values, dtype=np.float64)
+        self._positions = {name: i for i, name in enumerate(names)}
+
+    def __len__(self):
+        return len(self.names)
+
+    def get(self, image_name, default=None):
+        position = self._positions.get(image_name)
+        return default if position is None else float(self.values[position])
+
+    def align(self, image_ids):
+        """MOS of every image id as an array; NaN where the image has no MOS."""
+        positions = np.fromiter((self._positions.get(image_id, -1) for image_id in image_ids),
+                                dtype=np.int64, count=len(image_ids))
+        aligned = self.values[np.maximum(positions, 0)] if len(self) else np.zeros(len(image_ids))
+        aligned[positions < 0] = np.nan
+        return aligned
+
+
+@functools.lru_cache(maxsize=None)
+def load_mos(path):
+    """The MOS index of a file, parsed once per process."""
+    return MOSIndex(path)
+
+
+def load_results(path):
+    """Read a journal (.jsonl) or Parquet results file as
+    {(model, dataset, prompt): (image_ids, scores)} with non-numeric scores as NaN."""
+    cells = {}
+    if path.endswith(".parquet"):
+        import pyarrow.parquet as pq
+        table = pq.read_table(path, columns=["model_name", "dataset", "prompt", "image_id", "score_value"])
+        columns = {name: table.column(name).to_pylist() for name in table.column_names}
+        rows = zip(columns["model_name"], columns["dataset"], columns["prompt"],
+                   columns["image_id"], columns["score_value"])
+        grouped = {}
+        for model, dataset, prompt, image_id, score in rows:
+            grouped.setdefault((model, dataset, prompt), {})[image_id] = score
+    else:
+        grouped = {
+            # Journals record the config key; report the model name like the Parquet files
+            (models[model]["model_name"] if model in models else model, dataset, prompt):
+                {image_id: score for image_id, (score, _) in entries.items()}
+            for (model, dataset, prompt), entries in load_journal(path).items()
+        }
+
+    for cell, entries in grouped.items():
+        image_ids = sorted(entries)
+        cells[cell] = (image_ids, np.array([_as_float(entries[image_id]) for image_id in image_ids]))
+    return cells
+
+
+def _as_float(score):
+    try:
+        return float(score)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def pearson_rows(x, y):
+    """Pearson correlation along the last axis (x and y broadcast); NaN for constant rows."""
+    x = x - x.mean(axis=-1, keepdims=True)
+    y = y - y.mean(axis=-1, keepdims=True)
+    denominator = np.sqrt((x * x).sum(axis=-1) * (y * y).sum(axis=-1))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(denominator > 0, (x * y).sum(axis=-1) / denominator, np.nan)
+
+
+def rank_rows(x):
+    """Ranks along the last axis, ties getting their average rank (1-based)."""
+    n = x.shape[-1]
+    order = np.argsort(x, axis=-1, kind="stable")
+    ordered = np.take_along_axis(x, order, axis=-1)
+    positions = np.broadcast_to(np.arange(n), x.shape)
+
+    # First and last sorted position of every run of equal values
+    starts = np.ones(x.shape, dtype=bool)
+    starts[..., 1:] = ordered[..., 1:] != ordered[..., :-1]
+    ends = np.ones(x.shape, dtype=bool)
+    ends[..., :-1] = starts[..., 1:]
+    first = np.maximum.accumulate(np.where(starts, positions, 0), axis=-1)
+    last = np.flip(np.minimum.accumulate(np.flip(np.where(ends, positions, n - 1), axis=-1), axis=-1), axis=-1)
+
+    ranks = np.empty(x.shape, dtype=np.float64)
+    np.put_along_axis(ranks, order, (first + last) / 2 + 1, axis=-1)
+    return ranks
+
+
+def kendall_rows(x, y):
+    """Kendall's tau-b along the last axis (x and y broadcast); NaN for constant rows.
+
+    Pairwise signs are taken on integer ranks and accumulated over blocks of
+    the first index, so memory stays bounded for long rows and many
+    resamples. Signs of `y` are computed at its own shape and broadcast,
+    which matters when one MOS resample is shared by many prediction rows.
+    """
+    return _kendall_from_ranks(rank_rows(x), rank_rows(y))
+
+
+def _kendall_from_ranks(x, y):
+    n = x.shape[-1]
+    shape = np.broadcast_shapes(x.shape, y.shape)[:-1]
+    rows = int(np.prod(shape))
+    block = max(1, _BLOCK_ELEMENTS // max(1, rows * n))
+    # Doubled average ranks are integers and compare like the values
+    x = (2 * x).astype(np.int32)
+    y = (2 * y).astype(np.int32)
+
+    concordance = np.zeros(shape, dtype=np.int64)
+    x_ties = np.zeros(x.shape[:-1], dtype=np.int64)
+    y_ties = np.zeros(y.shape[:-1], dtype=np.int64)
+    for start in range(0, n, block):
+        stop = min(n, start + block)
+        dx = np.sign(x[..., start:stop, None] - x[..., None, :]).astype(np.int8)
+        dy = np.sign(y[..., start:stop, None] - y[..., None, :]).astype(np.int8)
+        concordance += (dx * dy).sum(axis=(-2, -1), dtype=np.int64)
+        x_ties += (dx == 0).sum(axis=(-2, -1), dtype=np.int64)
+        y_ties += (dy == 0).sum(axis=(-2, -1), dtype=np.int64)
+
+    # Every pair was counted in both orders, and every element tied with itself
+    pairs = n * (n - 1) / 2
+    denominator = np.sqrt((pairs - (x_ties - n) / 2) * (pairs - (y_ties - n) / 2))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(denominator > 0, concordance / 2 / denominator, np.nan)
+
+
+def correlations(predictions, mos):
+    """PLCC, SRCC and KRCC of every row of `predictions` (..., n) against `mos` (..., n)."""
+    prediction_ranks, mos_ranks = rank_rows(predictions), rank_rows(mos)
+    return {
+        "plcc": pearson_rows(predictions, mos),
+        "srcc": pearson_rows(prediction_ranks, mos_ranks),
+        "krcc": _kendall_from_ranks(prediction_ranks, mos_ranks),
+    }
+
+
+def _weighted_pearson(x, y, weights):
+    """Pearson correlation along the last axis with per-element weights (counts)."""
+    total = weights.sum(axis=-1, keepdims=True)
+    x = x - (weights * x).sum(axis=-1, keepdims=True) / total
+    y = y - (weights * y).sum(axis=-1, keepdims=True) / total
+    denominator = np.sqrt((weights * x * x).sum(axis=-1) * (weights * y * y).sum(axis=-1))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(denominator > 1e-12, (weights * x * y).sum(axis=-1) / denominator, np.nan)
+
+
+def _column_blocks(n):
+    block = max(1, _BLOCK_ELEMENTS // max(1, 4 * n))
+    return [slice(start, min(n, start + block)) for start in range(0, n, block)]
+
+
+def _resampled_ranks(values, counts):
+    """Average rank of every original element within every resample, (R, n)."""
+    ranks = np.empty(counts.shape)
+    for block in _column_blocks(len(values)):
+        below = (values[:, None] < values[None, block]).astype(np.float64)
+        tied = (values[:, None] == values[None, block]).astype(np.float64)
+        ranks[:, block] = counts @ below + (counts @ tied + 1) / 2
+    return ranks
+
+
+def _resampled_kendall(predictions, mos, counts):
+    """Kendall's tau-b of every row of (G, n) `predictions` in every resample, (G, R).
+
+    Ordered pairs of draws are counted as count_i * count_j per pair of
+    original elements, so each statistic is a quadratic form of the counts.
+    """
+    n = predictions.shape[-1]
+    concordance = np.zeros((len(predictions), len(counts)))
+    x_ties = np.zeros((len(predictions), len(counts)))
+    y_ties = np.zeros(len(counts))
+    for block in _column_blocks(n):
+        block_counts = counts[:, block]
+        dy = np.sign(mos[:, None] - mos[None, block])
+        y_ties += ((counts @ (dy == 0)) * block_counts).sum(axis=-1)
+        for g, values in enumerate(predictions):
+            dx = np.sign(values[:, None] - values[None, block])
+            concordance[g] += ((counts @ (dx * dy)) * block_counts).sum(axis=-1)
+            x_ties[g] += ((counts @ (dx == 0)) * block_counts).sum(axis=-1)
+
+    # Same correction as `_kendall_from_ranks`: n draws, each tied with itself
+    pairs = n * (n - 1) / 2
+    denominator = np.sqrt((pairs - (x_ties - n) / 2) * (pairs - (y_ties - n) / 2))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(denominator > 0, concordance / 2 / denominator, np.nan)
+
+
+def bootstrap_intervals(predictions, mos, num_resamples=1000, confidence=0.95, seed=0):
+    """Percentile bootstrap intervals of the correlations of (G, n) `predictions`.
+
+    All resamples are drawn at once as a (num_resamples, n) matrix of how
+    often each image is drawn, shared by the G rows. Every statistic of a
+    resample is then a count-weighted sum, computed for all resamples with
+    matrix products against comparisons of the original sample; nothing is
+    gathered or re-sorted per resample. Returns {metric: (low, high)} with
+    arrays of shape (G,).
+    """
+    n = predictions.shape[-1]
+    counts = np.random.default_rng(seed).multinomial(n, np.full(n, 1 / n), size=num_resamples).astype(np.float64)
+
+    mos_ranks = _resampled_ranks(mos, counts)
+    prediction_ranks = np.stack([_resampled_ranks(values, counts) for values in predictions])
+    resampled = {
+        "plcc": _weighted_pearson(predictions[:, None, :], mos, counts),
+        "srcc": _weighted_pearson(prediction_ranks, mos_ranks, counts),
+        "krcc": _resampled_kendall(predictions, mos, counts),
+    }
+
+    tail = (1 - confidence) / 2 * 100
+    intervals = {}
+    for metric, values in resampled.items():
+        with np.errstate(invalid="ignore"):
+            low, high = np.nanpercentile(values, [tail, 100 - tail], axis=-1)
+        intervals[metric] = (low, high)
+    return intervals
+
+
+def evaluate(cells, mos_paths, num_resamples=1000, confidence=0.95, seed=0):
+    """Correlation rows for every cell whose dataset has a MOS file.
+
+    Images without a MOS or without a numeric score are left out of their
+    cell; cells of a dataset left with the same images are evaluated together.
+    """
+    stacks = {}
+    for (model, dataset, prompt), (image_ids, scores) in cells.items():
+        if dataset not in mos_paths:
+            continue
+        mos = load_mos(mos_paths[dataset]).align(image_ids)
+        valid = ~(np.isnan(mos) | np.isnan(scores))
+        kept_ids = tuple(image_id for image_id, keep in zip(image_ids, valid) if keep)
+        entry = stacks.setdefault((dataset, kept_ids), {"mos": mos[valid], "cells": [], "scores": []})
+        entry["cells"].append((model, dataset, prompt))
+        entry["scores"].append(scores[valid])
+
+    rows = []
+    for (dataset, kept_ids), entry in stacks.items():
+        predictions = np.stack(entry["scores"])
+        n = len(kept_ids)
+        if n < 3:
+            point = {metric: np.full(len(entry["cells"]), np.nan) for metric in METRICS}
+            intervals = {metric: (point[metric], point[metric]) for metric in METRICS}
+        else:
+            point = correlations(predictions, entry["mos"])
+            intervals = bootstrap_intervals(predictions, entry["mos"], num_resamples, confidence, seed)
+
+        for g, (model, dataset, prompt) in enumerate(entry["cells"]):
+            row = {"model": model, "dataset": dataset, "prompt": prompt, "n": n}
+            for metric in METRICS:
+                row[metric] = float(point[metric][g])
+                row[f"{metric}_low"] = float(intervals[metric][0][g])
+                row[f"{metric}_high"] = float(intervals[metric][1][g])
+            rows.append(row)
+
+    rows.sort(key=lambda row: (row["model"], row["dataset"], row["prompt"]))
+    return rows
+
+
+def configured_mos_paths():
+    """MOS file of every configured dataset that has one."""
+    return {name: config["mos_path"] for name, config in datasets.items() if config.get("mos_path")}
+
+
+def print_rows(rows):
+    for row in rows:
+        metrics = "  ".join(
+            f"{metric.upper()} {row[metric]:+.3f} [{row[f'{metric}_low']:+.3f}, {row[f'{metric}_high']:+.3f}]"
+            for metric in METRICS
+        )
+        print(f"{row['model']} / {row['dataset']} / {row['prompt']} (n={row['n']}): {metrics}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Correlate experiment results with MOS.")
+    parser.add_argument("results", nargs="+", help="journal (.jsonl) or Parquet results files")
+    parser.add_argument("--mos", action="append", default=[], metavar="DATASET=PATH",
+                        help="MOS file of a dataset (default: mos_path in config/datasets.py)")
+    parser.add_argument("--resamples", type=int, default=1000)
+    parser.add_argument("--confidence", type=float, default=0.95)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--csv", default=None, help="also write the rows to this CSV file")
+    args = parser.parse_args()
+
+    mos_paths = configured_mos_paths()
+    mos_paths.update(value.split("=", 1) for value in args.mos)
+
+    cells = {}
+    for path in args.results:
+        cells.update(load_results(path))
+    rows = evaluate(cells, mos_paths, args.resamples, args.confidence, args.seed)
+    print_rows(rows)
+
+    if args.csv:
+        if os.path.dirname(args.csv):
+            os.makedirs(os.path.dirname(args.csv), exist_ok=True)
+        with open(args.csv, "w", newline="", encoding="utf-8") as f:
+            writer = csv.DictWriter(f, fieldnames=["model", "dataset", "prompt", "n"]
+                                    + [f"{metric}{suffix}" for metric in METRICS for suffix in ("", "_low", "_high")])
+            writer.writeheader()
+            writer.writerows(rows)
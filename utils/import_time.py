@@ -0,0 +1,96 @@
+"""
+Import-Time Benchmark
+---------------------
+Measures the startup cost of the entry points in fresh interpreters, so
+listing models, dry-running the planner or loading analysis code can be
+checked against regressions from eager heavy imports.
+
+    python -m utils.import_time [--repeat 5] [--top 10] [--adapters]
+
+Each target is imported `repeat` times in a new process; the median wall
+time is reported together with the slowest modules (cumulative, from
+`python -X importtime`) of the last run. `--adapters` also times importing
+each registered model adapter on its own.
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Imports that must stay light: nothing here should pull in torch or transformers
+DEFAULT_TARGETS = {
+    "experiment": "import experiment",
+    "models": "import models",
+    "planner": "import utils.planner",
+    "configs": "import config.prompts, config.datasets, config.models, config.experiment",
+}
+
+
+def parse_importtime(stderr):
+    """(cumulative microseconds, module) of every line of `-X importtime` output."""
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        modules.append((int(cumulative), name.strip()))
+    return modules
+
+
+def time_import(code, repeat=5):
+    """Median seconds to run `code` in a fresh interpreter, and its import profile.
+
+    Returns (None, error) if the import fails.
+    """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        process = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", code],
+            cwd=ROOT, capture_output=True, text=True,
+        )
+        timings.append(time.perf_counter() - start)
+        if process.returncode != 0:
+            return None, process.stderr.strip().splitlines()[-1]
+    return statistics.median(timings), parse_importtime(process.stderr)
+
+
+def run_benchmark(targets, repeat=5, top=10):
+    baseline, _ = time_import("pass", repeat)
+    print(f"Interpreter startup: {baseline * 1000:.0f} ms")
+    results = {}
+    for name, code in targets.items():
+        seconds, profile = time_import(code, repeat)
+        results[name] = seconds
+        if seconds is None:
+            print(f"{name}: failed ({profile})")
+            continue
+        print(f"{name}: {seconds * 1000:.0f} ms ({(seconds - baseline) * 1000:.0f} ms over startup)")
+        # Top-level imports only, to avoid listing a package and its submodules twice
+        slowest = sorted(
+            (entry for entry in profile if "." not in entry[1]),
+            reverse=True,
+        )[:top]
+        for cumulative, module in slowest:
+            print(f"    {cumulative / 1000:8.1f} ms  {module}")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure the import time of the entry points.")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--top", type=int, default=10, help="slowest top-level modules listed per target")
+    parser.add_argument("--adapters", action="store_true", help="also time every registered model adapter")
+    args = parser.parse_args()
+
+    targets = dict(DEFAULT_TARGETS)
+    if args.adapters:
+        from models import MODEL_REGISTRY
+        for model_name in MODEL_REGISTRY:
+            targets[model_name] = f"import models; models.get_model_class({model_name!r})"
+    run_benchmark(targets, args.repeat, args.top)
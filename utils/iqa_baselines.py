@@ -0,0 +1,228 @@
+"""
+Classical IQA Baselines
+-----------------------
+Scores the configured sample of every dataset (see utils/manifest.py) with
+the pyiqa metrics of config/baselines.py and writes the scores as a journal
+that utils/evaluation.py reads like any experiment run:
+
+    python -m utils.iqa_baselines [--metrics musiq,liqe] [--datasets KADID10K]
+    python -m utils.evaluation results/journal_<run>.jsonl results/baselines_<timestamp>.jsonl
+
+Metric instances stay alive for the whole run and receive batches of
+pre-decoded image tensors; each image is decoded once and shared by every
+device metric. Scores are cached per (metric, image content hash), so a
+rerun only scores new images and new metrics. CPU metrics run in a pool of
+worker processes, each keeping its own metric instances, while the device
+metrics work.
+"""
+
+import argparse
+import os
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import numpy as np
+import torch
+from PIL import Image
+
+from config.baselines import baselines
+from config.datasets import datasets
+from legacy.common_utils import IQA_METRIC_SCALES, init_iqa_metrics
+from utils.journal import Journal
+from utils.manifest import load_manifest, select_samples
+from utils.prefetch import Prefetcher
+
+# Prompt name of the baseline rows in the journal
+BASELINE_PROMPT = "baseline"
+
+
+class ScoreCache:
+    """Persistent (metric, image content hash) -> score store."""
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        if os.path.dirname(db_path):
+            os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self._conn = sqlite3.connect(db_path, timeout=60)
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS scores (
+                metric TEXT,
+                image_hash TEXT,
+                score REAL,
+                PRIMARY KEY (metric, image_hash)
+            )"""
+        )
+        self._conn.commit()
+
+    def get_many(self, metric, image_hashes):
+        """Cached scores of `metric` as {image_hash: score}."""
+        image_hashes = list(set(image_hashes))
+        scores = {}
+        # Stay below SQLite's limit on bound parameters
+        for start in range(0, len(image_hashes), 500):
+            chunk = image_hashes[start:start + 500]
+            rows = self._conn.execute(
+                f"SELECT image_hash, score FROM scores WHERE metric = ? AND image_hash IN ({','.join('?' * len(chunk))})",
+                [metric, *chunk],
+            )
+            scores.update(rows)
+        return scores
+
+    def put_many(self, metric, scores):
+        self._conn.executemany(
+            "INSERT OR REPLACE INTO scores VALUES (?, ?, ?)",
+            [(metric, image_hash, score) for image_hash, score in scores.items()],
+        )
+        self._conn.commit()
+
+    def close(self):
+        self._conn.close()
+
+
+def decode_image(path):
+    """RGB image as a float tensor (3, H, W) in [0, 1], the input pyiqa metrics take."""
+    with Image.open(path) as image:
+        array = np.asarray(image.convert("RGB"))
+    return torch.from_numpy(array).permute(2, 0, 1).float().div_(255)
+
+
+def score_tensors(metric, metric_name, tensors, batch_size):
+    """Scaled scores of decoded images, batching images of the same size."""
+    scale = IQA_METRIC_SCALES.get(metric_name, 1)
+    by_size = {}
+    for i, tensor in enumerate(tensors):
+        by_size.setdefault(tuple(tensor.shape), []).append(i)
+
+    scores = [None] * len(tensors)
+    for positions in by_size.values():
+        for start in range(0, len(positions), batch_size):
+            chunk = positions[start:start + batch_size]
+            with torch.inference_mode():
+                output = metric(torch.stack([tensors[i] for i in chunk]))
+            for i, value in zip(chunk, output.reshape(len(chunk), -1)[:, 0].float().cpu().tolist()):
+                scores[i] = value * scale
+    return scores
+
+
+def _init_worker(num_threads):
+    torch.set_num_threads(num_threads)
+
+
+def _score_in_worker(metric_name, batch_size, paths):
+    """Pool task: score image files with the worker's own instance of a metric."""
+    metric = init_iqa_metrics([metric_name], device="cpu")[metric_name]
+    return score_tensors(metric, metric_name, [decode_image(path) for path in paths], batch_size)
+
+
+def run_baselines(metric_names=None, dataset_names=None, timestamp=None):
+    """Score every dataset with every baseline metric; returns the journal path."""
+    metric_configs = {
+        name: config for name, config in baselines["metrics"].items()
+        if metric_names is None or name in metric_names
+    }
+    device = baselines["device"]
+    if device == "auto":
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+    pool_metrics = [name for name, config in metric_configs.items() if config.get("cpu") or device == "cpu"]
+    device_metrics = [name for name in metric_configs if name not in pool_metrics]
+
+    cache = ScoreCache(baselines["score_cache_path"])
+    timestamp = timestamp or datetime.now().strftime('%Y%m%d_%H%M%S')
+    journal_path = os.path.join("results", f"baselines_{timestamp}.jsonl")
+    journal = Journal(journal_path)
+
+    pool = None
+    if pool_metrics:
+        num_workers = baselines["cpu_workers"]
+        threads = baselines["cpu_threads_per_worker"] or max(1, len(os.sched_getaffinity(0)) // num_workers)
+        pool = ProcessPoolExecutor(max_workers=num_workers, initializer=_init_worker, initargs=(threads,))
+    instances = init_iqa_metrics(device_metrics, device=device) if device_metrics else {}
+    chunk_size = baselines["chunk_size"]
+
+    for dataset_name, dataset_config in datasets.items():
+        if dataset_names is not None and dataset_name not in dataset_names:
+            continue
+        try:
+            images = select_samples(dataset_name, dataset_config)
+        except OSError as e:
+            print(f"Cannot list dataset {dataset_name}: {str(e)}")
+            continue
+        # The manifest holds the content hashes the cache is keyed by
+        manifest = load_manifest(dataset_name, dataset_config)
+        paths = [os.path.join(dataset_config["path"], image) for image in images]
+        hashes = [manifest.hash_of(image) for image in images]
+
+        missing = {}
+        for name in metric_configs:
+            cached = cache.get_many(name, hashes)
+            missing[name] = [i for i, image_hash in enumerate(hashes) if image_hash not in cached]
+            print(f"{dataset_name} / {name}: {len(images) - len(missing[name])} cached, {len(missing[name])} to score")
+
+        # CPU metrics go to the pool first so they run alongside the device metrics
+        futures = []
+        for name in pool_metrics:
+            todo = missing[name]
+            for start in range(0, len(todo), chunk_size):
+                chunk = todo[start:start + chunk_size]
+                batch_size = metric_configs[name]["batch_size"]
+                futures.append((name, chunk, pool.submit(_score_in_worker, name, batch_size, [paths[i] for i in chunk])))
+
+        # Device metrics: decode every image once for all of them
+        needed = sorted(set().union(*(missing[name] for name in device_metrics)))
+        chunks = [needed[start:start + chunk_size] for start in range(0, len(needed), chunk_size)]
+        prefetcher = Prefetcher(
+            chunks,
+            lambda chunk: [decode_image(paths[i]) for i in chunk],
+            depth=baselines["decode_workers"],
+            num_workers=baselines["decode_workers"],
+        )
+        for chunk, tensors, error in prefetcher:
+            if error is not None:
+                print(f"Error decoding {len(chunk)} images of {dataset_name}: {str(error)}")
+                continue
+            for name in device_metrics:
+                wanted = set(missing[name])
+                selected = [k for k, i in enumerate(chunk) if i in wanted]
+                try:
+                    scores = score_tensors(
+                        instances[name], name, [tensors[k] for k in selected], metric_configs[name]["batch_size"]
+                    )
+                except Exception as e:
+                    print(f"Error scoring {dataset_name} with {name}: {str(e)}")
+                    continue
+                cache.put_many(name, {hashes[chunk[k]]: score for k, score in zip(selected, scores)})
+
+        for name, chunk, future in futures:
+            try:
+                scores = future.result()
+            except Exception as e:
+                print(f"Error scoring {dataset_name} with {name}: {str(e)}")
+                continue
+            cache.put_many(name, {hashes[i]: score for i, score in zip(chunk, scores)})
+
+        # Every score comes from the cache, computed now or in an earlier run
+        for name in metric_configs:
+            scores = cache.get_many(name, hashes)
+            for image, image_hash in zip(images, hashes):
+                if image_hash in scores:
+                    journal.record(name, dataset_name, BASELINE_PROMPT, image, scores[image_hash], None)
+
+    if pool is not None:
+        pool.shutdown()
+    cache.close()
+    journal.close()
+    print(f"Baseline scores saved to {journal_path}")
+    return journal_path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Score the datasets with the classical IQA baselines.")
+    parser.add_argument("--metrics", default=None, help="comma-separated metric names (default: all configured)")
+    parser.add_argument("--datasets", default=None, help="comma-separated dataset names (default: all configured)")
+    args = parser.parse_args()
+
+    run_baselines(
+        args.metrics.split(",") if args.metrics else None,
+        args.datasets.split(",") if args.datasets else None,
+    )
@@ -0,0 +1,74 @@
+"""
+Experiment Journal
+------------------
+Append-only JSON Lines log with one record per scored sample, written as
+soon as the sample is produced. A crashed or preempted run is resumed by
+reading the journal back and skipping the cells it already contains.
+"""
+
+import glob
+import json
+import os
+import re
+
+
+class Journal:
+    """Appends (model, dataset, prompt, image_id, score, raw_output) records.
+
+    Every record is flushed immediately, so at most the sample being written
+    when the process dies is lost; a torn last line is ignored on load.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._file = open(path, "a", encoding="utf-8")
+
+    def record(self, model, dataset, prompt, image_id, score, raw_output):
+        line = json.dumps({
+            "model": model,
+            "dataset": dataset,
+            "prompt": prompt,
+            "image_id": image_id,
+            "score": score,
+            "raw_output": raw_output,
+        }, default=str)
+        self._file.write(line + "\n")
+        self._file.flush()
+
+    def close(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+
+
+def load_journal(path):
+    """Read a journal back as {(model, dataset, prompt): {image_id: (score, raw_output)}}."""
+    completed = {}
+    if not os.path.exists(path):
+        return completed
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # Torn write from an interrupted run
+                continue
+            cell = (entry["model"], entry["dataset"], entry["prompt"])
+            completed.setdefault(cell, {})[entry["image_id"]] = (entry["score"], entry["raw_output"])
+    return completed
+
+
+# Journals of a single shard ("_shard0of4", see utils.sharding) or queue
+# attempt ("_attempt2", see utils.work_queue) only cover part of a run
+_PARTIAL_RUN = re.compile(r"_(shard\d+of\d+|attempt\d+)\.jsonl$")
+
+
+def latest_journal(results_dir="results"):
+    """Path of the most recently modified journal of a whole run in `results_dir`, or None."""
+    journals = [
+        path for path in glob.glob(os.path.join(results_dir, "journal_*.jsonl"))
+        if not _PARTIAL_RUN.search(path)
+    ]
+    return max(journals, key=os.path.getmtime) if journals else None
@@ -0,0 +1,258 @@
+"""
+Dataset Manifests
+-----------------
+One index file per dataset (cache/manifests/<dataset>.json) holding the
+name, file size, dimensions, content hash and MOS of every image, built by
+a single `os.scandir` pass with the files hashed in parallel. Runs load the
+manifest instead of listing and hashing the folder. It is refreshed when
+images are added to, removed from or rewritten in the folder (checked by
+size and modification time), when the MOS file changes, or on `--refresh`;
+only files whose size or modification time changed are read again.
+
+Quick runs score `sample_size` images of each dataset, chosen
+deterministically from `sample_seed`: either uniformly ("random") or evenly
+across MOS quantiles ("stratified"), see `sampling` in config/datasets.py.
+
+    python -m utils.manifest [--datasets KADID10K] [--refresh]
+"""
+
+import argparse
+import hashlib
+import io
+import json
+import os
+import random
+from concurrent.futures import ThreadPoolExecutor
+
+from config.datasets import datasets
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+
+MANIFEST_VERSION = 1
+
+# Per-image columns of the index file, in storage order
+COLUMNS = ("name", "size", "mtime", "width", "height", "hash", "mos")
+
+
+def _read_image_info(path):
+    """Content hash and (width, height) of one image file."""
+    from PIL import Image
+
+    with open(path, "rb") as f:
+        data = f.read()
+    # Opening only parses the header; nothing is decoded
+    with Image.open(io.BytesIO(data)) as image:
+        width, height = image.size
+    return hashlib.sha1(data).hexdigest(), width, height
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+class Manifest:
+    """Per-image columns of one dataset, sorted by image name."""
+
+    def __init__(self, columns, folder, folder_mtime=None, mos_path=None, mos_mtime=None):
+        self.columns = columns
+        self.folder = folder
+        self.folder_mtime = folder_mtime
+        self.mos_path = mos_path
+        self.mos_mtime = mos_mtime
+        self._positions = {name: i for i, name in enumerate(columns["name"])}
+
+    @property
+    def names(self):
+        return self.columns["name"]
+
+    def __len__(self):
+        return len(self.names)
+
+    def entry(self, name):
+        """All columns of one image as a dict, or None if it is not in the manifest."""
+        position = self._positions.get(name)
+        if position is None:
+            return None
+        return {column: values[position] for column, values in self.columns.items()}
+
+    def hash_of(self, name):
+        return self.columns["hash"][self._positions[name]]
+
+    def is_stale(self, mos_path=None):
+        """Whether images were added, removed or rewritten (size or modification
+        time changed), or the MOS file changed, since the manifest was built."""
+        if (
+            _mtime(self.folder) != self.folder_mtime
+            or mos_path != self.mos_path
+            or (mos_path is not None and _mtime(mos_path) != self.mos_mtime)
+        ):
+            return True
+        # A file overwritten in place leaves the folder mtime alone
+        try:
+            with os.scandir(self.folder) as scan:
+                for entry in scan:
+                    position = self._positions.get(entry.name)
+                    if position is None:
+                        continue
+                    stat = entry.stat()
+                    if (stat.st_size, stat.st_mtime_ns) != (self.columns["size"][position], self.columns["mtime"][position]):
+                        return True
+        except OSError:
+            return True
+        return False
+
+    def save(self, path):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp-{os.getpid()}"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({
+                "version": MANIFEST_VERSION,
+                "folder": self.folder,
+                "folder_mtime": self.folder_mtime,
+                "mos_path": self.mos_path,
+                "mos_mtime": self.mos_mtime,
+                "columns": self.columns,
+            }, f, separators=(",", ":"))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        if data.get("version") != MANIFEST_VERSION:
+            return None
+        return cls(data["columns"], data["folder"], data["folder_mtime"], data["mos_path"], data["mos_mtime"])
+
+    def sample(self, sample_size=None, seed=0, sampling="random", strata=10):
+        """Names of a deterministic subsample, in sorted order.
+
+        "random" draws `sample_size` images uniformly. "stratified" sorts the
+        images with a MOS into `strata` equal-count MOS bins and draws from
+        every bin in proportion to its size, so a small sample still spans
+        the whole quality range. The same seed always gives the same sample.
+        """
+        names = self.names
+        if sample_size is None or sample_size >= len(names):
+            return list(names)
+        rng = random.Random(seed)
+        if sampling == "random":
+            return sorted(rng.sample(names, sample_size))
+        if sampling != "stratified":
+            raise ValueError(f"Unknown sampling: {sampling}")
+
+        rated = sorted((mos, name) for name, mos in zip(names, self.columns["mos"]) if mos is not None)
+        if len(rated) < len(names):
+            print(f"Stratified sampling skips {len(names) - len(rated)} images without a MOS")
+        if sample_size >= len(rated):
+            return sorted(name for _, name in rated)
+
+        strata = max(1, min(strata, sample_size))
+        bins = [rated[len(rated) * i // strata:len(rated) * (i + 1) // strata] for i in range(strata)]
+        # Largest-remainder allocation of the sample over the bins
+        quotas = [sample_size * len(members) / len(rated) for members in bins]
+        counts = [int(quota) for quota in quotas]
+        by_remainder = sorted(range(strata), key=lambda i: (counts[i] - quotas[i], i))
+        for i in by_remainder[:sample_size - sum(counts)]:
+            counts[i] += 1
+
+        selected = []
+        for members, count in zip(bins, counts):
+            selected.extend(name for _, name in rng.sample(members, count))
+        return sorted(selected)
+
+
+def build_manifest(folder, mos_path=None, previous=None, num_workers=8):
+    """Scan `folder` once and index its images.
+
+    Files whose size and modification time match `previous` keep their
+    hash and dimensions; the others are read in `num_workers` threads.
+    """
+    folder_mtime = _mtime(folder)
+    with os.scandir(folder) as scan:
+        entries = sorted(
+            (entry.name, entry.stat()) for entry in scan
+            if entry.is_file() and entry.name.lower().endswith(IMAGE_EXTENSIONS)
+        )
+
+    known = {name: previous.entry(name) for name in previous.names} if previous is not None else {}
+
+    columns = {column: [] for column in COLUMNS}
+    to_read = []
+    for i, (name, stat) in enumerate(entries):
+        entry = known.get(name)
+        unchanged = entry is not None and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime_ns
+        columns["name"].append(name)
+        columns["size"].append(stat.st_size)
+        columns["mtime"].append(stat.st_mtime_ns)
+        columns["hash"].append(entry["hash"] if unchanged else None)
+        columns["width"].append(entry["width"] if unchanged else None)
+        columns["height"].append(entry["height"] if unchanged else None)
+        if not unchanged:
+            to_read.append(i)
+
+    with ThreadPoolExecutor(max_workers=max(1, num_workers)) as pool:
+        infos = pool.map(_read_image_info, [os.path.join(folder, columns["name"][i]) for i in to_read])
+        for i, (content_hash, width, height) in zip(to_read, infos):
+            columns["hash"][i] = content_hash
+            columns["width"][i] = width
+            columns["height"][i] = height
+
+    mos_mtime = None
+    if mos_path is not None:
+        from utils.evaluation import MOSIndex
+        mos_mtime = _mtime(mos_path)
+        mos = MOSIndex(mos_path)
+        columns["mos"] = [mos.get(name) for name in columns["name"]]
+    else:
+        columns["mos"] = [None] * len(entries)
+
+    print(f"Indexed {len(entries)} images in {folder} ({len(to_read)} read)")
+    return Manifest(columns, folder, folder_mtime, mos_path, mos_mtime)
+
+
+def manifest_path(dataset_name, manifest_dir="cache/manifests"):
+    return os.path.join(manifest_dir, f"{dataset_name}.json")
+
+
+def load_manifest(dataset_name, dataset_config, manifest_dir="cache/manifests", refresh=False):
+    """The manifest of a configured dataset, (re)built if missing, stale or `refresh`."""
+    path = manifest_path(dataset_name, manifest_dir)
+    mos_path = dataset_config.get("mos_path")
+    manifest = Manifest.load(path) if os.path.exists(path) else None
+    if manifest is not None and manifest.folder != dataset_config["path"]:
+        manifest = None
+    if manifest is not None and not refresh and not manifest.is_stale(mos_path):
+        return manifest
+
+    manifest = build_manifest(dataset_config["path"], mos_path, manifest)
+    manifest.save(path)
+    return manifest
+
+
+def select_samples(dataset_name, dataset_config):
+    """Image names of a dataset a run scores: its configured sample, sorted."""
+    manifest = load_manifest(dataset_name, dataset_config)
+    return manifest.sample(
+        dataset_config.get("sample_size"),
+        seed=dataset_config.get("sample_seed", 0),
+        sampling=dataset_config.get("sampling", "random"),
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build or refresh the dataset manifests.")
+    parser.add_argument("--datasets", default=None, help="comma-separated dataset names (default: all configured)")
+    parser.add_argument("--refresh", action="store_true", help="rescan the folders even if nothing was added or removed")
+    args = parser.parse_args()
+
+    for dataset_name, dataset_config in datasets.items():
+        if args.datasets and dataset_name not in args.datasets.split(","):
+            continue
+        manifest = load_manifest(dataset_name, dataset_config, refresh=args.refresh)
+        samples = select_samples(dataset_name, dataset_config)
+        print(f"{dataset_name}: {len(manifest)} images, {len(samples)} sampled "
+              f"({dataset_config.get('sampling', 'random')}, seed {dataset_config.get('sample_seed', 0)})")
@@ -0,0 +1,219 @@
+"""
+Experiment Planner
+------------------
+Expands models x datasets x active prompts into a task graph before
+anything runs. Prompt versions that need exactly the same model work (same
+text, same kind of pass, same decoding options) collapse into one task whose
+output is fanned out to every consumer's extraction method, and chained
+stages depend on the stage producing their `input_type` and run after it.
+"""
+
+import hashlib
+import json
+import math
+
+from config.prompts import prompts, get_generation_options
+
+
+def generation_key(prompt_config):
+    """Everything that determines the model work of a prompt version.
+
+    Softmax-based versions need one prefill pass read out at `token_pairs`;
+    every other version decodes with its generation options.
+    """
+    if prompt_config["extraction_method"] == "softmax_based":
+        return ("score", prompt_config["text"], tuple(prompt_config["token_pairs"]))
+    options = json.dumps(get_generation_options(prompt_config), sort_keys=True)
+    return ("generate", prompt_config["text"], options)
+
+
+def generation_key_hash(prompt_config):
+    """Short hash of `generation_key`, naming the stored outputs of a chain stage."""
+    return hashlib.sha1(json.dumps(generation_key(prompt_config)).encode()).hexdigest()[:12]
+
+
+def group_prompts(active_prompts):
+    """Map each representative prompt name to every prompt name sharing its work.
+
+    The representative is the first version in config order, so the result
+    keeps the order of `active_prompts`.
+    """
+    groups = {}
+    representatives = {}
+    for prompt_name, prompt_config in active_prompts.items():
+        key = generation_key(prompt_config)
+        if key not in representatives:
+            representatives[key] = prompt_name
+            groups[prompt_name] = []
+        groups[representatives[key]].append(prompt_name)
+    return groups
+
+
+def _all_prompt_versions():
+    return {
+        f"{prompt_id}_{version}": config
+        for prompt_id, prompt_data in prompts.items()
+        for version, config in prompt_data["versions"].items()
+    }
+
+
+def stage_dependencies(active_prompts):
+    """Map each chained prompt to the prompt producing its `input_type`.
+
+    Stages are matched within the same prompt family (e.g. prompt3_v2 reads
+    the scene graph of prompt3_v1). Active producers win; otherwise the
+    first configured version with that `output_type` is used and its outputs
+    must come from the stage store (see `utils.stage_store`).
+    """
+    producers = {}
+    for candidates in (active_prompts, _all_prompt_versions()):
+        for prompt_name, prompt_config in candidates.items():
+            if "output_type" in prompt_config:
+                family = prompt_name.rsplit("_", 1)[0]
+                producers.setdefault((family, prompt_config["output_type"]), prompt_name)
+
+    dependencies = {}
+    for prompt_name, prompt_config in active_prompts.items():
+        if "input_type" in prompt_config:
+            family = prompt_name.rsplit("_", 1)[0]
+            producer = producers.get((family, prompt_config["input_type"]))
+            if producer is None:
+                raise ValueError(f"No prompt produces '{prompt_config['input_type']}' for {prompt_name}")
+            dependencies[prompt_name] = producer
+    return dependencies
+
+
+def shared_stage_dependencies(active_prompts, prompt_groups):
+    """`stage_dependencies` restricted to the representatives of `group_prompts`,
+    with producers that were deduplicated replaced by their representative."""
+    representative_of = {name: rep for rep, names in prompt_groups.items() for name in names}
+    return {
+        prompt_name: representative_of.get(producer, producer)
+        for prompt_name, producer in stage_dependencies(active_prompts).items()
+        if prompt_name in prompt_groups
+    }
+
+
+def stage_order(active_prompts, dependencies):
+    """Active prompt names ordered so every stage runs after its active producer."""
+    ordered = []
+
+    def visit(prompt_name, path=()):
+        if prompt_name in ordered:
+            return
+        if prompt_name in path:
+            raise ValueError(f"Cyclic prompt chain: {' -> '.join(path + (prompt_name,))}")
+        producer = dependencies.get(prompt_name)
+        if producer in active_prompts:
+            visit(producer, path + (prompt_name,))
+        ordered.append(prompt_name)
+
+    for prompt_name in active_prompts:
+        visit(prompt_name)
+    return ordered
+
+
+class Task:
+    """One unit of model work: a prompt run over every sample of a dataset.
+
+    `input_from` names the stage whose outputs fill the prompt; `depends_on`
+    is the task running that stage in this plan (None when the outputs are
+    read from the stage store).
+    """
+
+    def __init__(self, model, dataset, prompt_name, prompt_config, consumers, depends_on, num_samples,
+                 input_from=None):
+        self.model = model
+        self.dataset = dataset
+        self.prompt_name = prompt_name
+        self.prompt_config = prompt_config
+        self.consumers = consumers
+        self.depends_on = depends_on
+        self.num_samples = num_samples
+        self.input_from = input_from
+
+    @property
+    def kind(self):
+        return generation_key(self.prompt_config)[0]
+
+    def __repr__(self):
+        return f"Task({self.model}, {self.dataset}, {self.prompt_name} -> {self.consumers})"
+
+
+def plan_experiment(models, datasets, active_prompts, sample_counts):
+    """Build the task graph of the whole experiment.
+
+    `sample_counts` maps dataset names to the number of images to score.
+    Returns the tasks in execution order; `task.depends_on` names the task
+    (representative prompt) of the same model and dataset that must run first.
+    """
+    groups = group_prompts(active_prompts)
+    representative_of = {name: rep for rep, names in groups.items() for name in names}
+    dependencies = stage_dependencies(active_prompts)
+
+    ordered = [prompt_name for prompt_name in stage_order(active_prompts, dependencies) if prompt_name in groups]
+
+    tasks = []
+    for model in models:
+        for dataset in datasets:
+            for prompt_name in ordered:
+                producer = dependencies.get(prompt_name)
+                tasks.append(Task(
+                    model,
+                    dataset,
+                    prompt_name,
+                    active_prompts[prompt_name],
+                    groups[prompt_name],
+                    representative_of.get(producer),
+                    sample_counts.get(dataset, 0),
+                    input_from=producer,
+                ))
+    return tasks
+
+
+def estimate_work(tasks, batch_size, execution_order="prompt_major"):
+    """Rough cost of a plan: forward passes, decode steps and image loads."""
+    estimate = {"tasks": len(tasks), "deduplicated": 0, "prefill_passes": 0,
+                "batches": 0, "max_decode_steps": 0, "unbounded_tasks": 0, "image_loads": 0}
+    images_per_cell = {}
+    for task in tasks:
+        n = task.num_samples
+        estimate["deduplicated"] += len(task.consumers) - 1
+        estimate["prefill_passes"] += n
+        estimate["batches"] += math.ceil(n / batch_size)
+        if task.kind == "generate":
+            budget = get_generation_options(task.prompt_config).get("max_new_tokens")
+            if budget is None:
+                estimate["unbounded_tasks"] += 1
+            else:
+                estimate["max_decode_steps"] += math.ceil(n / batch_size) * budget
+        cell = (task.model, task.dataset)
+        if execution_order == "image_major":
+            images_per_cell[cell] = n
+        else:
+            images_per_cell[cell] = images_per_cell.get(cell, 0) + n
+    estimate["image_loads"] = sum(images_per_cell.values())
+    return estimate
+
+
+def print_plan(tasks, batch_size, execution_order="prompt_major"):
+    """Print the task graph and its estimated work."""
+    print(f"Experiment plan: {len(tasks)} tasks")
+    for task in tasks:
+        shared = f" (shared by {', '.join(task.consumers)})" if len(task.consumers) > 1 else ""
+        after = ""
+        if task.depends_on:
+            after = f", after {task.depends_on}"
+        elif task.input_from:
+            after = f", reads stored {task.input_from} outputs"
+        print(f"  {task.model} / {task.dataset} / {task.prompt_name}: "
+              f"{task.kind}, {task.num_samples} images{after}{shared}")
+
+    estimate = estimate_work(tasks, batch_size, execution_order)
+    print(f"Estimated work: {estimate['prefill_passes']} prefill passes in {estimate['batches']} batches, "
+          f"up to {estimate['max_decode_steps']} batched decode steps"
+          + (f" (+{estimate['unbounded_tasks']} tasks without a token budget)" if estimate["unbounded_tasks"] else "")
+          + f", {estimate['image_loads']} image loads")
+    if estimate["deduplicated"]:
+        print(f"Deduplicated {estimate['deduplicated']} prompt versions sharing identical generation work")
+    return estimate
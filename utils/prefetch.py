@@ -0,0 +1,61 @@
+"""
+Background Prefetching
+----------------------
+Bounded producer/consumer pipeline that loads the next samples (image
+decoding, processor calls, host-to-device copies) in worker threads while
+the current batch is generating.
+"""
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Prefetcher:
+    """Iterate over `load_fn(item)` while the following items load in the background.
+
+    At most `depth` items are in flight at any time: a new item is only
+    submitted once the consumer takes a finished one, so a slow model applies
+    backpressure to the loaders instead of letting the queue grow. Items are
+    yielded in input order as `(item, result, error)`; a failed load yields
+    its exception as `error` so the consumer can handle it per sample.
+
+    With `depth=0` items are loaded synchronously on the calling thread.
+    """
+
+    def __init__(self, items, load_fn, depth=2, num_workers=2):
+        self.items = items
+        self.load_fn = load_fn
+        self.depth = depth
+        self.num_workers = num_workers
+
+    def _load(self, item):
+        try:
+            return self.load_fn(item), None
+        except Exception as e:
+            return None, e
+
+    def __iter__(self):
+        if self.depth <= 0:
+            for item in self.items:
+                result, error = self._load(item)
+                yield item, result, error
+            return
+
+        items = iter(self.items)
+        with ThreadPoolExecutor(max_workers=max(1, self.num_workers)) as pool:
+            pending = deque()
+
+            def submit_next():
+                for item in items:
+                    pending.append((item, pool.submit(self._load, item)))
+                    return
+
+            for _ in range(self.depth):
+                submit_next()
+
+            while pending:
+                item, future = pending.popleft()
+                result, error = future.result()
+                # Refill the queue before handing the result to the consumer
+                submit_next()
+                yield item, result, error
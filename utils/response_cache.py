@@ -0,0 +1,121 @@
+"""
+Response Cache
+--------------
+SQLite-backed memoization of model generations, keyed by model path, exact
+prompt text, image content hash and generation settings, so reruns only pay
+for the cells of the experiment matrix that changed.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+def image_content_hash(image):
+    """SHA-1 of an image file's bytes (decoded images carry it in `info`)."""
+    if hasattr(image, "info"):
+        return image.info.get("content_hash")
+    with open(image, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+class ResponseCache:
+    """Persistent (key -> response text) store with hit/miss counters and
+    least-recently-used eviction once the stored text exceeds `max_bytes`.
+
+    The connection is shared between the driver and prefetch worker threads
+    and guarded by a lock.
+    """
+
+    def __init__(self, db_path, max_bytes):
+        self.db_path = db_path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        if os.path.dirname(db_path):
+            os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        # Shard workers share the database; wait for their writes instead of failing
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, timeout=60)
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                model_path TEXT,
+                prompt TEXT,
+                image_hash TEXT,
+                generation_kwargs TEXT,
+                response TEXT,
+                size INTEGER,
+                last_used REAL
+            )"""
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+        self._conn.commit()
+
+    @staticmethod
+    def make_key(model_path, prompt, image_hash, generation_kwargs):
+        """Hash of everything that determines a generation."""
+        payload = json.dumps([model_path, prompt, image_hash, generation_kwargs], sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def get(self, key):
+        """Return the cached response for `key`, or None."""
+        with self._lock:
+            row = self._conn.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._conn.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+            self._conn.commit()
+            return row[0]
+
+    def put(self, key, model_path, prompt, image_hash, generation_kwargs, response):
+        """Store a response and evict the least recently used ones over the cap."""
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (key, model_path, prompt, image_hash, json.dumps(generation_kwargs, sort_keys=True, default=str),
+                 response, len(response.encode()) + len(prompt.encode()), time.time()),
+            )
+            self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        excess = total - self.max_bytes
+        freed = 0
+        stale = []
+        for key, size in self._conn.execute("SELECT key, size FROM responses ORDER BY last_used"):
+            if freed >= excess:
+                break
+            stale.append((key,))
+            freed += size
+        self._conn.executemany("DELETE FROM responses WHERE key = ?", stale)
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def stats(self):
+        """Hit/miss counters of this session and the current store size."""
+        with self._lock:
+            entries, size = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": entries,
+            "bytes": size,
+        }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
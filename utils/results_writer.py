@@ -0,0 +1,90 @@
+"""
+Streaming Results Writer
+------------------------
+Writes experiment results to Parquet one row group at a time, so memory use
+stays flat however long the run is. Model, dataset and prompt columns are
+dictionary-encoded, and the raw generations live in their own
+zstd-compressed column that analysis code can skip entirely, e.g.
+
+    pd.read_parquet(path, columns=["dataset", "prompt", "image_id", "score_value"])
+"""
+
+import os
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+
+RESULTS_SCHEMA = pa.schema([
+    ("model_name", pa.dictionary(pa.int32(), pa.string())),
+    ("dataset", pa.dictionary(pa.int32(), pa.string())),
+    ("prompt", pa.dictionary(pa.int32(), pa.string())),
+    ("image_id", pa.string()),
+    # The score as the driver produced it (number, extracted text or raw answer)
+    ("predicted_score", pa.string()),
+    # The same score as a float when it is numeric, null otherwise
+    ("score_value", pa.float64()),
+    ("raw_output", pa.string()),
+])
+
+
+def _score_value(score):
+    try:
+        return float(score)
+    except (TypeError, ValueError):
+        return None
+
+
+class ParquetResultsWriter:
+    """Buffers result rows and flushes them as Parquet row groups of `row_group_size`.
+
+    Only successfully scored samples are written; a missing (dataset, prompt,
+    image_id) row marks a sample that failed.
+    """
+
+    def __init__(self, path, row_group_size=1000):
+        self.path = path
+        self.row_group_size = row_group_size
+        self.rows_written = 0
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._writer = pq.ParquetWriter(
+            path,
+            RESULTS_SCHEMA,
+            use_dictionary=["model_name", "dataset", "prompt"],
+            compression={
+                "model_name": "snappy",
+                "dataset": "snappy",
+                "prompt": "snappy",
+                "image_id": "snappy",
+                "predicted_score": "snappy",
+                "score_value": "snappy",
+                "raw_output": "zstd",
+            },
+        )
+        self._buffer = {name: [] for name in RESULTS_SCHEMA.names}
+
+    def write(self, model_name, dataset, prompt, image_id, score, raw_output):
+        """Add one result row, flushing a row group when the buffer is full."""
+        self._buffer["model_name"].append(model_name)
+        self._buffer["dataset"].append(dataset)
+        self._buffer["prompt"].append(prompt)
+        self._buffer["image_id"].append(image_id)
+        self._buffer["predicted_score"].append(None if score is None else str(score))
+        self._buffer["score_value"].append(_score_value(score))
+        self._buffer["raw_output"].append(None if raw_output is None else str(raw_output))
+        if len(self._buffer["image_id"]) >= self.row_group_size:
+            self.flush()
+
+    def flush(self):
+        """Write the buffered rows as one row group."""
+        if not self._buffer["image_id"]:
+            return
+        table = pa.Table.from_pydict(self._buffer, schema=RESULTS_SCHEMA)
+        self._writer.write_table(table)
+        self.rows_written += table.num_rows
+        self._buffer = {name: [] for name in RESULTS_SCHEMA.names}
+
+    def close(self):
+        self.flush()
+        self._writer.close()
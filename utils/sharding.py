@@ -0,0 +1,174 @@
+"""
+Dataset Sharding
+----------------
+Splits the (dataset, image) work list into N shards, runs every shard in its
+own `experiment.py` worker process pinned to a GPU or to a set of CPU cores,
+and merges the per-shard journals into one journal and one Parquet file per
+model. Workers only need the same configs and dataset folders, so the
+launcher also works on CPU-only machines.
+
+With adaptive screening on, every shard stops its cells on its own images,
+so a sharded run scores a different set of images than a serial one.
+"""
+
+import os
+import subprocess
+import sys
+from datetime import datetime
+
+from config.datasets import datasets
+from config.experiment import experiment
+from config.models import models
+from config.prompts import get_active_prompts
+from utils.journal import Journal, load_journal
+from utils.planner import group_prompts, shared_stage_dependencies, stage_order
+
+
+def shard_samples(samples, shard_index, num_shards):
+    """The samples of one shard: every `num_shards`-th image starting at `shard_index`.
+
+    Interleaving keeps shards balanced even when image names (and so image
+    sizes or distortion types) are clustered in the sorted listing.
+    """
+    return samples[shard_index::num_shards]
+
+
+def parse_shard(value):
+    """Parse "I/N" into (I, N)."""
+    index, count = (int(part) for part in value.split("/"))
+    if not 0 <= index < count:
+        raise ValueError(f"Invalid shard {value}: expected I/N with 0 <= I < N")
+    return index, count
+
+
+def shard_run_id(timestamp, shard_index, num_shards):
+    """Run id of one shard; its journal and results files carry it in their names."""
+    return f"{timestamp}_shard{shard_index}of{num_shards}"
+
+
+def worker_placements(num_shards, devices="cpu"):
+    """Environment and CPU cores of every worker.
+
+    `devices` is "cpu" or a list of GPU ids assigned round-robin. The CPU
+    cores available to the launcher are split into contiguous, disjoint sets
+    either way, and the thread pools of each worker are sized to its set.
+    """
+    cores = sorted(os.sched_getaffinity(0))
+    per_worker = max(1, len(cores) // num_shards)
+
+    placements = []
+    for i in range(num_shards):
+        cpus = cores[i * per_worker:(i + 1) * per_worker] or cores
+        env = dict(os.environ)
+        env["OMP_NUM_THREADS"] = env["MKL_NUM_THREADS"] = str(len(cpus))
+        env["CUDA_VISIBLE_DEVICES"] = "" if devices == "cpu" else str(devices[i % len(devices)])
+        placements.append({"env": env, "cpus": cpus})
+    return placements
+
+
+def launch_shards(num_shards, devices="cpu", timestamp=None, results_dir="results"):
+    """Run `num_shards` workers in parallel, wait for them and merge their results.
+
+    Passing the `timestamp` of an earlier sharded run resumes it: every
+    worker continues from its own journal. Returns the workers' exit codes.
+    """
+    timestamp = timestamp or datetime.now().strftime('%Y%m%d_%H%M%S')
+    log_dir = os.path.join(results_dir, "logs")
+    os.makedirs(log_dir, exist_ok=True)
+    script = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "experiment.py")
+
+    workers = []
+    for i, placement in enumerate(worker_placements(num_shards, devices)):
+        run_id = shard_run_id(timestamp, i, num_shards)
+        command = [sys.executable, script, "--shard", f"{i}/{num_shards}"]
+        journal_path = os.path.join(results_dir, f"journal_{run_id}.jsonl")
+        if os.path.exists(journal_path):
+            command += ["--resume", journal_path]
+        else:
+            command += ["--run-id", run_id]
+
+        log = open(os.path.join(log_dir, f"{run_id}.log"), "a")
+        process = subprocess.Popen(
+            command,
+            env=placement["env"],
+            stdout=log,
+            stderr=subprocess.STDOUT,
+            preexec_fn=lambda cpus=placement["cpus"]: os.sched_setaffinity(0, cpus),
+        )
+        print(f"Shard {i}/{num_shards}: pid {process.pid}, "
+              f"{'cpu' if devices == 'cpu' else 'gpu ' + str(devices[i % len(devices)])}, "
+              f"cores {placement['cpus'][0]}-{placement['cpus'][-1]}")
+        workers.append((process, log))
+
+    exit_codes = []
+    for process, log in workers:
+        exit_codes.append(process.wait())
+        log.close()
+
+    failed = [i for i, code in enumerate(exit_codes) if code != 0]
+    if failed:
+        print(f"Shards {failed} failed, see {log_dir}; rerun with the same timestamp to resume them")
+    merge_shards(timestamp, num_shards, results_dir)
+    return exit_codes
+
+
+def merge_shards(timestamp, num_shards, results_dir="results"):
+    """Merge the shard journals of a run into journal_<timestamp>.jsonl and one
+    Parquet file per model, see `merge_journals`."""
+    journal_paths = []
+    for i in range(num_shards):
+        journal_path = os.path.join(results_dir, f"journal_{shard_run_id(timestamp, i, num_shards)}.jsonl")
+        if not os.path.exists(journal_path):
+            print(f"Missing shard journal: {journal_path}")
+            continue
+        journal_paths.append(journal_path)
+    merge_journals(journal_paths, timestamp, results_dir)
+
+
+def merge_journals(journal_paths, timestamp, results_dir="results"):
+    """Merge partial-run journals into journal_<timestamp>.jsonl and one Parquet
+    file per model.
+
+    Rows are written in the order of a serial prompt-major run (model,
+    dataset, prompt stage, image, consumer version). Without adaptive
+    screening the merged files match what `run_experiment` writes without
+    sharding.
+    """
+    from utils.results_writer import ParquetResultsWriter
+
+    completed = {}
+    for journal_path in journal_paths:
+        for cell, entries in load_journal(journal_path).items():
+            completed.setdefault(cell, {}).update(entries)
+
+    active_prompts = get_active_prompts()
+    prompt_groups = group_prompts(active_prompts)
+    unique_prompts = {prompt_name: active_prompts[prompt_name] for prompt_name in prompt_groups}
+    order = stage_order(unique_prompts, shared_stage_dependencies(active_prompts, prompt_groups))
+
+    # A resumed launch merges again from scratch
+    merged_journal_path = os.path.join(results_dir, f"journal_{timestamp}.jsonl")
+    if os.path.exists(merged_journal_path):
+        os.remove(merged_journal_path)
+    journal = Journal(merged_journal_path)
+    for model, model_config in models.items():
+        results_path = os.path.join(results_dir, f"{model_config['model_name']}_results_{timestamp}.parquet")
+        writer = ParquetResultsWriter(results_path, experiment["results_row_group_size"])
+        for dataset_name in datasets:
+            image_ids = sorted({
+                image_id
+                for prompt_name in active_prompts
+                for image_id in completed.get((model, dataset_name, prompt_name), {})
+            })
+            for prompt_name in order:
+                for image_id in image_ids:
+                    for consumer in prompt_groups[prompt_name]:
+                        entry = completed.get((model, dataset_name, consumer), {}).get(image_id)
+                        if entry is None:
+                            continue
+                        score, raw_output = entry
+                        journal.record(model, dataset_name, consumer, image_id, score, raw_output)
+                        writer.write(model_config["model_name"], dataset_name, consumer, image_id, score, raw_output)
+        writer.close()
+        print(f"Merged results saved to {results_path} ({writer.rows_written} rows)")
+    journal.close()
@@ -0,0 +1,51 @@
+"""
+Stage Output Store
+------------------
+Persists the outputs of chained prompt stages (scene graphs, guideline
+lists, ...) per model, dataset and producing prompt, across runs. A later
+stage reads them back, so it can be re-run or batched on its own without
+regenerating the stage before it. Outputs are filed under a hash of the
+producer's generation key (`utils.planner.generation_key_hash`), so editing
+a producer's text or decoding options never serves outputs of the old one.
+"""
+
+import json
+import os
+import re
+
+
+class StageStore:
+    """One JSON Lines file of {image_id, output} records per (model, dataset, prompt, key).
+
+    Records are appended and flushed as they are produced; on load the last
+    record of an image wins and a torn last line is ignored.
+    """
+
+    def __init__(self, root="results/stages"):
+        self.root = root
+
+    def path(self, model, dataset, prompt_name, key):
+        parts = [re.sub(r"[^\w.-]", "_", part) for part in (model, dataset, prompt_name, key)]
+        return os.path.join(self.root, *parts[:2], f"{parts[2]}-{parts[3]}.jsonl")
+
+    def load(self, model, dataset, prompt_name, key):
+        """Stored outputs as {image_id: output}."""
+        outputs = {}
+        path = self.path(model, dataset, prompt_name, key)
+        if not os.path.exists(path):
+            return outputs
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # Torn write from an interrupted run
+                    continue
+                outputs[entry["image_id"]] = entry["output"]
+        return outputs
+
+    def append(self, model, dataset, prompt_name, key, image_id, output):
+        path = self.path(model, dataset, prompt_name, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "a", encoding="utf-8") as f:
+            f.write(json.dumps({"image_id": image_id, "output": output}) + "\n")
@@ -0,0 +1,194 @@
+"""
+Preprocessed Tensor Cache
+-------------------------
+On-disk, content-addressed cache of image-processor outputs. Entries are
+keyed by the image content hash plus the processor identity, stored as .npy
+files and loaded memory-mapped, with LRU eviction under a size cap.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import torch
+from transformers import BatchFeature
+
+
+class TensorCache:
+    """Directory of cached tensor dicts with a total size cap and LRU eviction.
+
+    Each entry is a sub-directory named after its key holding one .npy file
+    per tensor. Recency is tracked through the entry's modification time so
+    it survives across runs.
+    """
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> size in bytes, oldest first
+        self.total_bytes = 0
+        os.makedirs(cache_dir, exist_ok=True)
+        self._scan()
+
+    def _scan(self):
+        """Index existing entries from oldest to most recently used."""
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if not entry.is_dir() or ".tmp-" in entry.name:
+                continue
+            size = sum(f.stat().st_size for f in os.scandir(entry.path))
+            entries.append((entry.stat().st_mtime, entry.name, size))
+        for _, key, size in sorted(entries):
+            self._entries[key] = size
+            self.total_bytes += size
+
+    def get(self, key):
+        """Return the cached tensors for `key` (memory-mapped), or None."""
+        entry_dir = os.path.join(self.cache_dir, key)
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        try:
+            os.utime(entry_dir)
+            tensors = {}
+            for name in os.listdir(entry_dir):
+                # Copy-on-write mapping: no read or copy until the data is touched
+                array = np.load(os.path.join(entry_dir, name), mmap_mode="c")
+                tensors[name[:-len(".npy")]] = torch.from_numpy(array)
+            return tensors
+        except OSError:
+            # Evicted by another process in the meantime
+            with self._lock:
+                self.total_bytes -= self._entries.pop(key, 0)
+            return None
+
+    def put(self, key, tensors):
+        """Store a dict of tensors under `key` and evict old entries over the cap."""
+        entry_dir = os.path.join(self.cache_dir, key)
+        tmp_dir = f"{entry_dir}.tmp-{os.getpid()}-{threading.get_ident()}"
+        os.makedirs(tmp_dir, exist_ok=True)
+        size = 0
+        for name, tensor in tensors.items():
+            path = os.path.join(tmp_dir, f"{name}.npy")
+            np.save(path, tensor.detach().cpu().numpy())
+            size += os.path.getsize(path)
+
+        # Publish atomically; a concurrent writer of the same key wins the race
+        try:
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+        with self._lock:
+            self.total_bytes += size - self._entries.get(key, 0)
+            self._entries[key] = size
+            self._entries.move_to_end(key)
+            evicted = []
+            while self.total_bytes > self.max_bytes and len(self._entries) > 1:
+                old_key, old_size = self._entries.popitem(last=False)
+                self.total_bytes -= old_size
+                evicted.append(old_key)
+        for old_key in evicted:
+            shutil.rmtree(os.path.join(self.cache_dir, old_key), ignore_errors=True)
+
+
+def processor_identity(name, config):
+    """Short hash identifying a processor by name and configuration."""
+    payload = json.dumps([name, config], sort_keys=True, default=str)
+    return hashlib.sha1(payload.encode()).hexdigest()[:16]
+
+
+def _image_key(image, identity, kwargs):
+    """Cache key of one decoded image, or None if its content hash is unknown.
+
+    The decoded size is part of the key, since the same file decodes to
+    different pixels at another reduced resolution.
+    """
+    content_hash = image.info.get("content_hash")
+    if content_hash is None:
+        return None
+    options = json.dumps(kwargs, sort_keys=True, default=str)
+    width, height = image.size
+    return hashlib.sha1(f"{identity}:{content_hash}:{width}x{height}:{options}".encode()).hexdigest()
+
+
+def _collate(rows):
+    """Stack per-image tensors into a batch, zero-padding the first dimension
+    (e.g. LLaVA-1.6 patch counts) like the processors do."""
+    if len(rows) == 1:
+        return rows[0].unsqueeze(0)
+    if all(row.shape == rows[0].shape for row in rows):
+        return torch.stack(rows)
+    max_len = max(row.shape[0] for row in rows)
+    batch = rows[0].new_zeros((len(rows), max_len, *rows[0].shape[1:]))
+    for i, row in enumerate(rows):
+        batch[i, :row.shape[0]] = row
+    return batch
+
+
+class CachedImageProcessor:
+    """Drop-in wrapper around a Hugging Face image processor backed by a TensorCache.
+
+    Images are looked up one by one by content hash (set by
+    `BaseModel.load_image`); misses run through the wrapped processor and are
+    stored. A single cached image is returned as a view of the memory-mapped
+    file. Every other attribute is forwarded to the wrapped processor.
+    """
+
+    def __init__(self, image_processor, cache, identity):
+        self.image_processor = image_processor
+        self.cache = cache
+        self.identity = identity
+
+    def __getattr__(self, name):
+        return getattr(self.image_processor, name)
+
+    def __call__(self, images, return_tensors=None, **kwargs):
+        if not isinstance(images, (list, tuple)):
+            images = [images]
+
+        rows = []
+        for image in images:
+            key = _image_key(image, self.identity, kwargs)
+            tensors = self.cache.get(key) if key is not None else None
+            if tensors is None:
+                output = self.image_processor(image, return_tensors="pt", **kwargs)
+                tensors = {name: value[0] for name, value in output.items() if isinstance(value, torch.Tensor)}
+                if key is not None:
+                    self.cache.put(key, tensors)
+            rows.append(tensors)
+
+        return BatchFeature({name: _collate([row[name] for row in rows]) for name in rows[0]})
+
+    def preprocess(self, images, return_tensors=None, **kwargs):
+        return self(images, return_tensors=return_tensors, **kwargs)
+
+
+class CachedTransform:
+    """Wrapper around a single-image transform (e.g. a torchvision Compose)
+    returning one tensor, backed by a TensorCache."""
+
+    def __init__(self, transform, cache, identity):
+        self.transform = transform
+        self.cache = cache
+        self.identity = identity
+
+    def __call__(self, image):
+        key = _image_key(image, self.identity, {})
+        tensors = self.cache.get(key) if key is not None else None
+        if tensors is not None:
+            return tensors["pixel_values"]
+        pixel_values = self.transform(image)
+        if key is not None:
+            self.cache.put(key, {"pixel_values": pixel_values})
+        return pixel_values
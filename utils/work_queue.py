@@ -0,0 +1,286 @@
+"""
+Shared-Filesystem Work Queue
+----------------------------
+Lease-based task queue in a directory shared by every worker (NFS, a
+cluster filesystem, or simply a local directory for several processes on
+one machine). No central service is involved; coordination relies only on
+exclusive file creation and hard links, which are atomic on POSIX and NFS.
+
+Layout of the queue directory:
+
+    tasks/<task_id>.json        task specs, written once
+    leases/<task_id>.<n>        the n-th claim of a task; its mtime is the heartbeat
+    done/<task_id>.jsonl        committed result (the worker's journal), exactly one
+    partial/<task_id>.jsonl     latest incomplete result, resumed by the next attempt
+    gaps/<task_id>.json         what a result committed after its last attempt misses
+
+A worker claims a task by creating lease generation n+1 with O_EXCL, so only
+one of several racing workers wins. A lease whose heartbeat is older than
+the TTL is abandoned and can be claimed again. Results are committed by
+hard-linking into done/, which fails if another attempt already committed.
+"""
+
+import json
+import os
+import shutil
+import socket
+import threading
+import time
+from contextlib import contextmanager
+
+
+class IncompleteResult(Exception):
+    """Raised by a task whose result misses part of its work.
+
+    The next attempt resumes from `result_path`; after the last attempt it
+    is committed as is, with `gaps` recorded next to it.
+    """
+
+    def __init__(self, result_path, gaps):
+        super().__init__(f"incomplete result, gaps: {gaps}")
+        self.result_path = result_path
+        self.gaps = gaps
+
+
+class Lease:
+    """A worker's claim on one task."""
+
+    def __init__(self, task_id, generation, path, spec):
+        self.task_id = task_id
+        self.generation = generation
+        self.path = path
+        self.spec = spec
+
+
+class WorkQueue:
+    """Claim, heartbeat and commit tasks in a shared queue directory.
+
+    Leases expire `lease_ttl` seconds after their last heartbeat; keep it
+    well above the heartbeat interval and any clock skew between nodes. A
+    task is given up after `max_attempts` claims that did not commit.
+    """
+
+    def __init__(self, queue_dir, lease_ttl=600, max_attempts=3, worker_id=None):
+        self.queue_dir = queue_dir
+        self.lease_ttl = lease_ttl
+        self.max_attempts = max_attempts
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+        for name in ("tasks", "leases", "done", "partial", "gaps"):
+            os.makedirs(os.path.join(queue_dir, name), exist_ok=True)
+
+    def _path(self, *parts):
+        return os.path.join(self.queue_dir, *parts)
+
+    def _publish(self, path, write):
+        """Create `path` atomically via a temporary file and a hard link.
+        Returns False if it already exists."""
+        tmp_path = f"{path}.tmp-{self.worker_id}-{threading.get_ident()}"
+        write(tmp_path)
+        try:
+            os.link(tmp_path, path)
+            return True
+        except FileExistsError:
+            return False
+        finally:
+            os.remove(tmp_path)
+
+    def add_task(self, task_id, spec):
+        """Add a task unless it exists already; safe to call from every worker."""
+        def write(tmp_path):
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(spec, f)
+        return self._publish(self._path("tasks", f"{task_id}.json"), write)
+
+    def tasks(self):
+        """All task specs as {task_id: spec}, in task id order."""
+        specs = {}
+        for name in sorted(os.listdir(self._path("tasks"))):
+            if name.endswith(".json"):
+                with open(self._path("tasks", name), encoding="utf-8") as f:
+                    specs[name[:-len(".json")]] = json.load(f)
+        return specs
+
+    def is_done(self, task_id):
+        return os.path.exists(self._path("done", f"{task_id}.jsonl"))
+
+    def _generations(self, task_id):
+        prefix = f"{task_id}."
+        generations = []
+        for name in os.listdir(self._path("leases")):
+            if name.startswith(prefix) and name[len(prefix):].isdigit():
+                generations.append(int(name[len(prefix):]))
+        return generations
+
+    def _expired(self, path):
+        try:
+            return time.time() - os.stat(path).st_mtime > self.lease_ttl
+        except FileNotFoundError:
+            return True
+
+    def claim(self):
+        """Claim the first open task: never claimed, or its lease expired.
+
+        Returns a Lease, or None when every task is done, leased or given up.
+        """
+        for task_id, spec in self.tasks().items():
+            if self.is_done(task_id):
+                continue
+            generations = self._generations(task_id)
+            current = max(generations, default=0)
+            if current >= self.max_attempts:
+                continue
+            if current and not self._expired(self._path("leases", f"{task_id}.{current}")):
+                continue
+
+            path = self._path("leases", f"{task_id}.{current + 1}")
+            try:
+                fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                # Another worker won this generation
+                continue
+            with os.fdopen(fd, "w") as f:
+                json.dump({"worker": self.worker_id, "claimed_at": time.time()}, f)
+            return Lease(task_id, current + 1, path, spec)
+        return None
+
+    def holds(self, lease):
+        """Whether `lease` is still the task's current, unexpired claim."""
+        return max(self._generations(lease.task_id), default=0) == lease.generation and not self._expired(lease.path)
+
+    def heartbeat(self, lease):
+        os.utime(lease.path)
+
+    @contextmanager
+    def keep_alive(self, lease, interval=None):
+        """Heartbeat `lease` from a background thread while the block runs."""
+        interval = interval or self.lease_ttl / 4
+        stop = threading.Event()
+
+        def beat():
+            while not stop.wait(interval):
+                try:
+                    self.heartbeat(lease)
+                except OSError:
+                    pass
+
+        thread = threading.Thread(target=beat, daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+
+    def release(self, lease):
+        """Give a lease up so the task can be claimed again right away."""
+        try:
+            os.utime(lease.path, (0, 0))
+        except FileNotFoundError:
+            pass
+
+    def commit(self, lease, result_path):
+        """Publish `result_path` as the task's result, exactly once.
+
+        Returns False (and publishes nothing) if the lease was lost or
+        another attempt of the task already committed.
+        """
+        if not self.holds(lease):
+            return False
+        return self._publish(
+            self._path("done", f"{lease.task_id}.jsonl"),
+            lambda tmp_path: shutil.copyfile(result_path, tmp_path),
+        )
+
+    def save_partial(self, lease, result_path):
+        """Keep an incomplete result for the task's next attempt (the latest one wins)."""
+        path = self._path("partial", f"{lease.task_id}.jsonl")
+        tmp_path = f"{path}.tmp-{self.worker_id}-{threading.get_ident()}"
+        shutil.copyfile(result_path, tmp_path)
+        os.replace(tmp_path, path)
+
+    def partial(self, task_id):
+        """Path of the task's latest incomplete result, or None."""
+        path = self._path("partial", f"{task_id}.jsonl")
+        return path if os.path.exists(path) else None
+
+    def record_gaps(self, task_id, gaps):
+        def write(tmp_path):
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(gaps, f)
+        return self._publish(self._path("gaps", f"{task_id}.json"), write)
+
+    def gaps(self):
+        """Recorded gaps of the committed results as {task_id: gaps}."""
+        recorded = {}
+        for name in sorted(os.listdir(self._path("gaps"))):
+            if name.endswith(".json"):
+                with open(self._path("gaps", name), encoding="utf-8") as f:
+                    recorded[name[:-len(".json")]] = json.load(f)
+        return recorded
+
+    def status(self):
+        """Counts of done, leased, given-up and open tasks."""
+        counts = {"done": 0, "leased": 0, "failed": 0, "open": 0}
+        for task_id in self.tasks():
+            current = max(self._generations(task_id), default=0)
+            if self.is_done(task_id):
+                counts["done"] += 1
+            elif current and not self._expired(self._path("leases", f"{task_id}.{current}")):
+                counts["leased"] += 1
+            elif current >= self.max_attempts:
+                counts["failed"] += 1
+            else:
+                counts["open"] += 1
+        return counts
+
+    def results(self):
+        """Paths of the committed results, in task id order."""
+        return [self._path("done", f"{task_id}.jsonl") for task_id in self.tasks() if self.is_done(task_id)]
+
+
+def run_worker(queue, run_task, poll_interval=30):
+    """Claim and run tasks until none is left to claim or wait for.
+
+    `run_task(task_id, spec, attempt_id, previous)` does the work and returns
+    the path of the result to commit; `previous` is the incomplete result of
+    an earlier attempt to resume from, or None. Failed tasks are released for
+    another attempt. A task raising `IncompleteResult` is released too, with
+    its result kept for the next attempt; on its last attempt the result is
+    committed with its gaps recorded instead.
+    """
+    while True:
+        lease = queue.claim()
+        if lease is None:
+            counts = queue.status()
+            if counts["leased"] == 0:
+                print(f"Queue drained: {counts}")
+                return counts
+            # Wait for running tasks to finish or their leases to expire
+            time.sleep(poll_interval)
+            continue
+
+        attempt_id = f"{lease.task_id}_attempt{lease.generation}"
+        print(f"Claimed {lease.task_id} (attempt {lease.generation}) as {queue.worker_id}")
+        gaps = None
+        try:
+            with queue.keep_alive(lease):
+                result_path = run_task(lease.task_id, lease.spec, attempt_id, queue.partial(lease.task_id))
+        except IncompleteResult as e:
+            if lease.generation < queue.max_attempts:
+                print(f"Task {lease.task_id} incomplete, keeping its result for the next attempt: {e.gaps}")
+                queue.save_partial(lease, e.result_path)
+                queue.release(lease)
+                continue
+            print(f"Task {lease.task_id} still incomplete after {lease.generation} attempts, committing it with its gaps")
+            result_path, gaps = e.result_path, e.gaps
+        except Exception as e:
+            print(f"Task {lease.task_id} failed: {str(e)}")
+            queue.release(lease)
+            continue
+
+        if queue.commit(lease, result_path):
+            if gaps is not None:
+                queue.record_gaps(lease.task_id, gaps)
+            print(f"Committed {lease.task_id}")
+        else:
+            print(f"Discarded {lease.task_id}: lease lost or committed by another worker")